@@ -1,28 +1,155 @@
 #!/usr/bin/env python3
 # -*-coding:utf-8 -*-
+import sys
 import argparse
 from base import *
+from jobqueue import QUEUE_FILE, JobQueue, parse_aids, run_batch
+from coordinator import get_coordinator
+from ratelimit import get_bucket, parse_rate
+from blobstore import LINK_MODES, HARDLINK, get_blob_store
+from server import DownloadServer, serve
+import metrics
+from httpcache import get_http_cache
+from progress import log
 
 
 class BiliBili:
-    def __init__(self, aid, directory=r'video', danmu=None):
+    def __init__(self, aid, directory=r'video', danmu=None, connections=1, rate=None, shared=False, pages=None,
+                 sharded=False, store=None, link=HARDLINK):
         """
         初始化
         :param aid: 普通视频AV号
         :param directory: 目录名
         :param danmu: 是否下载视频弹幕
+        :param connections: 单个视频分段的并行连接数
+        :param rate: 本视频的下载限速（字节/秒，可带K/M/G单位），None表示不限速
+        :param shared: 下载目录是否与其他进程/主机共用，是则通过目录中的租约数据库分配分P
+        :param pages: 只下载这些分P（从1开始的序号），None表示全部
+        :param sharded: 新建的下载目录是否按cid哈希分层存放
+        :param store: 内容寻址存储的根目录，None表示不使用
+        :param link: 输出文件指向存储对象的方式，见blobstore.LINK_MODES
         :return None
         """
         self.aid = aid
         self.directory = directory
         self.danmu = True if danmu is not None and danmu != 0 else False
+        self.connections = connections if connections and connections > 0 else 1
+        self.rate = parse_rate(rate)
+        self.shared = shared
+        self.pages = pages
+        self.sharded = sharded
+        self.store = store
+        self.link = link
 
-    def download_video(self):
+    def create_video(self):
+        """
+        获取视频信息并按参数设置限速、分P和租约
+        :return: Video
+        """
         video = Video(self.aid)
+        video.bucket.set_rate(self.rate)
+        video.pages = self.pages
+        video.sharded = self.sharded
+        if self.store:
+            video.blob_store = get_blob_store(self.store, self.link)
+        if self.shared:
+            video.coordinator = get_coordinator(self.directory)
+        return video
+
+    def download_video(self, video=None):
+        """
+        下载视频
+        :param video: create_video返回的Video，为None时新建
+        :return: bool 是否所有分P都已完整下载
+        """
+        video = video or self.create_video()
         if self.danmu:
-            video.multi_thread_download_video(self.directory)
-        else:
-            video.async_download_video(self.directory)
+            return video.multi_thread_download_video(self.directory, connections=self.connections)
+        return video.async_download_video(self.directory, connections=self.connections)
+
+
+def batch_download(source, directory=r'video', danmu=None, connections=1, rate=None, workers=4,
+                   queue_file=QUEUE_FILE, max_attempts=3, shared=False, sharded=False, store=None, link=HARDLINK):
+    """
+    批量下载：AV号先写入持久化的任务队列，再由多个工作线程下载，中断后重新运行会继续未完成的任务
+    :param source: 每行一个AV号的文件路径，'-'表示标准输入，None表示只继续队列中已有的任务
+    :param directory: 目录名
+    :param danmu: 是否下载视频弹幕
+    :param connections: 单个视频分段的并行连接数
+    :param rate: 单个视频的下载限速
+    :param workers: 同时下载的视频数
+    :param queue_file: 任务队列文件
+    :param max_attempts: 单个视频的最大尝试次数
+    :param shared: 下载目录是否与其他进程/主机共用
+    :param sharded: 新建的下载目录是否按cid哈希分层存放
+    :param store: 内容寻址存储的根目录
+    :param link: 输出文件指向存储对象的方式
+    :return: dict 各状态的任务数
+    """
+    queue = JobQueue(queue_file)
+    try:
+        if source is not None:
+            if source == '-':
+                aids = parse_aids(sys.stdin)
+            else:
+                with open(source, 'r', encoding='utf-8') as f:
+                    aids = parse_aids(f)
+            log('>>>新增{}个任务，共读取{}个AV号'.format(queue.add(aids, directory), len(aids)))
+
+        counts = run_batch(queue, lambda aid, directory_: BiliBili(aid, directory_, danmu, connections, rate,
+                                                                   shared, sharded=sharded, store=store,
+                                                                   link=link).download_video(),
+                           workers, max_attempts)
+        log('>>>批量下载结束：完成{done}个，失败{failed}个，等待中{pending}个'.format(**counts))
+        return counts
+    finally:
+        queue.close()
+
+
+def serve_download(job, shared=False, sharded=False, store=None, link=HARDLINK):
+    """
+    常驻服务中执行一个任务
+    :param job: server.Job
+    :param shared: 下载目录是否与其他进程/主机共用
+    :param sharded: 新建的下载目录是否按cid哈希分层存放
+    :param store: 内容寻址存储的根目录
+    :param link: 输出文件指向存储对象的方式
+    :return: bool 是否所有分P都已完整下载
+    """
+    b_video = BiliBili(job.aid, job.directory, job.danmu, job.connections, job.rate, shared, job.pages, sharded,
+                       store, link)
+    video = b_video.create_video()
+    job.bucket = video.bucket  # 任务状态中的下载量和速度来自本视频的令牌桶
+    return b_video.download_video(video)
+
+
+def run_server(argv):
+    """
+    Bilibili.py serve [选项]：常驻运行，通过本地HTTP接口接收下载任务
+    连接池、镜像记录、并发控制器和租约协调器在进程内保持预热，任务之间共用
+    :param argv: serve之后的命令行参数
+    :return None
+    """
+    parser = argparse.ArgumentParser(prog='Bilibili.py serve')
+    parser.add_argument('--host', required=False, help='Address to listen on', type=str, default='127.0.0.1')
+    parser.add_argument('--port', required=False, help='Port to listen on', type=int, default=8765)
+    parser.add_argument('--socket', required=False, help='Listen on a Unix socket instead of a TCP port', type=str, default=None)
+    parser.add_argument('-d', '--dir', required=False, help='Default download directory of the jobs', type=str, default='video')
+    parser.add_argument('-n', '--connections', required=False, help='Default number of parallel connections per video segment', type=int, default=1)
+    parser.add_argument('-r', '--rate', required=False, help='Global download rate limit in bytes per second, e.g. 500K, 10M', type=str, default=None)
+    parser.add_argument('-w', '--workers', required=False, help='Number of jobs downloaded at the same time', type=int, default=4)
+    parser.add_argument('--shared', required=False, help='The download directory is shared with other processes or hosts, coordinate pages with leases', action='store_true')
+    parser.add_argument('--sharded', required=False, help='Store new download directories in subdirectories by cid hash', action='store_true')
+    parser.add_argument('--store', required=False, help='Content-addressed store shared by downloads; identical pages are linked instead of downloaded again', type=str, default=None)
+    parser.add_argument('--link', required=False, help='How outputs point into the store', choices=LINK_MODES, default=HARDLINK)
+    parser.add_argument('--metrics-file', required=False, help='Write Prometheus metrics to this file at exit (also served on GET /metrics)', type=str, default=None)
+    args = parser.parse_args(argv)
+    get_bucket().set_rate(parse_rate(args.rate))
+    if args.metrics_file:
+        metrics.dump_at_exit(args.metrics_file)
+    downloader = DownloadServer(lambda job: serve_download(job, args.shared, args.sharded, args.store, args.link),
+                                args.workers, args.dir, args.connections)
+    serve(downloader, args.host, args.port, args.socket)
 
 
 if __name__ == '__main__':
@@ -35,6 +162,9 @@ if __name__ == '__main__':
     """
     if len(sys.argv) == 1:
         sys.argv.append('--help')
+    if sys.argv[1] == 'serve':
+        run_server(sys.argv[2:])
+        sys.exit()
 
     """
     该argparse模块可以轻松编写用户友好的命令行界面。
@@ -80,9 +210,24 @@ if __name__ == '__main__':
     metavar - 用法消息中参数的名称。
     dest - 要添加到返回的对象的属性的名称 parse_args()。
     """
-    parser.add_argument('-i', '--input', required=True, help='The AV number of the video for downloading', type=str)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-i', '--input', help='The AV number of the video for downloading', type=str)
+    target.add_argument('-b', '--batch', help='File with one AV number per line ("-" for stdin), queued for batch download', type=str)
+    target.add_argument('--resume', help='Continue the pending jobs in the batch queue', action='store_true')
     parser.add_argument('-d', '--dir', required=False, help='Save download file to a directory path', type=str, default='video')
     parser.add_argument('-D', '--Danmu', required=False, help='Whether to download the danmu of the video,if Yes,input non_zero number', type=int, default=0)
+    parser.add_argument('-n', '--connections', required=False, help='Number of parallel connections per video segment', type=int, default=1)
+    parser.add_argument('-r', '--rate', required=False, help='Global download rate limit in bytes per second, e.g. 500K, 10M', type=str, default=None)
+    parser.add_argument('-w', '--workers', required=False, help='Number of videos downloaded at the same time in batch mode', type=int, default=4)
+    parser.add_argument('-q', '--queue', required=False, help='SQLite file of the batch job queue', type=str, default=QUEUE_FILE)
+    parser.add_argument('--retries', required=False, help='Max attempts per video in batch mode', type=int, default=3)
+    parser.add_argument('--shared', required=False, help='The download directory is shared with other processes or hosts, coordinate pages with leases', action='store_true')
+    parser.add_argument('--sharded', required=False, help='Store new download directories in subdirectories by cid hash', action='store_true')
+    parser.add_argument('--store', required=False, help='Content-addressed store shared by downloads; identical pages are linked instead of downloaded again', type=str, default=None)
+    parser.add_argument('--link', required=False, help='How outputs point into the store', choices=LINK_MODES, default=HARDLINK)
+    parser.add_argument('--metrics-port', required=False, help='Serve Prometheus metrics on this local port', type=int, default=None)
+    parser.add_argument('--metrics-file', required=False, help='Write Prometheus metrics to this file at exit', type=str, default=None)
+    parser.add_argument('--no-cache', required=False, help='Always query the API instead of using cached responses', action='store_true')
 
     """
     ArgumentParser.parse_args(args=None, namespace=None)
@@ -93,5 +238,19 @@ if __name__ == '__main__':
     namespace - 获取属性的对象。默认值是一个新的空 Namespace对象。
     """
     args = parser.parse_args()
-    b_video = BiliBili(args.input, args.dir, args.Danmu)
-    b_video.download_video()
+    get_bucket().set_rate(parse_rate(args.rate))  # 全局限速，所有下载共用
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    if args.metrics_file:
+        metrics.dump_at_exit(args.metrics_file)
+    if args.no_cache:
+        get_http_cache().enabled = False
+    if args.input:
+        b_video = BiliBili(args.input, args.dir, args.Danmu, args.connections, shared=args.shared, sharded=args.sharded,
+                           store=args.store, link=args.link)
+        if not b_video.download_video():
+            sys.exit(1)  # 有分P未完整下载
+    else:
+        batch_download(args.batch, args.dir, args.Danmu, args.connections, workers=args.workers,
+                       queue_file=args.queue, max_attempts=args.retries, shared=args.shared, sharded=args.sharded,
+                       store=args.store, link=args.link)
@@ -2,23 +2,36 @@
 # -*-coding:utf-8 -*-
 # 参考https://github.com/Vespa314/bilibili-api/blob/master/api.md
 import os
-import sys
 import aiohttp
-import aiofiles
 import asyncio
 import chardet  # 检测编码格式
 import requests
 import threading
-import subprocess
 import xml.dom.minidom
+from concurrent.futures import ThreadPoolExecutor
 from util import *
-from tqdm import tqdm
 from contextlib import closing
-from multiprocessing import cpu_count
 from danmuku2ass import Danmaku2ASS, ConvertColor
+from writer import FileWriter, RangeBuffer
+from downloader import RangeDownloader, AsyncRangeDownloader, ConcatDownloader, AsyncConcatDownloader, PART_SUFFIX, \
+    is_completed, write_async
+from flv import is_flv_url
+from dash import OUTPUT_SUFFIX as DASH_OUTPUT_SUFFIX, select_streams, track_files
+from quality import get_quality_cache
+from catalog import get_download_index
+from blobstore import page_key
+from pool import get_pool, get_worker_loop
+from concurrency import get_controller
+from ratelimit import TokenBucket, get_bucket, throttle
+from merge import MergePipeline
+from integrity import VERIFY_ATTEMPTS, IntegrityError, StreamVerifier, write_manifest, rename_verified
+from progress import get_progress, log
+from metrics import DOWNLOAD_BYTES, SEGMENT_SECONDS, RETRIES, DANMAKU_SECONDS, host_of
+from retry import StallError, DownloadError, SpeedWatchdog, sleep_backoff, sleep_backoff_async
 
 
 signApiUrl = "https://interface.bilibili.com/v2/playurl?"
+MAX_QUALITY = 127  # playurl首先请求的清晰度，接口会返回不超过它的最高可用清晰度
 apiUrl = 'https://api.bilibili.com/x/'  # API地址
 webApiPrefix = apiUrl + 'web-interface/'  # web API前缀
 playerApiPrefix = apiUrl + 'player/'  # player API前缀
@@ -275,12 +288,21 @@ class Search:
         }
     }
         """
-        key = get_keyword(keyword)
-        url = allSearchUrl.format(key, page)
-        json_info = get_json_info(url)
+        json_info = get_json_info(allSearchUrl.format(get_keyword(keyword), page))
         data = json_info.get_value('data')
         return data
 
+    @staticmethod
+    async def search_all_async(keyword, page=1):
+        """
+        search_all的协程版本，在调用者的事件循环中请求
+        :param keyword: 关键词
+        :param page: 页码
+        :return: 同search_all
+        """
+        json_info = await get_json_info_async(allSearchUrl.format(get_keyword(keyword), page))
+        return json_info.get_value('data')
+
     @staticmethod
     @exec_time
     def search_type(keyword, page=1, search_type='video', highlight=1, **kwargs):
@@ -443,15 +465,33 @@ class Search:
 
         注意：搜索的数据每页固定20条数据，最多只有1000条，也就是50页
         """
-        key = get_keyword(keyword)
-        url = typeSearchUrl.format(key, page, search_type, highlight)
-        string = get_search_string(kwargs)
-        if string:
-            url += '&' + string
-        json_info = get_json_info(url)
+        json_info = get_json_info(Search._type_search_url(keyword, page, search_type, highlight, kwargs))
         data = json_info.get_value('data')
         return data
 
+    @staticmethod
+    async def search_type_async(keyword, page=1, search_type='video', highlight=1, **kwargs):
+        """
+        search_type的协程版本，在调用者的事件循环中请求
+        :param keyword: 关键词
+        :param page: 页码
+        :param search_type: 搜索类型
+        :param highlight: 是否高亮
+        :param kwargs 可选参数，见search_type
+        :return: 同search_type
+        """
+        url = Search._type_search_url(keyword, page, search_type, highlight, kwargs)
+        json_info = await get_json_info_async(url)
+        return json_info.get_value('data')
+
+    @staticmethod
+    def _type_search_url(keyword, page, search_type, highlight, params):
+        url = typeSearchUrl.format(get_keyword(keyword), page, search_type, highlight)
+        string = get_search_string(params)
+        if string:
+            url += '&' + string
+        return url
+
 
 class User:
     userSpaceInfoUrl = spaceApiPrefix + 'acc/info?mid={}'  # 指定mid(用户id)空间信息，根据空间主人设置得到相应信息
@@ -484,7 +524,11 @@ class User:
     userUnreadMsgUrl = 'https://api.vc.bilibili.com/web_im/v1/web_im/unread_msgs'  # 未读消息的相关信息，需要登录
     userNotifyCountUrl = 'https://message.bilibili.com/api/notify/query.notify.count.do'  # 消息中各个类型信息的个数，需要登录
 
-    def __init__(self, mid):
+    def __init__(self, mid, load=True):
+        """
+        :param mid: 用户ID
+        :param load: 是否立即同步获取空间信息，协程中请使用await User.load(mid)
+        """
         self.mid = mid
         self.name = ''  # 用户名
         self.official = False  # 是否是认证账号
@@ -518,12 +562,24 @@ class User:
         # self.rank = None
         # self.spaceName = None
 
-        self.get_user_space_info()
+        if load:
+            self.get_user_space_info()
 
         # self.get_user_fans_list()
 
         # self.get_user_follow_list()
 
+    @classmethod
+    async def load(cls, mid):
+        """
+        在调用者的事件循环中创建用户并获取空间信息
+        :param mid: 用户ID
+        :return: User
+        """
+        user = cls(mid, load=False)
+        await user.get_user_space_info_async()
+        return user
+
     def __getattr__(self, name):  # 定义当用户试图获取一个不存在的属性时的行为
         return None
 
@@ -592,6 +648,14 @@ class User:
             self.fans_count = data['total']
             self.fans_list = self.fans_list + data['list']
 
+    async def get_user_fans_list_async(self):
+        """
+        get_user_fans_list的协程版本，5页同时请求
+        :return: None
+        """
+        self.fans_count, fans_list = await self._get_relation_pages(self.userFansListInfoUrl)
+        self.fans_list = self.fans_list + fans_list
+
     def get_user_follow_list(self):
         """
         获取用户关注列表
@@ -638,6 +702,28 @@ class User:
             self.follow_count = data['total']
             self.follow_list = self.follow_list + data['list']
 
+    async def get_user_follow_list_async(self):
+        """
+        get_user_follow_list的协程版本，5页同时请求
+        :return: None
+        """
+        self.follow_count, follow_list = await self._get_relation_pages(self.userFollowListInfoUrl)
+        self.follow_list = self.follow_list + follow_list
+
+    async def _get_relation_pages(self, url_format):
+        """
+        同时请求粉丝或关注列表的前5页
+        :param url_format: userFansListInfoUrl或userFollowListInfoUrl
+        :return: (总数, 按页码顺序合并的列表)
+        """
+        json_infos = await asyncio.gather(*[get_json_info_async(url_format.format(self.mid, i)) for i in range(1, 6)])
+        total, items = 0, []
+        for json_info in json_infos:
+            data = json_info.get_value('data')
+            total = data['total']
+            items = items + data['list']
+        return total, items
+
     def get_user_space_info(self):
         """
         用户空间信息
@@ -679,7 +765,21 @@ class User:
         """
         url = self.userSpaceInfoUrl.format(self.mid)
         json_info = get_json_info(url)
-        data = json_info.get_value('data')
+        self._set_space_info(json_info.get_value('data'))
+
+    async def get_user_space_info_async(self):
+        """
+        get_user_space_info的协程版本
+        :return None
+        """
+        json_info = await get_json_info_async(self.userSpaceInfoUrl.format(self.mid))
+        self._set_space_info(json_info.get_value('data'))
+
+    def _set_space_info(self, data):
+        """
+        :param data: 接口返回的空间信息
+        :return None
+        """
         self.name = data['name']
         self.official = int(data['official']['role']) != 0
         self.official_title = data['official']['title']
@@ -697,6 +797,20 @@ class User:
         self.vip_type = self.get_vip_type(data['vip']['type'])
 
 
+def _stat_property(name, doc):
+    """
+    视频状态信息的属性，首次访问时才加载
+    :param name: 属性名，见Video.STAT_FIELDS
+    :param doc: 说明
+    :return: property
+    """
+    def getter(self):
+        self._load('stat')
+        return self._stat[name]
+
+    return property(getter, doc=doc)
+
+
 class Video:
     videoInfoUrl = webApiPrefix + 'view?aid={}'  # 视频信息API，需要aid
     videoStatInfoUrl = webApiPrefix + 'archive/stat?aid={}'  # 视频状态信息API，需要aid
@@ -704,30 +818,39 @@ class Video:
     videoTagsInfoUrl = 'https://api.bilibili.com/x/tag/archive/tags?aid={}'  # 视频标签信息，需要aid
     videoDanmukuUrl = 'http://comment.bilibili.cn/{}.xml'  # 视频弹幕库，需要cid
     videoDanmukuUrl1 = 'https://api.bilibili.com/x/v1/dm/list.so?oid={}'  # 视频弹幕库，需要cid
-
-    def __init__(self, aid):
+    STAT_FIELDS = {'coin': 'coin', 'dan_mu_count': 'danmaku', 'favorite': 'favorite', 'like': 'like',
+                   'reply': 'reply', 'share': 'share', 'view': 'view'}  # 状态信息的属性名: 接口字段名
+
+    coin = _stat_property('coin', '投硬币数')
+    dan_mu_count = _stat_property('dan_mu_count', '历史累计弹幕数')
+    favorite = _stat_property('favorite', '收藏人数')
+    like = _stat_property('like', '点赞数')
+    reply = _stat_property('reply', '评论数')
+    share = _stat_property('share', '分享数')
+    view = _stat_property('view', '访问观看数')
+
+    def __init__(self, aid, load=True):
+        """
+        :param aid: AV号
+        :param load: 是否立即同步获取视频信息，协程中请使用await Video.load(aid)
+        """
         self.aid = aid  # AV号
         self.arcurl = 'https://www.bilibili.com/video/av{}'.format(aid)
-        self.coin = 0  # 投硬币数
         self.copyright = 1  # 转载是否需要授权，默认1表示需要
         self.cover = ''  # 视频封面图地址
-        self.dan_mu_count = 0  # 历史累计弹幕数
         self.description = ''  # 视频简介
         self.download_url_dict = {}  # 视频下载地址
+        self.mirror_url_dict = {}  # 视频每个分段的所有镜像地址，[[url, backup_url...], ...]
+        self.dash_url_dict = {}  # DASH分P的视频轨和音频轨镜像地址，{cid: {'video': [...], 'audio': [...]}}
+        self.quality_dict = {}  # 各分P下载的清晰度，{cid: qn}
         self.duration = 0  # 所有视频总时长（秒）
-        self.favorite = 0  # 收藏人数
-        self.like = 0  # 点赞数
         self.owner = {}  # 视频UP简略信息，包括mid（用户ID），name（用户昵称），face（用户头像地址）
         self.page_count = 1  # 视频选集数
-        self.page_list = []  # 视频选集
-        self.reply = 0  # 评论数
-        self.share = 0  # 分享数
         self.cid = 0  # 视频源及弹幕编号
         self.tid = 0  # 视频标签ID
         self.tag = ''  # 视频标签名
         self.title = ''  # 视频标题
         self.upload_time = 0  # 视频上传时间，unix时间戳
-        self.view = 0  # 访问观看数
 
         # # 未赋值和使用
         # self.credit = None  # 评分数量
@@ -744,21 +867,87 @@ class Video:
         # self.play_forward = None  # 外链播放？
         # self.play_mobile = None  # app播放
 
-        self.sess = requests.Session()
+        self.sess = get_pool().session  # 所有Video共享同一个连接池
+        self.bucket = TokenBucket()  # 本视频的下载限速，默认不限速，可通过self.bucket.set_rate()随时修改
+        self.coordinator = None  # 多个进程/主机共用下载目录时的租约协调器（coordinator.LeaseCoordinator）
+        self.blob_store = None  # 内容寻址存储（blobstore.BlobStore），None表示不使用
+        self.pages = None  # 只下载这些分P（从1开始的序号），None表示全部
+        self.sharded = False  # 新建下载目录时是否按cid哈希分层存放，已有目录沿用索引中记录的布局
+        self._stat = None  # 状态信息（投硬币数、弹幕数等），{属性名: 值}，view接口没有返回时首次访问才请求
+        self._page_list = None  # 视频选集，view接口没有返回时首次访问page_list才请求
+        self._meta_lock = threading.Lock()
+
+        if load:
+            self._get_video_info()
+
+    @classmethod
+    async def load(cls, aid):
+        """
+        在调用者的事件循环中创建视频并获取视频信息
+        状态信息和选集view接口一般已返回，缺少时可await load_details()获取，避免之后访问属性时发出同步请求
+        :param aid: AV号
+        :return: Video
+        """
+        video = cls(aid, load=False)
+        json_info = await get_json_info_async(video.videoInfoUrl.format(aid))
+        video._set_video_info(json_info.get_value('data'))
+        return video
 
-        self._get_video_info()
+    async def load_details(self):
+        """
+        协程中获取尚未加载的状态信息和选集，两者同时请求
+        :return None
+        """
+        loaders = {'stat': self._get_video_stat_info_async, 'page_list': self._get_video_page_list_info_async}
+        await asyncio.gather(*[loader() for part, loader in loaders.items() if getattr(self, '_' + part) is None])
 
     def __getattr__(self, name):  # 定义当用户试图获取一个不存在的属性时的行为
         return None
 
     def __str__(self):  # 定义当被str()调用或者打印对象时的行为
-        return str(self.__dict__)  # 返回当前范围（类或实例）的所有属性名称列表
+        return str(self._fields())  # 返回所有公开的属性
 
     def keys(self):
-        return self.__dict__.keys()
+        return self._fields().keys()
 
     def values(self):
-        return self.__dict__.values()
+        return self._fields().values()
+
+    @property
+    def page_list(self):
+        """
+        视频选集
+        :return: list [VideoPage, ...]
+        """
+        self._load('page_list')
+        return self._page_list
+
+    def _fields(self):
+        """
+        所有公开的属性，状态信息和选集尚未加载时先（并发）获取
+        :return: dict
+        """
+        self._load('stat', 'page_list')
+        fields = {name: value for name, value in self.__dict__.items() if not name.startswith('_')}
+        fields.update((name, self._stat[name]) for name in self.STAT_FIELDS)
+        fields['page_list'] = self._page_list
+        return fields
+
+    def _load(self, *parts):
+        """
+        获取尚未加载的状态信息或选集，两者都缺失时同时请求
+        :param parts: 'stat'或'page_list'
+        :return None
+        """
+        loaders = {'stat': self._get_video_stat_info, 'page_list': self._get_video_page_list_info}
+        with self._meta_lock:
+            missing = [loaders[part] for part in parts if getattr(self, '_' + part) is None]
+            if len(missing) == 1:
+                missing[0]()
+            elif missing:
+                with ThreadPoolExecutor(len(missing)) as executor:
+                    for future in [executor.submit(loader) for loader in missing]:
+                        future.result()  # 重新抛出请求中的异常
 
     def _get_video_info(self):
         """
@@ -845,7 +1034,13 @@ class Video:
         """
         url = self.videoInfoUrl.format(self.aid)
         json_info = get_json_info(url)
-        data = json_info.get_value('data')
+        self._set_video_info(json_info.get_value('data'))
+
+    def _set_video_info(self, data):
+        """
+        :param data: view接口返回的视频信息
+        :return None
+        """
         self.page_count = data['videos']
         self.cid = data['cid']
         self.tid = data['tid']
@@ -858,9 +1053,32 @@ class Video:
         self.duration = data['duration']
         self.owner = data['owner']
 
-        self._get_video_stat_info()
+        # view接口一般已包含状态信息和选集，不再单独请求；缺少时在首次访问对应属性时请求
+        if data.get('stat'):
+            self._set_stat(data['stat'])
+        if data.get('pages'):
+            self._set_page_list(data['pages'])
+
+    def _set_stat(self, data):
+        """
+        :param data: 接口返回的状态信息
+        :return None
+        """
+        self._stat = {name: data.get(key, 0) for name, key in self.STAT_FIELDS.items()}
 
-        self._get_video_page_list_info()
+    def _set_page_list(self, data):
+        """
+        :param data: 接口返回的选集列表
+        :return None
+        """
+        page_list = []
+        for x in data:
+            dimension = x.get('dimension') or {}
+            page_list.append(VideoPage(x['cid'], page=x['page'], origin=x.get('from', 'vupload'),
+                                       part=x.get('part', ''), duration=x.get('duration', 0),
+                                       width=dimension.get('width', 0), height=dimension.get('height', 0),
+                                       rotate=dimension.get('rotate', 0)))
+        self._page_list = page_list
 
     def _get_video_stat_info(self):
         """
@@ -889,14 +1107,14 @@ class Video:
         url = self.videoStatInfoUrl.format(self.aid)
         json_info = get_json_info(url)
         data = json_info.get_value('data')
-        self.coin = data['coin']
         self.copyright = data['copyright']
-        self.dan_mu_count = data['danmaku']
-        self.favorite = data['favorite']
-        self.like = data['like']
-        self.reply = data['reply']
-        self.share = data['share']
-        self.view = data['view']
+        self._set_stat(data)
+
+    async def _get_video_stat_info_async(self):
+        json_info = await get_json_info_async(self.videoStatInfoUrl.format(self.aid))
+        data = json_info.get_value('data')
+        self.copyright = data['copyright']
+        self._set_stat(data)
 
     def _get_video_page_list_info(self):
         """
@@ -927,11 +1145,11 @@ class Video:
         url = self.videoPageListInfoUrl.format(self.aid)
         json_info = get_json_info(url)
         data = json_info.get_value('data')
-        for x in data:
-            temp = VideoPage(x['cid'], page=x['page'], origin=x['from'], part=x['part'], duration=x['duration'],
-                             width=x['dimension']['width'], height=x['dimension']['height'],
-                             rotate=x['dimension']['rotate'])
-            self.page_list.append(temp)
+        self._set_page_list(data)
+
+    async def _get_video_page_list_info_async(self):
+        json_info = await get_json_info_async(self.videoPageListInfoUrl.format(self.aid))
+        self._set_page_list(json_info.get_value('data'))
 
     @staticmethod
     def _check_dir(directory):
@@ -1039,6 +1257,12 @@ class Video:
         json_info = get_json_info(url)
         return json_info.get_value('accept_quality')
 
+    @staticmethod
+    async def _get_video_quality_info_async(cid):
+        params = {'cid': cid, 'otype': 'json', 'qn': 15, 'quality': 15, 'type': ''}
+        json_info = await get_json_info_async(signApiUrl + get_sign(params))
+        return json_info.get_value('accept_quality')
+
     def _get_video_download_url(self):
         """
         {
@@ -1087,14 +1311,18 @@ class Video:
                 return None
 
             json_info = json.loads(infos)
+            if self._set_dash_streams(p.cid, json_info['data'].get('dash')):
+                continue
             durl = json_info['data']['durl']
             for i in range(len(durl)):
                 url = durl[i]['url']
 
                 if str(p.cid) not in self.download_url_dict:
                     self.download_url_dict[str(p.cid)] = []
+                    self.mirror_url_dict[str(p.cid)] = []
 
                 self.download_url_dict[str(p.cid)].append(url)
+                self.mirror_url_dict[str(p.cid)].append([url] + (durl[i].get('backup_url') or []))
 
     def _get_video_download_url_v2(self):
         """
@@ -1133,36 +1361,359 @@ class Video:
             ]
         }
         """
+        cache = get_quality_cache()
         for p in self.page_list:
-            quality = self._get_video_quality_info(p.cid)
-            params = {'cid': p.cid, 'otype': 'json', 'qn': quality[0], 'quality': quality[0], 'type': ''}
-            url = signApiUrl + get_sign(params)
-            json_info = get_json_info(url)
-            durl = json_info.get_value('durl')
-            for i in range(len(durl)):
-                url = durl[i]['url']
+            # 直接请求最高清晰度，接口返回能下载的最高清晰度和accept_quality，不再单独探测
+            quality = MAX_QUALITY
+            json_info = self._get_play_info(p.cid, quality)
+            if json_info.get_value('dash') is None and json_info.get_value('durl') is None:
+                # 不接受超出范围的清晰度时改用可用清晰度中最高的一个，缓存里没有记录才探测
+                accept = self._known_quality(p.cid, json_info) or self._get_video_quality_info(p.cid)
+                cache.set(p.cid, accept)
+                quality = max(accept)
+                json_info = self._get_play_info(p.cid, quality)
+            self._set_play_info(p.cid, json_info, quality)
+
+    async def _get_video_download_url_async(self):
+        """
+        _get_video_download_url_v2的协程版本，各分P的下载地址同时请求
+        :return None
+        """
+        async def resolve(cid):
+            quality = MAX_QUALITY
+            json_info = await get_json_info_async(self._play_info_url(cid, quality))
+            if json_info.get_value('dash') is None and json_info.get_value('durl') is None:
+                accept = self._known_quality(cid, json_info) or await self._get_video_quality_info_async(cid)
+                get_quality_cache().set(cid, accept)
+                quality = max(accept)
+                json_info = await get_json_info_async(self._play_info_url(cid, quality))
+            self._set_play_info(cid, json_info, quality)
+
+        await asyncio.gather(*[resolve(p.cid) for p in self.page_list])
+
+    def _set_play_info(self, cid, json_info, quality):
+        """
+        记录playurl的结果：可用清晰度写入缓存，DASH分P记录轨道，其余记录各分段的镜像地址
+        :param cid: 分P的cid
+        :param json_info: playurl的JsonInfo
+        :param quality: 请求的清晰度
+        :return None
+        """
+        get_quality_cache().set(cid, json_info.get_value('accept_quality'))
+        self.quality_dict[str(cid)] = json_info.get_value('quality') or quality
+        if self._set_dash_streams(cid, json_info.get_value('dash'), quality):
+            return
+        durl = json_info.get_value('durl')
+        for i in range(len(durl)):
+            url = durl[i]['url']
 
-                if str(p.cid) not in self.download_url_dict:
-                    self.download_url_dict[str(p.cid)] = []
+            if str(cid) not in self.download_url_dict:
+                self.download_url_dict[str(cid)] = []
+                self.mirror_url_dict[str(cid)] = []
 
-                self.download_url_dict[str(p.cid)].append(url)
+            self.download_url_dict[str(cid)].append(url)
+            self.mirror_url_dict[str(cid)].append([url] + (durl[i].get('backup_url') or []))
 
-    def video_downloader(self, directory, download_url, file_name):
+    @staticmethod
+    def _play_info_url(cid, quality):
         """
-        视频下载器
-        :param directory: 视频保存路径
-        :param download_url: 视频下载地址
-        :param file_name: 保存的视频名称
-        :return None
+        分P下载地址的请求地址
+        fnval=16请求DASH格式，高清晰度只以DASH提供；不支持时接口仍返回durl
+        :param cid: 分P的cid
+        :param quality: 清晰度
+        :return: string
+        """
+        params = {'cid': cid, 'fnval': 16, 'fourk': 1, 'otype': 'json', 'qn': quality, 'quality': quality, 'type': ''}
+        return signApiUrl + get_sign(params)
+
+    @staticmethod
+    def _known_quality(cid, json_info):
+        """
+        最高清晰度被拒绝时不必探测就能知道的可用清晰度：拒绝的响应中带有accept_quality，或者缓存中有记录
+        :param cid: 分P的cid
+        :param json_info: 被拒绝的playurl的JsonInfo
+        :return: list 可用清晰度，都没有时返回None
+        """
+        return json_info.get_value('accept_quality') or get_quality_cache().get(cid)
+
+    @staticmethod
+    def _get_play_info(cid, quality):
+        """
+        请求分P的下载地址
+        :param cid: 分P的cid
+        :param quality: 清晰度
+        :return: JsonInfo
+        """
+        return get_json_info(Video._play_info_url(cid, quality))
+
+    def _set_dash_streams(self, cid, dash, quality=None):
+        """
+        记录DASH分P要下载的视频轨和音频轨
+        :param cid: 分P的cid
+        :param dash: playurl返回的dash块，没有时为None
+        :param quality: 期望的清晰度
+        :return: bool 是否为DASH分P
+        """
+        streams = select_streams(dash, quality) if dash else None
+        if streams is None:
+            return False
+        self.dash_url_dict[str(cid)] = streams
+        return True
+
+    def _page_file_name(self, title, cid):
+        """
+        分P的输出文件名，DASH分P封装为MP4，其余为FLV
+        :param title: 处理后的标题
+        :param cid: 分P的cid
+        :return: string
         """
-        size = 0
-        download_headers = {
+        return title + (DASH_OUTPUT_SUFFIX if str(cid) in self.dash_url_dict else '.flv')
+
+    def _page_title(self, i):
+        """
+        分P的标题，多P视频加上选集名称，并过滤文件名中的非法字符
+        :param i: 分P下标
+        :return: string
+        """
+        # 针对多p视频的标题处理
+        if len(self.page_list) == 1:
+            title = self.title
+        else:
+            title = self.title + '_' + self.page_list[i].part
+
+        for c in u'´☆❤◦\\/:*?"<>|':  # 过滤文件非法字符
+            title = title.replace(c, '')
+
+        return title.replace(' ', '_')  # 转换空格，避免ffmpeg无法识别
+
+    def _page_output(self, directory, i):
+        """
+        分P的输出文件路径
+        :param directory: 下载目录
+        :param i: 分P下标
+        :return: string
+        """
+        cid = str(self.page_list[i].cid)
+        return os.path.join(self._page_directory(directory, cid), self._page_file_name(self._page_title(i), cid))
+
+    def _check_pages(self, directory, indexes):
+        """
+        所有下载和合并结束后检查各分P的输出文件，校验失败、DASH轨道缺失、区间多次下载失败、合并失败的分P都没有输出文件
+        :param directory: 下载目录
+        :param indexes: 分P下标
+        :return: bool 是否全部完成
+        """
+        incomplete = [self._page_title(i) for i in indexes if not os.path.exists(self._page_output(directory, i))]
+        if incomplete:
+            log('>>>{}个分P未完整下载，重新运行即可从断点继续：{}'.format(len(incomplete), '、'.join(incomplete)))
+            return False
+        log('>>>视频全部下载完成！')
+        return True
+
+    def _get_download_headers(self):
+        """
+        下载视频时使用的请求头
+        :return: dict
+        """
+        return {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.167 Safari/537.36',
             'Accept': '*/*',
             'Accept-Encoding': 'gzip, deflate, br',
             'Accept-Language': 'zh-CN,zh;q=0.9',
             'Referer': self.arcurl
         }
+
+    def _page_indexes(self):
+        """
+        需要下载的分P下标
+        :return: list
+        """
+        return [i for i in range(len(self.page_list)) if not self.pages or i + 1 in self.pages]
+
+    def _schedule_pages(self, directory, indexes):
+        """
+        按租约调度分P：其他进程正在下载的分P推迟到最后，持有者挂掉后接手，已被其他进程完成的分P跳过
+        已完成的租约只有在输出文件确实不存在时才重新发放
+        :param directory: 下载目录
+        :param indexes: 分P下标
+        :return: 可迭代的分P下标
+        """
+        if self.coordinator is None:
+            return indexes
+        return self.coordinator.schedule([(self.aid, self.page_list[i].cid, i) for i in indexes],
+                                         reopen=lambda i: not os.path.exists(self._page_output(directory, i)))
+
+    def _wait_page(self, cid, file_name):
+        """
+        等待分P的租约，已完成的租约只有在输出文件确实不存在时才重新发放
+        :param cid: 分P的cid
+        :param file_name: 分P的输出文件
+        :return: bool 取得租约时返回True，已被其他进程完成时返回False
+        """
+        return self.coordinator is None or self.coordinator.wait(self.aid, cid,
+                                                                 reopen=lambda: not os.path.exists(file_name))
+
+    async def _async_wait_page(self, cid, file_name):
+        """
+        _wait_page的协程版本
+        :return: bool
+        """
+        return self.coordinator is None or await self.coordinator.wait_async(
+            self.aid, cid, reopen=lambda: not os.path.exists(file_name))
+
+    def _page_directory(self, directory, cid):
+        """
+        分P的文件所在目录，按哈希分层时为下载目录下的子目录
+        :param directory: 下载目录
+        :param cid: 分P的cid
+        :return: string
+        """
+        return get_download_index(directory, self.sharded).page_directory(cid)
+
+    def _is_downloaded(self, directory, cid, file_name):
+        """
+        按下载索引判断分P是否已完成，只检查索引记录和一个文件，不列出目录
+        :param directory: 下载目录
+        :param cid: 分P的cid
+        :param file_name: 分P的输出文件
+        :return: bool
+        """
+        return get_download_index(directory, self.sharded).lookup(self.aid, cid, file_name) is not None
+
+    def _link_from_store(self, directory, cid, file_name):
+        """
+        下载之前检查内容存储，已有同一cid和清晰度的内容时直接链接到输出文件并写入下载索引
+        :param directory: 下载目录
+        :param cid: 分P的cid
+        :param file_name: 分P的输出文件
+        :return: bool 是否已从存储得到
+        """
+        quality = self.quality_dict.get(cid)
+        if self.blob_store is None or quality is None:
+            return False
+        digest = self.blob_store.link(page_key(cid, quality), file_name)
+        if digest is None:
+            return False
+        get_download_index(directory, self.sharded).record(self.aid, cid, file_name, quality, digest)
+        return True
+
+    def _finish_page(self, directory, cid, file_name):
+        """
+        输出文件存在时写入下载索引（计算摘要）并加入内容存储，然后释放分P的租约，未完成时其他进程可以立即接手
+        :param directory: 下载目录
+        :param cid: 分P的cid
+        :param file_name: 分P的输出文件
+        :return None
+        """
+        done = os.path.exists(file_name)
+        if done:
+            entry = get_download_index(directory, self.sharded).record(self.aid, cid, file_name,
+                                                                        self.quality_dict.get(cid))
+            if self.blob_store is not None and entry is not None and entry['hash']:
+                key = page_key(cid, entry['quality'])
+                found = self.blob_store.find(key)
+                if found is None or found[0] != entry['hash']:  # 从存储链接出来的分P不必再加入
+                    self.blob_store.ingest(file_name, entry['hash'], [key])
+        if self.coordinator is not None:
+            self.coordinator.release(self.aid, cid, done)
+
+    def _release_page(self, directory, cid, file_name, merging=None):
+        """
+        分P结束（或跳过）时调用，见_finish_page
+        :param directory: 下载目录
+        :param cid: 分P的cid
+        :param file_name: 分P的输出文件
+        :param merging: 后台合并任务的Future，合并结束后才记录和释放
+        :return None
+        """
+        if merging is not None:
+            merging.add_done_callback(lambda future: self._finish_page(directory, cid, file_name))
+        else:
+            self._finish_page(directory, cid, file_name)
+
+    async def _async_release_page(self, directory, cid, file_name):
+        """
+        _release_page的协程版本，摘要在线程池中计算，不阻塞事件循环
+        :return None
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self._finish_page, directory, cid, file_name)
+
+    def concat_video_downloader(self, directory, segments, file_name, connections=1):
+        """
+        多段FLV视频下载器，各分段直接拼接写入同一个文件并修正时间戳
+        :param directory: 视频保存路径
+        :param segments: 每个分段的镜像地址列表
+        :param file_name: 保存的视频名称
+        :param connections: 每个分段的并行连接数
+        :return: bool 是否完整下载，服务器不支持Range或时间戳无法直接拼接时返回None
+        """
+        with get_progress().task(file_name) as progress:
+            downloader = ConcatDownloader(self.sess, segments, os.path.join(directory, file_name),
+                                          self._get_download_headers(), connections, self.bucket, progress)
+            result = downloader.download()
+        if result:
+            log('视频[{}]下载完成!'.format(file_name))
+        return result
+
+    def dash_video_downloader(self, directory, streams, title, connections=1):
+        """
+        DASH视频下载器，视频轨和音频轨在两个线程中同时下载，每条轨道再按字节区间多连接下载
+        :param directory: 视频保存路径
+        :param streams: 视频轨和音频轨的镜像地址，见dash.select_streams
+        :param title: 视频标题，轨道保存为title.video.m4s和title.audio.m4s
+        :param connections: 每条轨道的并行连接数
+        :return: list 轨道文件名，视频轨在前，未完整下载时返回None
+        """
+        tracks = track_files(title, streams)
+
+        def run(mirrors, name):
+            try:
+                self.video_downloader(directory, mirrors, name, connections)
+            except DownloadError as e:  # 轨道文件不存在，下面返回None
+                log(e)
+
+        threads = [threading.Thread(target=run, args=(mirrors, name)) for name, mirrors in tracks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        names = [name for name, _ in tracks]
+        if not all(os.path.exists(os.path.join(directory, name)) for name in names):
+            return None
+        return names
+
+    def video_downloader(self, directory, download_url, file_name, connections=1):
+        """
+        视频下载器
+        :param directory: 视频保存路径
+        :param download_url: 视频下载地址，或同一分段的多个镜像地址列表
+        :param file_name: 保存的视频名称
+        :param connections: 单个分段的并行连接数，服务器支持Range时按字节区间下载并可断点续传
+        :return None
+        """
+        video_name = os.path.join(directory, file_name)
+        if is_completed(video_name):  # 之前的运行中已下载完成
+            log('视频[{}]已存在，跳过下载'.format(file_name))
+            return
+
+        with get_progress().task(file_name) as progress:  # 各连接只累加计数，由进度输出器统一显示
+            self._video_downloader(download_url, video_name, file_name, connections, progress)
+
+    def _video_downloader(self, download_url, video_name, file_name, connections, progress):
+        """
+        video_downloader的下载部分
+        :param progress: 进度计数（progress.ProgressTask）
+        :return None
+        """
+        download_headers = self._get_download_headers()
+        downloader = RangeDownloader(self.sess, download_url, video_name, download_headers, connections,
+                                     bucket=self.bucket, progress=progress)
+        if downloader.probe() is not None:  # 服务器不支持Range时退回单连接从头下载
+            if downloader.download():
+                log('视频[{}]下载完成!'.format(file_name))
+            else:
+                log('链接异常')
+            return
         """
         contextlib.closing(thing)
         返回一个在块完成上结束thing的上下文管理器。
@@ -1172,325 +1723,394 @@ class Video:
         如果一个类没有这两个方法，是无法使用with的。 
         contextlib.closing()会帮它加上__enter__()和__exit__()，使其满足with的条件。
         """
-        with closing(self.sess.get(download_url, headers=download_headers, stream=True, verify=False)) as response:
-            chunk_size = 1024
-            content_size = int(response.headers['content-length'])
-            if response.status_code == 200:
+        for attempt in range(VERIFY_ATTEMPTS):
+            try:
+                # 连接和读取都有超时，建立连接后不再发送数据的CDN不会让下载一直挂起
+                response = self.sess.get(downloader.download_url, headers=download_headers, stream=True, verify=False,
+                                         timeout=RangeDownloader.timeout)
+            except requests.RequestException as e:
+                log('视频[{}]下载出错，稍后重新下载：{}'.format(file_name, e))
+                RETRIES.inc(reason='retry')
+                sleep_backoff(attempt)
+                continue
+            with closing(response) as response:
+                chunk_size = 256 * 1024
+                if response.status_code != 200:
+                    log('链接异常')
+                    return
+                content_size = int(response.headers['content-length'])
+                # 边写边统计大小、计算分块摘要并检查FLV分帧，不需要写完后再读一遍
+                verifier = StreamVerifier(0, content_size, is_flv_url(downloader.download_url), content=True)
                 # sys.stdout.write('  [文件大小]:%0.2f MB\n' % (content_size / chunk_size / 1024))
-                video_name = os.path.join(directory, file_name)
-                with tqdm(total=content_size, mininterval=1, unit='Bytes') as bar:
-                    bar.set_description('[Download]')
-                    with open(video_name, 'wb') as file:
+                progress.total = content_size
+                progress.reset()
+                begin = time.time()
+                watchdog = SpeedWatchdog()  # 速度持续过低时放弃本次请求重新下载
+                try:
+                    if os.path.exists(video_name + PART_SUFFIX):  # 不支持Range时只能从头下载
+                        os.remove(video_name + PART_SUFFIX)
+                    with FileWriter(video_name + PART_SUFFIX, content_size) as writer:
+                        buffer = RangeBuffer(writer, 0, verifier=verifier)
                         """
                         requests.get(url)默认是下载在内存中的，下载完成才存到硬盘上，
                         可以用Response.iter_content来边下载边存硬盘，
                         chunk_size可以自由调整为可以更好地适合您的用例的数字
-    
+
                         对于分块的编码请求，我们最好使用 Response.iter_content()对其数据进行迭代。
                         在理想情况下，你的 request 会设置 stream=True，
                         这样你就可以通过调用 iter_content 并将分块大小参数设为 None，从而进行分块的迭代。
                         如果你要设置分块的最大体积，你可以把分块大小参数设为任意整数。
                         """
                         for data in response.iter_content(chunk_size=chunk_size):
-                            """
-                            write() 方法用于向文件中写入指定字符串。
-                            在文件关闭前或缓冲区刷新前，字符串内容存储在缓冲区中，这时你在文件中是看不到写入的内容的。
-                            如果文件打开模式带 b，那写入文件内容时，str (参数)要用 encode 方法转为 bytes 形式，
-                            否则报错：TypeError: a bytes-like object is required, not 'str'。
-                            """
-                            file.write(data)
-                            size += len(data)
-                            """
-                            flush() 方法是用来刷新缓冲区的，即将缓冲区中的数据立刻写入文件，同时清空缓冲区，不需要被动的等待输出缓冲区写入。
-                            一般情况下，文件关闭后会自动刷新缓冲区，但有时你需要在关闭前刷新它，这时就可以使用 flush() 方法。
-                            """
-                            file.flush()
-
-                            bar.update(len(data))  # 更新下载进度条
+                            watchdog.update(len(data), throttle(len(data), get_bucket(), self.bucket))
+                            buffer.write(data)  # 数据先拼接进大缓冲区，写满后由写线程写盘
+                            progress.update(len(data))  # 只累加计数，由进度输出器定时显示
                             # sys.stdout.write('  [下载进度]:%.2f%%' % float(size / content_size * 100) + '\r')
                             # sys.stdout.flush()
-                if size / content_size == 1:
-                    print('视频[{}]下载完成!'.format(file_name))
-            else:
-                print('链接异常')
+                        buffer.flush()
+                    result = verifier.finish()
+                except IntegrityError as e:
+                    log('视频[{}]校验失败，重新下载：{}'.format(file_name, e))
+                    RETRIES.inc(reason='verify')
+                    continue
+                except (StallError, requests.RequestException) as e:
+                    log('视频[{}]下载出错，稍后重新下载：{}'.format(file_name, e))
+                    RETRIES.inc(reason='stall' if isinstance(e, StallError) else 'retry')
+                    sleep_backoff(attempt)
+                    continue
+                finally:
+                    DOWNLOAD_BYTES.inc(verifier.size, host=host_of(downloader.download_url))
+            SEGMENT_SECONDS.observe(time.time() - begin, mode='stream')
+            write_manifest(video_name, content_size, verifier.pieces, content_digest=verifier.content_digest,
+                           **result)
+            os.replace(video_name + PART_SUFFIX, video_name)
+            log('视频[{}]下载完成!'.format(file_name))
+            return
+        log('视频[{}]多次校验失败，重新运行即可重新下载'.format(file_name))
 
     @exec_time
-    def download_video(self, directory=r'video', stage_width=640, stage_height=360, **kwargs):
+    def download_video(self, directory=r'video', stage_width=640, stage_height=360, connections=1, **kwargs):
         """
         单线程下载视频及弹幕
         :param directory: 下载目录
         :param stage_width: 弹幕宽
         :param stage_height: 弹幕高
+        :param connections: 单个分段的并行连接数
         :param kwargs: 其余下载弹幕时用的参数
-        :return: None
+        :return: bool 是否所有分P都已完整下载
         """
         new_directory = self._check_dir(directory)  # 检查目录合法性
-        print('>>>目录检查完成...')
+        log('>>>目录检查完成...')
 
         self._get_video_download_url_v2()  # 获取视频下载地址
-        print('>>>获取视频下载地址完成...')
+        log('>>>获取视频下载地址完成...')
 
         # 下载视频
-        page_list_length = len(self.page_list)  # 视频分P总数
-        for i in range(page_list_length):
-            # 针对多p视频的标题处理
-            if page_list_length == 1:
-                title = self.title
-            else:
-                title = self.title + '_' + self.page_list[i].part
-
-            for c in u'´☆❤◦\/:*?"<>|':  # 过滤文件非法字符
-                title = title.replace(c, '')
-
-            title = title.replace(' ', '_')  # 转换空格，避免ffmpeg无法识别
-
-            if title + '.flv' not in os.listdir(new_directory):
-                movies = []
-                cid_ = str(self.page_list[i].cid)
-                for i_, url_ in enumerate(self.download_url_dict[cid_]):
-                    if url_ != '':
-                        temp_file_name = title + '_' + str(i_ + 1) + '.flv'
-                        movies.append(temp_file_name)
-                        print('视频[{}]下载中...'.format(temp_file_name))
-                        self.video_downloader(new_directory, url_, temp_file_name)
-
-                # 多段视频合成
-                if len(movies) > 1:
-                    try:
-                        """
-                        os.path.join(path1[, path2[, ...]])
-                        把目录和文件名合成一个路径，可以传入多个路径
-                        会从第一个以”/”开头的参数开始拼接，之前的参数全部丢弃。
-                        在上一种情况确保情况下，若出现”./”开头的参数，从”./”开头的参数前的全部会保留并开始拼接。
-                        """
-                        file_list_file_name = os.path.join(new_directory, 'file_list.txt')
-
-                        with open(file_list_file_name, 'w') as f:
-                            for flv in movies:
-                                f.write("file " + flv)
-                                f.write('\n')
-
-                        os.system('cd %s & ffmpeg -f concat -safe 0 -i %s -c copy %s' % (
-                            new_directory, 'file_list.txt', title + '.flv'))
-
-                        """
-                        os.remove(path)
-                        用于删除指定路径的文件。如果指定的路径是一个目录，将抛出OSError。
-                        参数
-                            path -- 要移除的文件路径
-                        返回值
-                            该方法没有返回值
-                        """
-                        for movie in movies:
-                            os.remove(os.path.join(new_directory, movie))
-
-                        os.remove(file_list_file_name)
-
-                        print('视频合并完成！')
-                    except Exception as e:
-                        exit(e)
-                else:
-                    """
-                    os.rename(src, dst)
-                    用于命名文件或目录，从 src 到 dst,如果dst是一个存在的目录, 将抛出OSError。
-                    只能对相应的文件进行重命名, 不能重命名文件的上级目录名。
-                    参数
-                        src -- 要修改的目录名
-                        dst -- 修改后的目录名
-                    返回值
-                        该方法没有返回值
+        indexes = self._page_indexes()
+        merger = MergePipeline()
+        steps = PageDownloader(self, merger, danmu=dict(stage_width=stage_width, stage_height=stage_height, **kwargs))
+        for i in self._schedule_pages(new_directory, indexes):  # 其他进程正在下载的分P推迟到最后
+            run_sync(self._download_page(steps, i, new_directory, connections, leased=True))
 
-                    os.renames(old, new)
-                    用于递归重命名目录或文件。
-                    是os.rename的升级版, 既可以重命名文件, 也可以重命名文件的上级目录名。
-                    参数
-                        old -- 要重命名的目录
-                        new --文件或目录的新名字。甚至可以是包含在目录中的文件，或者完整的目录树。
-                    返回值
-                        该方法没有返回值
-                    """
-                    os.rename(os.path.join(new_directory, movies[0]), os.path.join(new_directory, title + '.flv'))
-
-                # 下载弹幕文件
-                danmu_ass = os.path.join(new_directory, title + '.ass')
-                print('视频[{}]的弹幕下载中...'.format(title))
-                self.get_video_danmuku_2_ass(cid_, danmu_ass, stage_width, stage_height, **kwargs)
-                print('视频[{}]的弹幕下载完成!'.format(title))
-
-        print('>>>视频全部下载完成！')
+        merger.close()  # 等待后台的合并任务完成
+        return self._check_pages(new_directory, indexes)
 
     @exec_time
-    def multi_thread_download_video(self, directory=r'video', stage_width=640, stage_height=360, **kwargs):
+    def multi_thread_download_video(self, directory=r'video', stage_width=640, stage_height=360, connections=1,
+                                    **kwargs):
         """
         单线程下载视频及弹幕
         :param directory: 下载目录
         :param stage_width: 弹幕宽
         :param stage_height: 弹幕高
+        :param connections: 单个分段的并行连接数
         :param kwargs: 其余下载弹幕时用的参数
-        :return: None
+        :return: bool 是否所有分P都已完整下载
         """
         new_directory = self._check_dir(directory)  # 检查目录合法性
-        print('>>>目录检查完成...')
+        log('>>>目录检查完成...')
 
         self._get_video_download_url_v2()  # 获取视频下载地址
-        print('>>>获取视频下载地址完成...')
+        log('>>>获取视频下载地址完成...')
 
-        page_list_length = len(self.page_list)
-        max_workers = page_list_length if cpu_count() > page_list_length else cpu_count()
+        indexes = self._page_indexes()
+        # 实际的网络并发由各主机的AIMD控制器调整，这里只限制同时运行的线程数
+        max_workers = max(1, min(len(indexes), get_controller().page_limit))
         semaphore = threading.BoundedSemaphore(max_workers)
+        merger = MergePipeline()
 
-        all_tasks = [MultiThreadDownloadVideo(self, semaphore, i, new_directory, stage_width, stage_height, **kwargs)
-                     for i in range(page_list_length)]
+        all_tasks = [MultiThreadDownloadVideo(self, semaphore, i, new_directory, stage_width, stage_height, connections,
+                                              merger, **kwargs)
+                     for i in indexes]
         for task in all_tasks:
             task.start()
 
         for task in all_tasks:
             task.join()
+        merger.close()  # 等待后台的合并任务完成
+        return self._check_pages(new_directory, indexes)
 
-        print('>>>视频全部下载完成！')
-
-    async def _async_video_downloader(self, semaphore: asyncio.Semaphore, directory, download_url, file_name):
+    async def _async_video_downloader(self, semaphore: asyncio.Semaphore, directory, download_url, file_name,
+                                      connections=1):
         """
         异步视频下载器，不下载弹幕，因为弹幕使用的是阻塞IO，无法应用协程
-        :param semaphore: 同时进行的最大协程数
+        :param semaphore: 同时进行的最大协程数，为None时表示调用者已持有
         :param directory: 视频保存路径
-        :param download_url: 视频下载地址
+        :param download_url: 视频下载地址，或同一分段的多个镜像地址列表
         :param file_name: 保存的视频名称
+        :param connections: 单个分段的并行连接数，服务器支持Range时按字节区间下载并可断点续传
         :return None
         """
-        download_headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/64.0.3282.167 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Accept-Language': 'zh-CN,zh;q=0.9',
-            'Referer': self.arcurl
-        }
-
-        size = 0
+        video_name = os.path.join(directory, file_name)
+        if is_completed(video_name):  # 之前的运行中已下载完成
+            log('视频[{}]已存在，跳过下载'.format(file_name))
+            return
+
+        if semaphore is None:  # 调用者已持有信号量
+            await self._async_fetch_video(video_name, download_url, file_name, connections)
+            return
         async with semaphore:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(download_url, headers=download_headers, chunked=True, verify_ssl=False) as response:
+            await self._async_fetch_video(video_name, download_url, file_name, connections)
+
+    async def _async_fetch_video(self, video_name, download_url, file_name, connections):
+        """
+        _async_video_downloader中实际的下载过程，调用时需已持有信号量
+        :param video_name: 视频保存的完整路径
+        :param download_url: 视频下载地址，或同一分段的多个镜像地址列表
+        :param file_name: 保存的视频名称
+        :param connections: 单个分段的并行连接数
+        :return None
+        """
+        download_headers = self._get_download_headers()
+        with get_progress().task(file_name) as progress:  # 各连接只累加计数，由进度输出器统一显示
+            session = get_pool().async_session()  # 共享连接池，由async_download_video负责关闭
+            downloader = AsyncRangeDownloader(session, download_url, video_name, download_headers, connections,
+                                              bucket=self.bucket, progress=progress)
+            if await downloader.probe() is not None:  # 服务器不支持Range时退回单连接从头下载
+                if await downloader.download():
+                    log('视频[{}]下载完成!'.format(file_name))
+                return
+
+            for attempt in range(VERIFY_ATTEMPTS):
+                try:
+                    response = await session.get(downloader.download_url, headers=download_headers,
+                                                 chunked=True, verify_ssl=False,
+                                                 timeout=AsyncRangeDownloader.timeout)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    log('视频[{}]下载出错，稍后重新下载：{}'.format(file_name, e))
+                    RETRIES.inc(reason='retry')
+                    await sleep_backoff_async(attempt)
+                    continue
+                async with response:
                     chunk_size = 1024 * 1024
+                    if response.status != 200:
+                        log('链接异常')
+                        return
                     content_size = int(response.headers['content-length'])
-                    if response.status == 200:
-                        video_name = os.path.join(directory, file_name)
-                        async with aiofiles.open(video_name, 'wb') as file:
-                            async for data in response.content.iter_chunked(chunk_size):
-                                await file.write(data)
-                                size += len(data)
-                                await file.flush()
-
-                        if size / content_size == 1:
-                            print('视频[{}]下载完成!'.format(file_name))
-
-    async def _async_download_video(self, i: int, queue: asyncio.Queue, semaphore: asyncio.Semaphore, directory=r'video'):
+                    progress.total = content_size
+                    progress.reset()
+                    begin = time.time()
+                    if os.path.exists(video_name + PART_SUFFIX):  # 不支持Range时只能从头下载
+                        os.remove(video_name + PART_SUFFIX)
+                    loop = asyncio.get_event_loop()
+                    verifier = StreamVerifier(0, content_size, is_flv_url(downloader.download_url), content=True)
+                    watchdog = SpeedWatchdog()  # 速度持续过低时放弃本次请求重新下载
+                    writer = FileWriter(video_name + PART_SUFFIX, content_size)
+                    try:
+                        try:
+                            buffer = RangeBuffer(writer, 0, verifier=verifier)
+                            await write_async(buffer, response.content.iter_chunked(chunk_size),
+                                              bucket=self.bucket, progress=progress, watchdog=watchdog)
+                        finally:
+                            await loop.run_in_executor(None, writer.close)
+                        result = verifier.finish()
+                    except IntegrityError as e:
+                        log('视频[{}]校验失败，重新下载：{}'.format(file_name, e))
+                        RETRIES.inc(reason='verify')
+                        continue
+                    except (StallError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        log('视频[{}]下载出错，稍后重新下载：{}'.format(file_name, e))
+                        RETRIES.inc(reason='stall' if isinstance(e, StallError) else 'retry')
+                        await sleep_backoff_async(attempt)
+                        continue
+                    finally:
+                        DOWNLOAD_BYTES.inc(verifier.size, host=host_of(downloader.download_url))
+                SEGMENT_SECONDS.observe(time.time() - begin, mode='stream')
+                write_manifest(video_name, content_size, verifier.pieces, content_digest=verifier.content_digest,
+                               **result)
+                os.replace(video_name + PART_SUFFIX, video_name)
+                log('视频[{}]下载完成!'.format(file_name))
+                return
+            log('视频[{}]多次校验失败，重新运行即可重新下载'.format(file_name))
+
+    async def _async_concat_video_downloader(self, semaphore: asyncio.Semaphore, directory, segments, file_name,
+                                             connections=1):
         """
-        单线程下载视频及弹幕
-        :param i: 任务下标
-        :param queue: 清理队列
+        concat_video_downloader的协程版本
         :param semaphore: 同时进行的最大协程数
-        :param directory: 下载目录
-        :return: None
+        :param directory: 视频保存路径
+        :param segments: 每个分段的镜像地址列表
+        :param file_name: 保存的视频名称
+        :param connections: 每个分段的并行连接数
+        :return: bool 是否完整下载，服务器不支持Range或时间戳无法直接拼接时返回None
         """
-        # 针对多p视频的标题处理
-        if len(self.page_list) == 1:
-            title = self.title
-        else:
-            title = self.title + '_' + self.page_list[i].part
-
-        for c in u'´☆❤◦\/:*?"<>|':  # 过滤文件非法字符
-            title = title.replace(c, '')
-
-        title = title.replace(' ', '_')  # 转换空格，避免ffmpeg无法识别
-
-        if title + '.flv' not in os.listdir(directory):
-            movies = []
-            cid_ = str(self.page_list[i].cid)
-            for i_, url_ in enumerate(self.download_url_dict[cid_]):
-                if url_ != '':
-                    temp_file_name = title + '_' + str(i_ + 1) + '.flv'
-                    movies.append(temp_file_name)
-                    print('视频[{}]下载中...'.format(temp_file_name))
-                    await self._async_video_downloader(semaphore, directory, url_, temp_file_name)
-
-            await asyncio.sleep(1)  # 等待释放相关资源以供ffmpeg使用
-
-            # 多段视频合成
-            if len(movies) > 1:
-                try:
-                    file_list_file_name = os.path.join(directory, 'file_list_' + str(i + 1) + '.txt')
-                    async with aiofiles.open(file_list_file_name, 'w') as f:
-                        for flv in movies:
-                            await f.write("file " + flv)
-                            await f.write('\n')
-
-                    """
-                    ffmpeg
-                    -i path（输入）
-                    输入您要处理的视频文件路径
-
-                    -f fmt（输入/输出）
-                    强制输入或输出文件格式。通常会自动检测输入文件的格式，并从输出文件的文件扩展名中猜出格式，因此在大多数情况下不需要此选项。
-
-                    -c [：stream_specifier ] 编解码器（输入/输出，每个流）
-                    为一个或多个流选择编码器（在输出文件之前使用时）或解码器（在输入文件之前使用时）。
-                    codec是解码器/编码器的名称或特殊值copy（仅输出），表示不对流进行重新编码。
-
-                    例如
-                    ffmpeg -i INPUT -map 0 -c:v libx264 -c:a copy OUTPUT
-                    使用libx264对所有视频流进行编码并复制所有音频流。
-
-                    对于每个流，c应用最后一个匹配选项，因此
-                    ffmpeg -i INPUT -map 0 -c copy -c：v：1 libx264 -c：a：137 libvorbis OUTPUT
-                    将复制除第二个视频（将使用libx264编码）和第138个音频（将使用libvorbis编码）之外的所有流。
-                    """
-                    cwd = directory if os.path.isabs(directory) else os.path.join(sys.path[0], directory)
-                    process = subprocess.Popen(
-                        ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', 'file_list_' + str(i + 1) + '.txt', '-c', 'copy',
-                         title + '.flv'], cwd=cwd)
-
-                    while True:
-                        if process.poll() is not None:  # 等待子进程结束
-                            queue.put_nowait(file_list_file_name)
-                            for movie in movies:
-                                queue.put_nowait(os.path.join(directory, movie))
-                            break
-
-                        await asyncio.sleep(1)
-                except Exception as e:
-                    print(e)
-            else:
-                os.rename(os.path.join(directory, movies[0]), os.path.join(directory, title + '.flv'))
-        else:
+        async with semaphore:
+            with get_progress().task(file_name) as progress:
+                downloader = AsyncConcatDownloader(get_pool().async_session(), segments,
+                                                   os.path.join(directory, file_name), self._get_download_headers(),
+                                                   connections, self.bucket, progress)
+                result = await downloader.download()
+            if result:
+                log('视频[{}]下载完成!'.format(file_name))
+            return result
+
+    async def _async_dash_video_downloader(self, semaphore: asyncio.Semaphore, directory, streams, title,
+                                           connections=1):
+        """
+        dash_video_downloader的协程版本，整个分P只占一个信号量，两条轨道在其中同时下载
+        :param semaphore: 同时进行的最大协程数
+        :param directory: 视频保存路径
+        :param streams: 视频轨和音频轨的镜像地址
+        :param title: 视频标题
+        :param connections: 每条轨道的并行连接数
+        :return: list 轨道文件名，未完整下载时返回None
+        """
+        tracks = track_files(title, streams)
+        async with semaphore:
+            # 一条轨道失败时另一条仍然下载完，下次运行只需继续失败的轨道
+            results = await asyncio.gather(*[self._async_video_downloader(None, directory, mirrors, name, connections)
+                                             for name, mirrors in tracks], return_exceptions=True)
+        for result in results:
+            if isinstance(result, DownloadError):  # 轨道文件不存在，下面返回None
+                log(result)
+            elif isinstance(result, BaseException):
+                raise result
+        names = [name for name, _ in tracks]
+        if not all(os.path.exists(os.path.join(directory, name)) for name in names):
             return None
+        return names
 
-    @exec_time
-    def async_download_video(self, directory=r'video'):
+    async def _download_page(self, steps, i, directory, connections=1, leased=False):
+        """
+        下载一个分P：内容存储 -> DASH轨道 -> 多段FLV拼接 -> 逐段下载并合并 -> 弹幕 -> 写入下载索引并释放租约
+        三种下载方式共用这一流程，与方式有关的下载、合并等步骤由steps完成，见PageDownloader和AsyncPageDownloader
+        :param steps: PageDownloader或AsyncPageDownloader
+        :param i: 分P下标
+        :param directory: 下载目录
+        :param connections: 单个分段的并行连接数
+        :param leased: 调用方是否已取得分P的租约（按租约调度时）
+        :return None
+        """
+        title = self._page_title(i)
+        cid_ = str(self.page_list[i].cid)
+        page_directory = self._page_directory(directory, cid_)  # 分层时为cid对应的子目录
+        output = self._page_file_name(title, cid_)  # DASH分P为MP4
+        output_path = os.path.join(page_directory, output)
+        if not leased and not await steps.wait_page(cid_, output_path):  # 已由其他进程完成
+            return
+        merging = None
+        try:
+            if self._is_downloaded(directory, cid_, output_path):
+                return
+            streams = self.dash_url_dict.get(cid_)
+            if await steps.link(directory, cid_, output_path):
+                log('视频[{}]已在内容存储中，直接链接'.format(output))
+            elif streams is not None:
+                # 视频轨和音频轨同时下载，完成后用ffmpeg封装为MP4
+                log('视频[{}]下载中...'.format(output))
+                tracks = await steps.dash(page_directory, streams, title, connections)
+                if tracks is None:
+                    log('视频[{}]未完整下载，重新运行即可从断点继续'.format(title))
+                    return
+                merging = await steps.mux(page_directory, tracks, output)
+            else:
+                segments = [m for m in self.mirror_url_dict[cid_] if m[0] != '']
+                concatenated = None
+                if len(segments) > 1 and all(is_flv_url(m[0]) for m in segments):
+                    # 多段FLV直接拼接进最终文件，不产生临时分段文件，也不需要ffmpeg
+                    log('视频[{}]下载中...'.format(output))
+                    concatenated = await steps.concat(page_directory, segments, output, connections)
+                    if concatenated is False:
+                        log('视频[{}]未完整下载，重新运行即可从断点继续'.format(title))
+                        return
+
+                if concatenated is None:  # 单段视频或服务器不支持Range时逐段下载
+                    movies = []
+                    for i_, mirrors_ in enumerate(self.mirror_url_dict[cid_]):
+                        if mirrors_[0] != '':
+                            temp_file_name = title + '_' + str(i_ + 1) + '.flv'
+                            movies.append(temp_file_name)
+                            log('视频[{}]下载中...'.format(temp_file_name))
+                            await steps.segment(page_directory, mirrors_, temp_file_name, connections)
+
+                    if not all(os.path.exists(os.path.join(page_directory, movie)) for movie in movies):
+                        log('视频[{}]未完整下载，重新运行即可从断点继续'.format(title))
+                        return
+
+                    # 多段视频合成，合并在后台进行，同时继续下载下一P，分段文件在合并成功后删除
+                    if len(movies) > 1:
+                        merging = await steps.merge(page_directory, movies, output)
+                    else:
+                        rename_verified(os.path.join(page_directory, movies[0]), output_path)
+
+            await steps.danmu(page_directory, title, cid_)
+        except DownloadError as e:  # 只有这一P失败，其余分P继续下载
+            log('{}，重新运行即可从断点继续'.format(e))
+        finally:
+            await steps.release(directory, cid_, output_path, merging)
+
+    async def download(self, directory=r'video', connections=1):
+        """
+        在调用者的事件循环中下载视频，不新建也不关闭事件循环，可与调用者的其他协程同时运行
+        使用该事件循环共享的aiohttp会话，由调用者在事件循环结束前await get_pool().async_close()关闭
+        :param directory: 下载目录
+        :param connections: 单个分段的并行连接数
+        :return: bool 是否所有分P都已完整下载
+        """
         new_directory = self._check_dir(directory)  # 检查目录合法性
-        print('>>>目录检查完成...')
+        log('>>>目录检查完成...')
 
-        self._get_video_download_url_v2()  # 获取视频下载地址
-        print('>>>获取视频下载地址完成...')
+        await self.load_details()
+        await self._get_video_download_url_async()  # 获取视频下载地址
+        log('>>>获取视频下载地址完成...')
 
-        futures = []
-        clean_queue = asyncio.Queue()
-        page_list_length = len(self.page_list)
-        max_workers = page_list_length if cpu_count() * 2 > page_list_length else cpu_count() * 2
-        current_semaphore = asyncio.Semaphore(max_workers)  # 限制并发量为任务数或CPU核数的2倍
-        for i in range(page_list_length):
-            futures.append(self._async_download_video(i, clean_queue, current_semaphore, new_directory))
+        indexes = self._page_indexes()
+        max_workers = max(1, min(len(indexes), get_controller().page_limit))
+        current_semaphore = asyncio.Semaphore(max_workers)  # 实际的网络并发由各主机的AIMD控制器调整
+        merger = MergePipeline(loop=asyncio.get_event_loop())  # 分段文件在各自的合并完成回调中删除
+        try:
+            steps = AsyncPageDownloader(self, merger, current_semaphore)
+            await asyncio.gather(*[self._download_page(steps, i, new_directory, connections) for i in indexes])
+        finally:
+            await merger.join_async()
+        return self._check_pages(new_directory, indexes)
 
+    @exec_time
+    def async_download_video(self, directory=r'video', connections=1):
+        """
+        在事件循环中下载视频，不下载弹幕
+        工作线程（见pool.worker_loop）中使用线程的长期事件循环和aiohttp会话，任务之间保持连接，不关闭；
+        否则使用当前线程的事件循环，结束时关闭会话和事件循环
+        :param directory: 下载目录
+        :param connections: 单个分段的并行连接数
+        :return: bool 是否所有分P都已完整下载
+        """
+        loop = get_worker_loop()
+        if loop is not None:
+            try:
+                return loop.run_until_complete(self.download(directory, connections))
+            finally:
+                # 出错时gather中其余分P的协程还留在事件循环里，取消掉，不带到下一个任务
+                pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
         with closing(asyncio.get_event_loop()) as loop:
-            loop.run_until_complete(asyncio.gather(*futures))
-
-        # 清理不需要的文件
-        while True:
-            if not clean_queue.empty():
-                os.remove(clean_queue.get_nowait())
-            else:
-                break
-
-        print('>>>视频全部下载完成！')
+            try:
+                return loop.run_until_complete(self.download(directory, connections))
+            finally:
+                loop.run_until_complete(get_pool().async_close())  # 连接池的aiohttp会话需在事件循环关闭前关闭
 
     def get_video_danmuku(self, cid, return_type='list', order='asc'):
         """
@@ -1531,7 +2151,8 @@ class Video:
         url = self.videoDanmukuUrl.format(cid)
         content = get_url_content(url)
         if len(content) > 0:
-            content = zlib.decompressobj(-zlib.MAX_WBITS).decompress(content)  # 返回bytes
+            if not content.lstrip().startswith(b'<'):  # 服务器未声明Content-Encoding时需自行解压
+                content = zlib.decompressobj(-zlib.MAX_WBITS).decompress(content)  # 返回bytes
 
             if return_type == 'string':
                 return content
@@ -1601,9 +2222,10 @@ class Video:
             file.flush()
 
         time.sleep(1)
-        Danmaku2ASS(danmu_xml, 'Bilibili', output_file, stage_width, stage_height, reserve_blank, font_face, font_size,
-                    text_opacity, duration_marquee, duration_still, comment_filter, is_reduce_comments,
-                    progress_callback)
+        with DANMAKU_SECONDS.time():
+            Danmaku2ASS(danmu_xml, 'Bilibili', output_file, stage_width, stage_height, reserve_blank, font_face,
+                        font_size, text_opacity, duration_marquee, duration_still, comment_filter, is_reduce_comments,
+                        progress_callback)
         os.remove(danmu_xml)
 
     @staticmethod
@@ -1688,7 +2310,7 @@ class Danmu:
 
 class MultiThreadDownloadVideo(threading.Thread):
     def __init__(self, video: Video, semaphore: threading.BoundedSemaphore, i: int, directory=r'video', stage_width=640,
-                 stage_height=360, **kwargs):
+                 stage_height=360, connections=1, merger=None, **kwargs):
         """
         传递视频实例对象及相关下载参数，多线程切换对CPU的负荷较大，不建议使用
         :param video: 视频实例对象
@@ -1697,6 +2319,8 @@ class MultiThreadDownloadVideo(threading.Thread):
         :param directory: 下载目录
         :param stage_width: 弹幕宽
         :param stage_height: 弹幕高
+        :param connections: 单个分段的并行连接数
+        :param merger: 共享的合并流水线，为None时在当前线程中等待合并完成
         :param kwargs: 其余下载弹幕时用的参数
         :return None
         """
@@ -1707,63 +2331,146 @@ class MultiThreadDownloadVideo(threading.Thread):
         self.directory = directory
         self.stage_width = stage_width
         self.stage_height = stage_height
+        self.connections = connections
+        self.merger = merger
         self.kwargs = kwargs
 
     def run(self):
-        self.semaphore.acquire()
+        steps = PageDownloader(self.video, self.merger, self.semaphore,
+                               dict(stage_width=self.stage_width, stage_height=self.stage_height, **self.kwargs))
+        run_sync(self.video._download_page(steps, self.i, self.directory, self.connections))
+
+
+def run_sync(coroutine):
+    """
+    在当前线程中运行一个不会挂起的协程，不需要事件循环
+    PageDownloader的步骤都是阻塞调用，Video._download_page用它运行时从头执行到尾
+    :param coroutine: 协程对象
+    :return: 协程的返回值
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError('同步下载流程中等待了异步操作')
+
+
+class PageDownloader:
+    """
+    Video._download_page中与下载方式有关的步骤：在当前线程中阻塞下载，合并交给后台的合并流水线，下载弹幕
+    步骤写成协程只是为了与AsyncPageDownloader共用同一个流程，其中没有await，由run_sync运行
+    """
+
+    def __init__(self, video: Video, merger=None, semaphore=None, danmu=None):
+        """
+        :param video: 视频实例对象
+        :param merger: 共享的合并流水线，为None时每次合并临时创建一个并等待合并完成
+        :param semaphore: 同时下载的分P数（线程信号量），取得租约后占用，为None时不限制
+        :param danmu: 下载弹幕时用的参数（stage_width、stage_height等），为None时不下载弹幕
+        :return None
+        """
+        self.video = video
+        self.merger = merger
+        self.semaphore = semaphore
+        self.danmu_kwargs = danmu
 
-        # 针对多p视频的标题处理
-        if len(self.video.page_list) == 1:
-            title = self.video.title
-        else:
-            title = self.video.title + '_' + self.video.page_list[self.i].part
+    async def wait_page(self, cid, file_name):
+        if not self.video._wait_page(cid, file_name):
+            return False
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return True
 
-        for c in u'´☆❤◦\/:*?"<>|':  # 过滤文件非法字符
-            title = title.replace(c, '')
+    async def link(self, directory, cid, file_name):
+        return self.video._link_from_store(directory, cid, file_name)
 
-        title = title.replace(' ', '_')  # 转换空格，避免ffmpeg无法识别
+    async def dash(self, directory, streams, title, connections):
+        return self.video.dash_video_downloader(directory, streams, title, connections)
 
-        if title + '.flv' not in os.listdir(self.directory):
-            movies = []
-            cid_ = str(self.video.page_list[self.i].cid)
-            for i_, url_ in enumerate(self.video.download_url_dict[cid_]):
-                if url_ != '':
-                    temp_file_name = title + '_' + str(i_ + 1) + '.flv'
-                    movies.append(temp_file_name)
-                    print('视频[{}]下载中...'.format(temp_file_name))
-                    self.video.video_downloader(self.directory, url_, temp_file_name)
+    async def concat(self, directory, segments, file_name, connections):
+        return self.video.concat_video_downloader(directory, segments, file_name, connections)
 
-            # 多段视频合成
-            if len(movies) > 1:
-                try:
-                    file_list_file_name = os.path.join(self.directory, 'file_list.txt')
-                    with open(file_list_file_name, 'w') as f:
-                        for flv in movies:
-                            f.write("file " + flv)
-                            f.write('\n')
+    async def segment(self, directory, mirrors, file_name, connections):
+        self.video.video_downloader(directory, mirrors, file_name, connections)
 
-                    os.system('cd %s & ffmpeg -f concat -safe 0 -i %s -c copy %s' % (
-                        self.directory, 'file_list.txt', title + '.flv'))
+    def _submit(self, submit, *args):
+        """
+        提交合并任务，没有共享的合并流水线时临时创建一个并等待合并完成
+        :return: Future
+        """
+        merger = self.merger if self.merger is not None else MergePipeline()
+        merging = submit(merger, *args)
+        if merger is not self.merger:
+            merger.close()
+        return merging
+
+    async def mux(self, directory, tracks, output):
+        return self._submit(MergePipeline.submit_mux, directory, tracks, output)
+
+    async def merge(self, directory, movies, output):
+        return self._submit(MergePipeline.submit_concat, directory, movies, output)
+
+    async def danmu(self, directory, title, cid):
+        if self.danmu_kwargs is None:
+            return
+        # 下载弹幕文件
+        danmu_ass = os.path.join(directory, title + '.ass')
+        log('视频[{}]的弹幕下载中...'.format(title))
+        self.video.get_video_danmuku_2_ass(cid, danmu_ass, **self.danmu_kwargs)
+        log('视频[{}]的弹幕下载完成!'.format(title))
+
+    async def release(self, directory, cid, file_name, merging):
+        if self.semaphore is not None:
+            self.semaphore.release()
+        self.video._release_page(directory, cid, file_name, merging)
+
+
+class AsyncPageDownloader:
+    """
+    Video._download_page中与下载方式有关的步骤的协程版本：每次下载占用一个信号量（DASH分P的两条轨道共用一个），
+    在事件循环中等待合并完成，不下载弹幕，因为弹幕使用的是阻塞IO，无法应用协程
+    """
+
+    def __init__(self, video: Video, merger: MergePipeline, semaphore: asyncio.Semaphore):
+        """
+        :param video: 视频实例对象
+        :param merger: 运行在当前事件循环中的合并流水线
+        :param semaphore: 同时进行的最大协程数
+        :return None
+        """
+        self.video = video
+        self.merger = merger
+        self.semaphore = semaphore
 
-                    for movie in movies:
-                        os.remove(os.path.join(self.directory, movie))
+    async def wait_page(self, cid, file_name):
+        return await self.video._async_wait_page(cid, file_name)
 
-                    os.remove(file_list_file_name)
+    async def link(self, directory, cid, file_name):
+        return await asyncio.get_event_loop().run_in_executor(None, self.video._link_from_store, directory, cid,
+                                                              file_name)
 
-                    print('视频合并完成！')
-                except Exception as e:
-                    print('请安装FFmpeg--http://ffmpeg.org/，并配置Path环境变量')
-                    exit(e)
-            else:
-                os.rename(os.path.join(self.directory, movies[0]), os.path.join(self.directory, title + '.flv'))
+    async def dash(self, directory, streams, title, connections):
+        return await self.video._async_dash_video_downloader(self.semaphore, directory, streams, title, connections)
+
+    async def concat(self, directory, segments, file_name, connections):
+        return await self.video._async_concat_video_downloader(self.semaphore, directory, segments, file_name,
+                                                               connections)
+
+    async def segment(self, directory, mirrors, file_name, connections):
+        await self.video._async_video_downloader(self.semaphore, directory, mirrors, file_name, connections)
+
+    async def mux(self, directory, tracks, output):
+        await self.merger.submit_mux(directory, tracks, output)  # 在事件循环中等待ffmpeg子进程，不阻塞其他分P
+
+    async def merge(self, directory, movies, output):
+        await self.merger.submit_concat(directory, movies, output)
 
-            # 下载弹幕文件
-            danmu_ass = os.path.join(self.directory, title + '.ass')
-            print('视频[{}]的弹幕下载中...'.format(title))
-            self.video.get_video_danmuku_2_ass(cid_, danmu_ass, self.stage_width, self.stage_height, **self.kwargs)
-            print('视频[{}]的弹幕下载完成!'.format(title))
+    async def danmu(self, directory, title, cid):
+        pass
 
-        self.semaphore.release()
+    async def release(self, directory, cid, file_name, merging):
+        await self.video._async_release_page(directory, cid, file_name)
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载性能基准：本地模拟B站接口和CDN（可设置延迟、带宽和错误率），比较三种下载方式的速度、CPU时间和内存峰值
+# 用法：python benchmark.py --pages 1,4 --segments 1,4 --size 8M --latency 0.02
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from flv import FLV_HEADER_SIZE, TAG_HEADER_SIZE, TAG_VIDEO
+from ratelimit import parse_rate
+
+try:
+    import resource  # Windows上没有，内存峰值记为None
+except ImportError:
+    resource = None
+
+ENGINES = ['download_video', 'multi_thread_download_video', 'async_download_video']
+TAG_DATA_SIZE = 64 * 1024  # 模拟视频中每个标签的数据大小
+CASE_TIMEOUT = 600  # 单次下载的超时（秒），超时的子进程被终止并记为出错
+DANMAKU_XML = b'<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver>' \
+              b'<d p="1.0,1,25,16777215,1547803730,0,624a2288,1">benchmark</d></i>'
+
+
+def build_flv(size):
+    """
+    生成约size字节的合法FLV数据（只有视频标签，时间戳每帧递增40毫秒）
+    :param size: 字节数
+    :return: bytes
+    """
+    data = bytearray(b'FLV\x01\x01\x00\x00\x00\x09' + b'\x00' * 4)
+    timestamp = 0
+    while len(data) + TAG_HEADER_SIZE + 4 < size:
+        length = min(TAG_DATA_SIZE, size - len(data) - TAG_HEADER_SIZE - 4)
+        data += bytes([TAG_VIDEO]) + length.to_bytes(3, 'big') + (timestamp & 0xFFFFFF).to_bytes(3, 'big') + \
+            bytes([timestamp >> 24 & 0xFF]) + b'\x00' * 3
+        data += bytes((i * 7 + timestamp) & 0xFF for i in range(min(length, 256))) * (length // 256) + \
+            b'\x00' * (length % 256)
+        data += struct.pack('>I', TAG_HEADER_SIZE + length)
+        timestamp += 40
+    assert len(data) > FLV_HEADER_SIZE
+    return bytes(data)
+
+
+class FakeBilibili:
+    """模拟的接口和CDN配置，由请求处理器读取"""
+
+    def __init__(self, pages=1, segments=1, size=8 * 1024 * 1024, latency=0.0, bandwidth=0, error_rate=0.0, seed=0):
+        """
+        :param pages: 每个视频的分P数
+        :param segments: 每个分P的分段数
+        :param size: 每个分段的字节数
+        :param latency: 每个请求在返回响应头前的延迟（秒）
+        :param bandwidth: 每个连接的带宽（字节/秒），0表示不限
+        :param error_rate: 视频请求出错的概率，出错时一半返回503，一半在传输中途断开
+        :param seed: 随机数种子
+        :return None
+        """
+        self.pages = pages
+        self.segments = segments
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.payload = build_flv(size)
+        self.danmaku = zlib.compress(DANMAKU_XML)[2:-4]  # 弹幕接口返回不带zlib头尾的deflate数据
+
+    def view(self, aid):
+        pages = self.page_list(aid)
+        return {'aid': aid, 'videos': self.pages, 'cid': pages[0]['cid'], 'tid': 17, 'tname': 'benchmark',
+                'copyright': 1, 'pic': '', 'title': 'benchmark_av{}'.format(aid), 'pubdate': 0, 'ctime': 0,
+                'desc': '', 'duration': 60 * self.pages, 'owner': {'mid': 1, 'name': 'benchmark', 'face': ''},
+                'stat': self.stat(aid), 'pages': pages}
+
+    @staticmethod
+    def stat(aid):
+        return {'aid': aid, 'view': 0, 'danmaku': 1, 'reply': 0, 'favorite': 0, 'coin': 0, 'share': 0, 'like': 0,
+                'copyright': 1, 'now_rank': 0, 'his_rank': 0, 'no_reprint': 1}
+
+    def page_list(self, aid):
+        return [{'cid': aid * 1000 + page, 'page': page, 'from': 'vupload', 'part': 'P{}'.format(page),
+                 'duration': 60, 'vid': '', 'weblink': '', 'dimension': {'width': 1920, 'height': 1080, 'rotate': 0}}
+                for page in range(1, self.pages + 1)]
+
+    def play_url(self, base_url, cid):
+        durl = [{'order': i + 1, 'length': 60000 // self.segments, 'size': len(self.payload),
+                 'url': '{}/media/{}-{}.flv'.format(base_url, cid, i + 1),
+                 'backup_url': ['{}/media/{}-{}.flv?mirror=1'.format(base_url, cid, i + 1)]}
+                for i in range(self.segments)]
+        return {'from': 'local', 'result': 'suee', 'quality': 80, 'format': 'flv',
+                'accept_quality': [80, 64, 32, 16], 'durl': durl}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持keep-alive，和真实CDN一致
+
+    def _send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, data):
+        self._send_body(200, json.dumps(data).encode('utf-8'))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        parsed = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        path = parsed.path
+        base_url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        if path.endswith('/web-interface/view'):
+            self._send_json({'code': 0, 'message': '0', 'data': fake.view(int(query['aid']))})
+        elif path.endswith('/archive/stat'):
+            self._send_json({'code': 0, 'message': '0', 'data': fake.stat(int(query['aid']))})
+        elif path.endswith('/player/pagelist'):
+            self._send_json({'code': 0, 'message': '0', 'data': fake.page_list(int(query['aid']))})
+        elif path.endswith('/playurl'):
+            self._send_json(fake.play_url(base_url, int(query['cid'])))
+        elif path.startswith('/dm/'):
+            self._send_body(200, fake.danmaku, 'text/xml')
+        elif path.startswith('/media/'):
+            self._send_media(fake)
+        else:
+            self._send_body(404, b'')
+
+    def _send_media(self, fake):
+        payload = fake.payload
+        start, end = 0, len(payload) - 1
+        status = 200
+        match = self.headers.get('Range', '')
+        if match.startswith('bytes='):
+            first, _, last = match[6:].partition('-')
+            start, end = int(first), min(int(last) if last else end, end)
+            status = 206
+        error = self.command == 'GET' and fake.random.random() < fake.error_rate
+        if error and fake.random.random() < 0.5:
+            self._send_body(503, b'', 'text/plain')
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/x-flv')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(payload)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        cut = start + (end - start) // 2 if error else None  # 传输中途断开
+        view = memoryview(payload)
+        position = start
+        chunk_size = 64 * 1024
+        while position <= end:
+            if cut is not None and position >= cut:
+                self.close_connection = True
+                return
+            chunk = view[position:min(position + chunk_size, end + 1)]
+            self.wfile.write(chunk)
+            position += len(chunk)
+            if fake.bandwidth:
+                time.sleep(len(chunk) / fake.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(fake):
+    """
+    在后台线程中启动模拟服务器
+    :param fake: FakeBilibili对象
+    :return: string 服务器地址，例如http://127.0.0.1:12345
+    """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+    httpd.daemon_threads = True
+    httpd.fake = fake
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+
+
+def _redirect(base, base_url):
+    """把base中的接口地址指向模拟服务器"""
+    video = base.Video
+    video.videoInfoUrl = base_url + '/x/web-interface/view?aid={}'
+    video.videoStatInfoUrl = base_url + '/x/web-interface/archive/stat?aid={}'
+    video.videoPageListInfoUrl = base_url + '/x/player/pagelist?aid={}'
+    video.videoDanmukuUrl = base_url + '/dm/{}.xml'
+    base.signApiUrl = base_url + '/v2/playurl?'
+
+
+def _run_engine(engine, base_url, aid, directory, connections, verbose, results):
+    """
+    在子进程中运行一次下载，子进程的CPU时间和内存峰值只属于这次下载
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    import asyncio
+    import base
+    import quality
+    import httpcache
+    import mirror
+    _redirect(base, base_url)
+    quality._cache = quality.QualityCache(file_name=None)  # 模拟服务器的cid不写入真实的清晰度缓存
+    httpcache._cache = httpcache.HttpCache(file_name=None)
+    # 镜像测速记录写到本次的临时目录，模拟CDN的成绩不混入真实记录，也不受之前运行的影响
+    mirror._scoreboard = mirror.HostScoreboard(os.path.join(directory, os.path.basename(mirror.SCOREBOARD_FILE)))
+    asyncio.set_event_loop(asyncio.new_event_loop())  # async_download_video结束时会关闭事件循环
+    begin, begin_cpu = time.time(), time.process_time()
+    error = None
+    try:
+        video = base.Video(aid)
+        if getattr(video, engine)(directory, connections=connections) is False:
+            error = '部分分P未完整下载'
+    except (Exception, SystemExit) as e:
+        error = repr(e)
+    wall, cpu = time.time() - begin, time.process_time() - begin_cpu
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory)
+               for name in names if name.endswith('.flv'))
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == 'darwin' else peak * 1024  # Linux上单位为KB
+    results.put({'bytes': size, 'wall': wall, 'cpu': cpu, 'peak_rss': peak, 'error': error})
+
+
+def run_case(engine, base_url, aid, connections, verbose=False, timeout=CASE_TIMEOUT):
+    """
+    在新的子进程和临时目录中运行一次下载
+    子进程崩溃（没有返回结果就退出）或超时时返回一条出错记录，不会一直等待
+    :return: dict
+    """
+    directory = tempfile.mkdtemp(prefix='bilibili-benchmark-')
+    context = multiprocessing.get_context('spawn')  # 子进程从零开始，连接池、缓存和内存峰值都不受之前的运行影响
+    results = context.Queue()
+    process = context.Process(target=_run_engine, args=(engine, base_url, aid, directory, connections, verbose,
+                                                        results))
+    begin = time.time()
+    result = None
+    try:
+        process.start()
+        while result is None:
+            alive = process.is_alive()  # 先判断，退出前放入队列的结果在下面一定能取到
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not alive:
+                    error = 'child process exited with code {}'.format(process.exitcode)
+                elif time.time() - begin > timeout:
+                    process.terminate()
+                    error = 'timed out after {}s'.format(timeout)
+                else:
+                    continue
+                result = {'bytes': 0, 'wall': time.time() - begin, 'cpu': 0, 'peak_rss': None, 'error': error}
+        process.join()
+        if process.exitcode and result['error'] is None:
+            result['error'] = 'child process exited with code {}'.format(process.exitcode)
+    finally:
+        if process.is_alive():
+            process.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the download engines against a local fake Bilibili')
+    parser.add_argument('-e', '--engines', help='Comma separated engines, default all', type=str,
+                        default=','.join(ENGINES))
+    parser.add_argument('-p', '--pages', help='Comma separated page counts', type=str, default='1,4')
+    parser.add_argument('-s', '--segments', help='Comma separated segment counts per page', type=str, default='1,4')
+    parser.add_argument('-n', '--connections', help='Comma separated connections per segment', type=str, default='1')
+    parser.add_argument('--size', help='Size of each segment, e.g. 8M', type=str, default='8M')
+    parser.add_argument('--latency', help='Latency added to every request in seconds', type=float, default=0.0)
+    parser.add_argument('--bandwidth', help='Bandwidth per connection, e.g. 5M, 0 for unlimited', type=str,
+                        default='0')
+    parser.add_argument('--error-rate', help='Probability that a media request fails', type=float, default=0.0)
+    parser.add_argument('--repeat', help='Runs per case, the best one is reported', type=int, default=1)
+    parser.add_argument('--timeout', help='Seconds before a run is killed and reported as an error', type=float,
+                        default=CASE_TIMEOUT)
+    parser.add_argument('--json', help='Print one JSON line per case instead of a table', action='store_true')
+    parser.add_argument('-v', '--verbose', help='Show the output of the downloads', action='store_true')
+    args = parser.parse_args(argv)
+
+    engines = [engine.strip() for engine in args.engines.split(',') if engine.strip()]
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error('unknown engine {}, choose from {}'.format(engine, ', '.join(ENGINES)))
+
+    if not args.json:
+        print('{:<30}{:>6}{:>9}{:>6}{:>10}{:>9}{:>9}{:>10}'.format('engine', 'pages', 'segments', 'conn', 'MB/s',
+                                                                   'wall(s)', 'cpu(s)', 'rss(MB)'))
+    aid = 1
+    for pages in [int(x) for x in args.pages.split(',')]:
+        for segments in [int(x) for x in args.segments.split(',')]:
+            fake = FakeBilibili(pages, segments, parse_rate(args.size), args.latency, parse_rate(args.bandwidth),
+                                args.error_rate)
+            base_url = start_server(fake)
+            for connections in [int(x) for x in args.connections.split(',')]:
+                for engine in engines:
+                    runs = []
+                    for _ in range(max(1, args.repeat)):
+                        runs.append(run_case(engine, base_url, aid, connections, args.verbose, args.timeout))
+                        aid += 1  # 每次使用新的AV号，避免命中上一次的下载结果
+                    best = min(runs, key=lambda run: run['wall'])
+                    speed = best['bytes'] / 1024 / 1024 / best['wall'] if best['wall'] else 0
+                    # 多段拼接时第2段起去掉FLV文件头
+                    expected = pages * (len(fake.payload) * segments - FLV_HEADER_SIZE * (segments - 1))
+                    record = dict(best, engine=engine, pages=pages, segments=segments, connections=connections,
+                                  mb_per_second=speed, expected_bytes=expected)
+                    if args.json:
+                        print(json.dumps(record))
+                    else:
+                        rss = '{:.1f}'.format(best['peak_rss'] / 1024 / 1024) if best['peak_rss'] else '-'
+                        print('{:<30}{:>6}{:>9}{:>6}{:>10.2f}{:>9.2f}{:>9.2f}{:>10}'.format(
+                            engine, pages, segments, connections, speed, best['wall'], best['cpu'], rss))
+                        if best['error'] or best['bytes'] != record['expected_bytes']:
+                            print('  !! {} of {} bytes, error: {}'.format(best['bytes'], record['expected_bytes'],
+                                                                         best['error']))
+                    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
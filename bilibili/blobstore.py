@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 内容寻址存储：完成的分P按内容摘要只保存一份，并按cid+清晰度建立键，
+# 转载、合集和重复运行引用同一分P或同样的内容时，带标题的输出文件只是指向存储对象的硬链接、reflink或符号链接
+import os
+import time
+import errno
+import atexit
+import shutil
+import sqlite3
+import threading
+from progress import log
+from metrics import STORE_BYTES
+
+try:
+    import fcntl  # reflink只在Linux上通过FICLONE实现
+except ImportError:
+    fcntl = None
+
+STORE_FILE = '.bilibili_blobs.db'  # 键到摘要的映射，放在存储根目录中
+OBJECT_DIR = 'objects'  # 对象目录，对象路径为objects/摘要前2位/摘要
+FICLONE = 0x40049409  # linux/fs.h中的ioctl请求号
+
+HARDLINK = 'hardlink'  # 硬链接：不占额外空间，要求与下载目录在同一文件系统，修改任一路径的内容另一路径同样变化
+REFLINK = 'reflink'  # 写时复制的副本（Btrfs、XFS等），各自修改互不影响
+SYMLINK = 'symlink'  # 符号链接：可以跨文件系统，移动存储目录后链接失效
+LINK_MODES = (HARDLINK, REFLINK, SYMLINK)
+
+
+def page_key(cid, quality):
+    """
+    :param cid: 分P的cid
+    :param quality: 清晰度
+    :return: string 存储中分P的键
+    """
+    return '{}:{}'.format(cid, quality)
+
+
+def _reflink(src, dst):
+    """
+    :raise OSError: 平台或文件系统不支持
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, '当前平台不支持reflink')
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+class BlobStore:
+    """
+    对象文件写入后不再修改，只通过临时文件加os.replace出现，多个进程可以共用同一个存储
+    键的映射与下载索引一样保存在SQLite中，所有线程共用一个连接，通过锁串行访问
+    """
+
+    def __init__(self, root, mode=HARDLINK):
+        """
+        :param root: 存储根目录
+        :param mode: 输出文件的链接方式，见LINK_MODES；不支持时（例如跨文件系统）退回复制
+        :return None
+        """
+        if mode not in LINK_MODES:
+            raise ValueError('不支持的链接方式：{}'.format(mode))
+        self.root = os.path.abspath(root)
+        self.mode = mode
+        self._fallback_logged = False
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, OBJECT_DIR), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.root, STORE_FILE), timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS blob_keys (
+                                  key TEXT PRIMARY KEY,
+                                  hash TEXT NOT NULL,
+                                  updated REAL NOT NULL)''')
+
+    def object_path(self, digest):
+        """
+        :param digest: 内容摘要
+        :return: string 对象文件路径
+        """
+        return os.path.join(self.root, OBJECT_DIR, digest[:2], digest)
+
+    def find(self, key):
+        """
+        按键查找对象，对象文件已被删除时删除映射
+        :param key: page_key的返回值
+        :return: (摘要, 对象路径)，没有时返回None
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT hash FROM blob_keys WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        path = self.object_path(row[0])
+        if not os.path.isfile(path):
+            with self._lock:
+                self._conn.execute('DELETE FROM blob_keys WHERE key = ?', (key,))
+            return None
+        return row[0], path
+
+    def link(self, key, file_name):
+        """
+        下载之前调用：存储中已有该键时按链接方式在file_name处生成输出文件
+        :param key: page_key的返回值
+        :param file_name: 输出文件路径
+        :return: string 摘要，存储中没有时返回None
+        """
+        found = self.find(key)
+        if found is None:
+            return None
+        digest, path = found
+        try:
+            self._place(path, file_name, self.mode)
+        except OSError as e:
+            log('从内容存储链接[{}]失败：{}'.format(file_name, e))
+            return None
+        STORE_BYTES.inc(os.path.getsize(path), result='hit')
+        return digest
+
+    def ingest(self, file_name, digest, keys=()):
+        """
+        下载完成后调用：内容不在存储中时加入，已在存储中时把file_name换成指向对象的链接，释放重复的空间
+        :param file_name: 已完成的输出文件
+        :param digest: 文件内容的摘要（integrity.file_digest）
+        :param keys: 指向该内容的键
+        :return None
+        """
+        path = self.object_path(digest)
+        try:
+            existed = os.path.isfile(path)
+            if not existed:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 对象本身必须是真实文件；同一文件系统上硬链接不复制数据，reflink模式下为写时复制的副本
+                self._place(file_name, path, REFLINK if self.mode == REFLINK else HARDLINK)
+            if (existed or self.mode == SYMLINK) and not os.path.samefile(file_name, path):
+                size = os.path.getsize(file_name)
+                if self._place(path, file_name, self.mode) and existed:
+                    STORE_BYTES.inc(size, result='dedup')
+        except OSError as e:
+            log('视频[{}]加入内容存储失败：{}'.format(file_name, e))
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO blob_keys (key, hash, updated) VALUES (?, ?, ?)',
+                                   [(key, digest, now) for key in keys])
+
+    def _place(self, src, dst, mode):
+        """
+        在dst处生成src的链接或副本，先写临时路径再替换，dst已存在时原子地替换
+        :param src: 源文件
+        :param dst: 目标路径
+        :param mode: 链接方式
+        :return: bool 是否为链接，False表示退回了复制
+        """
+        temp_name = dst + '.link'
+        if os.path.lexists(temp_name):
+            os.remove(temp_name)
+        try:
+            if mode == HARDLINK:
+                os.link(src, temp_name)
+            elif mode == REFLINK:
+                _reflink(src, temp_name)
+            else:
+                os.symlink(os.path.abspath(src), temp_name)
+        except OSError as e:
+            if not self._fallback_logged:
+                self._fallback_logged = True
+                log('无法使用{}（{}），改为复制文件'.format(mode, e))
+            if os.path.lexists(temp_name):
+                os.remove(temp_name)
+            shutil.copyfile(src, temp_name)
+            os.replace(temp_name, dst)
+            return False
+        os.replace(temp_name, dst)
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_blob_store(root, mode=HARDLINK):
+    """
+    获取存储根目录对应的内容存储，同一进程内的所有线程共用，进程退出时关闭
+    :param root: 存储根目录
+    :param mode: 链接方式，只在首次创建时生效
+    :return: BlobStore
+    """
+    root = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = BlobStore(root, mode)
+            _stores[root] = store
+            atexit.register(store.close)
+        return store
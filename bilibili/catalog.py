@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 已完成下载的索引（SQLite）：每个分P一条记录(aid, cid, quality, path, size, hash)，放在下载目录中，
+# 续传时按(aid, cid)查找并核对文件大小，不必每P列出整个目录；可选按cid哈希分层存放，单个目录不会过大
+import os
+import time
+import atexit
+import hashlib
+import sqlite3
+import threading
+from integrity import file_digest, streamed_digest
+from progress import log
+
+INDEX_FILE = '.bilibili_index.db'  # 索引数据库的默认文件名，放在下载目录中
+SHARD_WIDTH = 2  # 分层目录名取cid哈希的前几位十六进制字符，2位即256个子目录
+SHARD_LEVELS = 1  # 分层的层数
+
+FLAT = 'flat'  # 所有文件直接放在下载目录中
+SHARDED = 'sharded'  # 按cid哈希放在子目录中
+
+
+def shard_of(cid, width=SHARD_WIDTH, levels=SHARD_LEVELS):
+    """
+    分P所在的子目录，只与cid有关，标题变化或重新运行时位置不变
+    :param cid: 分P的cid
+    :param width: 每层目录名的长度
+    :param levels: 层数
+    :return: string 相对下载目录的路径
+    """
+    digest = hashlib.sha1(str(cid).encode()).hexdigest()
+    return os.path.join(*[digest[i * width:(i + 1) * width] for i in range(levels)])
+
+
+class DownloadIndex:
+    """
+    所有线程共用一个连接，通过锁串行访问；每条记录用一条INSERT OR REPLACE写入，进程崩溃时不会留下半条记录
+    路径相对下载目录保存，整个目录移动后索引仍然有效
+    """
+
+    def __init__(self, directory, file_name=None, sharded=False):
+        """
+        :param directory: 下载目录
+        :param file_name: SQLite文件路径，默认为下载目录中的INDEX_FILE
+        :param sharded: 新建索引时是否按cid哈希分层，已有索引沿用其中记录的布局
+        :return None
+        """
+        self.directory = os.path.abspath(directory)
+        self.file_name = file_name or os.path.join(self.directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS downloads (
+                                  aid TEXT NOT NULL,
+                                  cid TEXT NOT NULL,
+                                  quality INTEGER,
+                                  path TEXT NOT NULL,
+                                  size INTEGER NOT NULL,
+                                  hash TEXT,
+                                  completed REAL NOT NULL,
+                                  PRIMARY KEY (aid, cid))''')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('layout', ?)",
+                           (SHARDED if sharded else FLAT,))
+        self.layout = self._conn.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()[0]
+        if sharded and self.layout != SHARDED:
+            log('下载目录[{}]已按{}布局存放，忽略分层设置'.format(self.directory, self.layout))
+
+    @property
+    def sharded(self):
+        return self.layout == SHARDED
+
+    def page_directory(self, cid):
+        """
+        分P的文件（包括临时文件和弹幕）所在目录，分层时按需创建
+        :param cid: 分P的cid
+        :return: string
+        """
+        if not self.sharded:
+            return self.directory
+        directory = os.path.join(self.directory, shard_of(cid))
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def lookup(self, aid, cid, file_name=None):
+        """
+        查找已完成的分P，记录的文件已被删除或大小不符时删除记录
+        :param aid: AV号
+        :param cid: 分P的cid
+        :param file_name: 预期的输出文件路径，没有记录但该文件存在时（建立索引之前下载的）补录，不计算摘要
+        :return: dict {'aid', 'cid', 'quality', 'path', 'size', 'hash'}，未完成时返回None
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT quality, path, size, hash FROM downloads WHERE aid = ? AND cid = ?',
+                                     (str(aid), str(cid))).fetchone()
+        if row is not None:
+            path = os.path.join(self.directory, row[1])
+            try:
+                if os.path.getsize(path) == row[2]:
+                    return {'aid': str(aid), 'cid': str(cid), 'quality': row[0], 'path': path, 'size': row[2],
+                            'hash': row[3]}
+            except OSError:
+                pass
+            self.remove(aid, cid)
+        if file_name is not None and os.path.isfile(file_name):
+            return self.record(aid, cid, file_name, digest=False)
+        return None
+
+    def record(self, aid, cid, file_name, quality=None, digest=True):
+        """
+        记录一个已完成的分P，同一分P已有相同路径和大小的记录时不重复计算摘要
+        :param aid: AV号
+        :param cid: 分P的cid
+        :param file_name: 输出文件路径
+        :param quality: 下载的清晰度
+        :param digest: 是否计算整个文件的摘要（优先使用下载时记录在清单中的摘要），也可以直接传入已知的摘要
+        :return: dict 同lookup，文件不存在时返回None
+        """
+        try:
+            size = os.path.getsize(file_name)
+            path = os.path.relpath(os.path.abspath(file_name), self.directory)
+            with self._lock:
+                row = self._conn.execute('SELECT path, size, hash, quality FROM downloads WHERE aid = ? AND cid = ?',
+                                         (str(aid), str(cid))).fetchone()
+            if isinstance(digest, str):
+                hash_ = digest
+            elif row is not None and row[0] == path and row[1] == size:  # 跳过的分P，补录的记录也不补算摘要
+                hash_ = row[2]
+                quality = quality if quality is not None else row[3]
+            else:
+                hash_ = (streamed_digest(file_name) or file_digest(file_name)) if digest else None
+        except OSError as e:
+            log('分P[{}]写入下载索引失败：{}'.format(cid, e))
+            return None
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO downloads (aid, cid, quality, path, size, hash, completed) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (str(aid), str(cid), quality, path, size, hash_, time.time()))
+        return {'aid': str(aid), 'cid': str(cid), 'quality': quality, 'path': os.path.join(self.directory, path),
+                'size': size, 'hash': hash_}
+
+    def remove(self, aid, cid):
+        with self._lock:
+            self._conn.execute('DELETE FROM downloads WHERE aid = ? AND cid = ?', (str(aid), str(cid)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_download_index(directory, sharded=False):
+    """
+    获取下载目录对应的索引，同一进程内的所有线程共用，进程退出时关闭
+    :param directory: 下载目录
+    :param sharded: 新建索引时是否按cid哈希分层
+    :return: DownloadIndex
+    """
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        if index is None:
+            os.makedirs(directory, exist_ok=True)
+            index = DownloadIndex(directory, sharded=sharded)
+            _indexes[directory] = index
+            atexit.register(index.close)
+        return index
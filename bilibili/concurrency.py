@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 按主机自适应调整并发数（AIMD：加性增、乘性减），取代按CPU核数估算并发量
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+API_HOSTS = ('api.bilibili.com', 'interface.bilibili.com', 'www.bilibili.com', 'space.bilibili.com',
+             'api.live.bilibili.com', 'api.vc.bilibili.com', 'comment.bilibili.cn')  # 接口主机，其余视为CDN主机
+THROTTLE_STATUS = (403, 429, 503)  # 表示被限流的状态码
+
+
+class AIMDLimiter:
+    """
+    单个主机的并发上限
+    每个统计窗口内总吞吐量仍在上升且没有出错时上限加1；
+    出错、被限流或首字节延迟明显上升时上限减半
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, window=2.0, latency_factor=2.0):
+        """
+        :param initial: 初始并发上限
+        :param minimum: 并发上限的下限
+        :param maximum: 并发上限的上限
+        :param window: 统计窗口（秒）
+        :param latency_factor: 延迟超过历史最低延迟的倍数时视为拥塞
+        :return None
+        """
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # [(loop, future), ...]
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_latency = []
+        self._window_failures = 0
+        self._last_throughput = 0.0
+        self._base_latency = None
+        self._last_decrease = 0
+
+    def _try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._cond:
+                    if (loop, future) in self._async_waiters:  # 尚未被唤醒，移出等待队列
+                        self._async_waiters.remove((loop, future))
+                    else:  # 唤醒已被调度但本协程不再需要，把空出的名额交给其他等待者
+                        self._wake()
+                raise
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        """唤醒等待中的线程和协程，调用时需持有锁"""
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self._cond.notify(free)
+        while self._async_waiters and free > 0:
+            loop, future = self._async_waiters.pop(0)
+            loop.call_soon_threadsafe(_set_future, future)
+            free -= 1
+
+    @contextmanager
+    def slot(self):
+        """
+        占用一个并发名额
+        with limiter.slot():
+            ...
+        """
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def success(self, size=0, latency=None):
+        """
+        报告一次成功的传输
+        :param size: 传输的字节数
+        :param latency: 首字节延迟（秒）
+        :return None
+        """
+        with self._cond:
+            self._window_bytes += size
+            if latency is not None:
+                self._window_latency.append(latency)
+                if self._base_latency is None or latency < self._base_latency:
+                    self._base_latency = latency
+            self._maybe_adjust()
+
+    def failure(self, status=None, size=0):
+        """
+        报告一次失败，立即乘性减小上限（同一窗口内只减一次，避免并发的失败连续减半）
+        失败也是一次采样：出错前收到的字节计入吞吐量，统计窗口照常结束，本窗口内不再加性增
+        :param status: HTTP状态码，连接错误时为None
+        :param size: 出错前已传输的字节数
+        :return None
+        """
+        with self._cond:
+            self._window_bytes += size
+            self._window_failures += 1
+            now = time.time()
+            # 被限流时以半个窗口为间隔继续减小，其他错误每个窗口只减一次
+            interval = self.window / 2 if status in THROTTLE_STATUS else self.window
+            if now - self._last_decrease >= interval:
+                self._decrease(now)
+            self._maybe_adjust()
+
+    def _decrease(self, now):
+        self.limit = max(self.minimum, self.limit // 2)
+        self._last_decrease = now
+        self._last_throughput = 0.0
+
+    def _maybe_adjust(self):
+        """统计窗口结束时根据吞吐量和延迟调整上限，调用时需持有锁"""
+        now = time.time()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        throughput = self._window_bytes / elapsed
+        latencies = sorted(self._window_latency)
+        median_latency = latencies[len(latencies) // 2] if latencies else None
+        if self._window_failures:
+            pass  # 本窗口出错时已在failure中减小过上限，不再按延迟减小，也不加性增
+        elif median_latency is not None and self._base_latency and \
+                median_latency > self._base_latency * self.latency_factor:
+            self._decrease(now)
+        elif throughput > self._last_throughput * 1.05 and self.in_flight >= int(self.limit):
+            # 只有名额用满时吞吐量上升才说明上限是瓶颈
+            self.limit = min(self.maximum, self.limit + 1)
+            self._wake()
+        self._last_throughput = max(self._last_throughput, throughput) if throughput else self._last_throughput
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_latency = []
+        self._window_failures = 0
+
+
+def _set_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ConcurrencyController:
+    """按主机管理AIMDLimiter，接口主机和CDN主机使用不同的初始值和上限"""
+
+    def __init__(self, api_budget=(2, 1, 8), cdn_budget=(4, 1, 32)):
+        """
+        :param api_budget: 接口主机的(初始并发, 最小并发, 最大并发)
+        :param cdn_budget: CDN主机的(初始并发, 最小并发, 最大并发)
+        :return None
+        """
+        self.api_budget = api_budget
+        self.cdn_budget = cdn_budget
+        self.limiters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_api_host(host):
+        return host in API_HOSTS
+
+    def for_url(self, url):
+        """
+        获取下载地址所在主机的并发控制器
+        :param url: 地址
+        :return: AIMDLimiter
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                initial, minimum, maximum = self.api_budget if self.is_api_host(host) else self.cdn_budget
+                limiter = AIMDLimiter(initial, minimum, maximum)
+                self.limiters[host] = limiter
+            return limiter
+
+    @property
+    def page_limit(self):
+        """
+        同时处理的分P数上限，真正的网络并发由各主机的AIMDLimiter控制，这里只限制等待中的线程/协程数量
+        :return: int
+        """
+        return self.cdn_budget[2]
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """
+    获取进程内共享的并发控制器
+    :return: ConcurrencyController
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = ConcurrencyController()
+        return _controller
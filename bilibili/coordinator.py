@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 多进程/多主机协作：以(aid, cid)为单位发放带过期时间的租约，持有者定期续约，
+# 进程或主机挂掉后租约过期，其他进程可以接手（窃取）这些分P
+import os
+import time
+import atexit
+import uuid
+import socket
+import sqlite3
+import asyncio
+import functools
+import threading
+from progress import log
+
+LEASE_FILE = '.bilibili_leases.db'  # 租约数据库的默认文件名，放在共享的下载目录中
+LEASE_TTL = 60  # 租约有效期（秒），持有者每LEASE_TTL/3秒续约一次
+POLL_INTERVAL = 5  # 等待其他进程持有的租约时的轮询间隔（秒）
+
+ACQUIRED = 'acquired'  # 已取得租约
+LEASED = 'leased'  # 由其他存活的进程持有
+DONE = 'done'  # 已由某个进程完成
+
+
+class LeaseCoordinator:
+    """
+    基于SQLite的租约协调器，多个进程（包括通过共享目录访问同一文件的多台主机）共用同一个数据库文件
+    租约过期时间由持有者的后台线程续约；持有者退出时释放未完成的租约，崩溃时等待过期
+    注意：NFS上的SQLite依赖文件锁，需要NFS服务端支持lockd（NFSv4默认支持）
+    """
+
+    def __init__(self, file_name=LEASE_FILE, owner=None, ttl=LEASE_TTL):
+        """
+        :param file_name: SQLite文件路径
+        :param owner: 持有者标识，默认为主机名:进程号:随机串
+        :param ttl: 租约有效期（秒）
+        :return None
+        """
+        self.file_name = file_name
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ttl = ttl
+        self._held = set()  # 本进程持有的(aid, cid)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                                  aid TEXT NOT NULL,
+                                  cid TEXT NOT NULL,
+                                  owner TEXT,
+                                  status TEXT NOT NULL,
+                                  expires REAL NOT NULL,
+                                  updated REAL NOT NULL,
+                                  PRIMARY KEY (aid, cid))''')
+
+    def _transaction(self, function, *args):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(*args)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return result
+
+    def _acquire(self, aid, cid, reopen):
+        now = time.time()
+        row = self._conn.execute('SELECT owner, status, expires, updated FROM leases WHERE aid = ? AND cid = ?',
+                                 (aid, cid)).fetchone()
+        if row is not None:
+            owner, status, expires, updated = row
+            if status == DONE and not (reopen and now - updated > self.ttl):
+                return DONE
+            if owner != self.owner and expires > now:
+                return LEASED
+        # 没有租约、租约已过期（持有者挂掉，在此窃取）、本来就由自己持有，或完成很久后文件已被删除
+        self._conn.execute('INSERT OR REPLACE INTO leases (aid, cid, owner, status, expires, updated) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', (aid, cid, self.owner, LEASED, now + self.ttl, now))
+        return ACQUIRED
+
+    def acquire(self, aid, cid, reopen=False):
+        """
+        尝试取得(aid, cid)的租约，同一进程内同样互斥：本进程已持有时也返回LEASED
+        :param aid: AV号
+        :param cid: 分P的cid
+        :param reopen: 调用方确认输出文件不存在时为True，完成超过ttl秒的租约视为文件已被删除，重新发放
+                       （不足ttl秒时可能只是共享目录的属性缓存还没有刷新）；
+                       也可以是返回该值的函数，每次尝试时在事务之外重新检查输出文件
+        :return: string ACQUIRED、LEASED或DONE
+        """
+        key = (str(aid), str(cid))
+        with self._lock:
+            if key in self._held:  # 数据库中的持有者按进程记录，本进程的其他线程或协程持有时在这里排除
+                return LEASED
+            self._held.add(key)  # 先占住，同一进程内并发的acquire不会都取得
+        status = None
+        try:
+            if callable(reopen):
+                reopen = reopen()
+            status = self._transaction(self._acquire, key[0], key[1], reopen)
+        finally:
+            if status != ACQUIRED:
+                with self._lock:
+                    self._held.discard(key)
+        if status == ACQUIRED:
+            self._start_heartbeat()
+        return status
+
+    def release(self, aid, cid, done=True):
+        """
+        释放租约
+        :param aid: AV号
+        :param cid: 分P的cid
+        :param done: 是否已完成，未完成时其他进程可以立即接手
+        :return None
+        """
+        key = (str(aid), str(cid))
+        with self._lock:
+            self._held.discard(key)
+            if done:
+                self._conn.execute('UPDATE leases SET status = ?, owner = NULL, updated = ? '
+                                   'WHERE aid = ? AND cid = ? AND owner = ?',
+                                   (DONE, time.time()) + key + (self.owner,))
+            else:
+                self._conn.execute('DELETE FROM leases WHERE aid = ? AND cid = ? AND owner = ?',
+                                   key + (self.owner,))
+
+    def wait(self, aid, cid, reopen=False, poll=POLL_INTERVAL):
+        """
+        阻塞直到取得租约（持有者挂掉后窃取）或该分P已被其他进程完成
+        :param aid: AV号
+        :param cid: 分P的cid
+        :param reopen: 见acquire
+        :param poll: 轮询间隔（秒）
+        :return: bool 取得租约时返回True，已完成时返回False
+        """
+        while True:
+            status = self.acquire(aid, cid, reopen)
+            if status != LEASED:
+                return status == ACQUIRED
+            time.sleep(poll)
+
+    async def wait_async(self, aid, cid, reopen=False, poll=POLL_INTERVAL):
+        """
+        wait的协程版本
+        :return: bool
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            status = await loop.run_in_executor(None, self.acquire, aid, cid, reopen)
+            if status != LEASED:
+                return status == ACQUIRED
+            await asyncio.sleep(poll)
+
+    def schedule(self, items, reopen=False, poll=POLL_INTERVAL):
+        """
+        按顺序处理一组分P：空闲的立即交给调用方，被其他进程持有的先跳过，
+        处理完其余分P后再轮询这些分P，持有者挂掉则窃取，直到全部完成或取得
+        :param items: [(aid, cid, 任意附加数据), ...]
+        :param reopen: 见acquire，为函数时以附加数据为参数，逐个分P检查输出文件
+        :param poll: 轮询间隔（秒）
+        :return: 生成器，产出已取得租约的附加数据，调用方处理完后需调用release
+        """
+        pending = list(items)
+        while pending:
+            deferred = []
+            for aid, cid, payload in pending:
+                status = self.acquire(aid, cid, functools.partial(reopen, payload) if callable(reopen) else reopen)
+                if status == ACQUIRED:
+                    yield payload
+                elif status == LEASED:
+                    deferred.append((aid, cid, payload))
+            pending = deferred
+            if pending:
+                time.sleep(poll)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+                self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held)
+                if not held:
+                    continue
+                now = time.time()
+                try:
+                    self._conn.executemany('UPDATE leases SET expires = ?, updated = ? '
+                                           'WHERE aid = ? AND cid = ? AND owner = ?',
+                                           [(now + self.ttl, now, aid, cid, self.owner) for aid, cid in held])
+                except sqlite3.Error as e:  # 数据库暂时不可用时等下一次续约，租约过期前恢复即可
+                    log('租约续约失败：{}'.format(e))
+
+    def close(self):
+        """
+        停止续约并释放本进程持有的全部未完成租约
+        :return None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            held = list(self._held)
+        for aid, cid in held:
+            self.release(aid, cid, done=False)
+        with self._lock:
+            self._conn.close()
+
+
+_coordinators = {}
+_coordinators_lock = threading.Lock()
+
+
+def get_coordinator(directory):
+    """
+    获取下载目录对应的租约协调器，同一进程内的所有线程共用，进程退出时释放未完成的租约
+    :param directory: 下载目录（多台主机共享）
+    :return: LeaseCoordinator
+    """
+    file_name = os.path.abspath(os.path.join(directory, LEASE_FILE))
+    with _coordinators_lock:
+        coordinator = _coordinators.get(file_name)
+        if coordinator is None:
+            os.makedirs(directory, exist_ok=True)
+            coordinator = LeaseCoordinator(file_name)
+            _coordinators[file_name] = coordinator
+            atexit.register(coordinator.close)
+        return coordinator
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# DASH流处理：playurl返回的dash块中视频和音频是分开的两条轨道，选出要下载的表示（representation），
+# 两条轨道同时下载后用ffmpeg封装进同一个MP4
+VIDEO = 'video'
+AUDIO = 'audio'
+TRACK_SUFFIXES = ((VIDEO, '.video.m4s'), (AUDIO, '.audio.m4s'))  # 轨道临时文件后缀，按ffmpeg输入顺序
+OUTPUT_SUFFIX = '.mp4'  # 封装后的文件后缀
+CODEC_PREFERENCE = (7, 12, 13)  # 同一清晰度有多种编码时的优先顺序：AVC、HEVC、AV1，AVC的播放器兼容性最好
+
+
+def _mirrors(stream):
+    """
+    表示的所有镜像地址，新旧接口的键名分别为baseUrl/backupUrl和base_url/backup_url
+    :param stream: dash块中的一个表示
+    :return: list [url, backup_url...]
+    """
+    url = stream.get('baseUrl') or stream.get('base_url')
+    backup = stream.get('backupUrl') or stream.get('backup_url') or []
+    return [url] + [u for u in backup if u and u != url]
+
+
+def _codec_rank(stream):
+    codec = stream.get('codecid')
+    return CODEC_PREFERENCE.index(codec) if codec in CODEC_PREFERENCE else len(CODEC_PREFERENCE)
+
+
+def select_streams(dash, quality=None):
+    """
+    选出要下载的视频和音频表示
+    视频取不超过quality的最高清晰度，同一清晰度按CODEC_PREFERENCE选编码，再取码率最高的；音频取码率最高的
+    :param dash: playurl返回的dash块
+    :param quality: 期望的清晰度（qn），None表示最高
+    :return: dict {VIDEO: [url, backup_url...], AUDIO: [url, backup_url...]}，没有音频时不含AUDIO，
+             没有可用的视频时返回None
+    """
+    videos = [v for v in dash.get('video') or [] if v.get('baseUrl') or v.get('base_url')]
+    if quality is not None and any(v.get('id', 0) <= quality for v in videos):
+        videos = [v for v in videos if v.get('id', 0) <= quality]
+    if not videos:
+        return None
+    video = min(videos, key=lambda v: (-v.get('id', 0), _codec_rank(v), -v.get('bandwidth', 0)))
+    streams = {VIDEO: _mirrors(video)}
+    audios = [a for a in dash.get('audio') or [] if a.get('baseUrl') or a.get('base_url')]
+    if audios:
+        streams[AUDIO] = _mirrors(max(audios, key=lambda a: a.get('bandwidth', 0)))
+    return streams
+
+
+def track_files(title, streams):
+    """
+    各轨道的临时文件名
+    :param title: 视频标题
+    :param streams: select_streams的返回值
+    :return: list [(文件名, 镜像地址列表), ...]，按ffmpeg输入顺序
+    """
+    return [(title + suffix, streams[kind]) for kind, suffix in TRACK_SUFFIXES if kind in streams]
@@ -0,0 +1,1114 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 基于HTTP Range请求的多连接分段下载
+import os
+import json
+import time
+import asyncio
+import hashlib
+import aiohttp
+import functools
+import threading
+from contextlib import closing
+from writer import FileWriter, RangeBuffer
+from mirror import get_scoreboard
+from concurrency import get_controller
+from ratelimit import get_bucket, throttle, throttle_async
+from flv import FLV_HEADER_SIZE, TimestampError, concat_timestamps, is_flv_url
+from progress import log
+from metrics import DOWNLOAD_BYTES, FIRST_BYTE_SECONDS, SEGMENT_SECONDS, RETRIES, HEDGES, host_of
+from retry import RETRY_ATTEMPTS, HEDGE_THRESHOLD, HEDGE_MIN_SIZE, HEDGE_INTERVAL, StallError, HedgeCancelled, \
+    DownloadError, SpeedWatchdog, sleep_backoff, sleep_backoff_async
+from integrity import HASH_ALGORITHM, VERIFY_ATTEMPTS, IntegrityError, StreamVerifier, check_flv_file, \
+    rehash_pieces, write_manifest
+
+PART_SUFFIX = '.part'  # 未完成下载的数据文件后缀
+STATE_SUFFIX = '.part.json'  # 记录已完成字节区间的进度文件后缀
+ORIGINAL = 'original'  # 区间的原请求
+HEDGE = 'hedge'  # 区间的对冲请求
+# 单次区间请求的最大字节数：每条连接依次请求不超过该大小的区间，每个区间结束时向AIMD控制器报告一次并重新取得名额，
+# 只有一个连接的大文件也能在下载过程中按并发上限的调整放缓或加快
+MAX_RANGE_SIZE = 8 * 1024 * 1024
+
+
+def split_ranges(content_size, connections, min_range_size=1024 * 1024):
+    """
+    将文件按字节切分为若干区间
+    :param content_size: 文件总大小
+    :param connections: 期望的连接数
+    :param min_range_size: 单个区间的最小字节数，避免小文件被切得过碎
+    :return: list [(start, end), ...]，end为闭区间
+    """
+    if content_size <= 0:
+        return []
+    return split_gaps([(0, content_size - 1)], connections, min_range_size)
+
+
+def split_gaps(gaps, connections, min_range_size=1024 * 1024):
+    """
+    将若干待下载的字节区间再切分，使总区间数接近连接数
+    :param gaps: list [(start, end), ...]，end为闭区间
+    :param connections: 期望的连接数
+    :param min_range_size: 单个区间的最小字节数
+    :return: list [(start, end), ...]
+    """
+    total = sum(end - start + 1 for start, end in gaps)
+    if total <= 0:
+        return []
+    step = max(min_range_size, -(-total // max(1, connections)))  # 向上取整
+    ranges = []
+    for start, end in gaps:
+        length = end - start + 1
+        count = max(1, length // step)
+        size = length // count
+        for i in range(count):
+            begin = start + i * size
+            ranges.append((begin, end if i == count - 1 else begin + size - 1))
+    return ranges
+
+
+def split_range(start, end, max_size=MAX_RANGE_SIZE):
+    """
+    将一个字节区间按顺序切成不超过max_size的若干相接的区间
+    :param start: 起始字节
+    :param end: 结束字节（包含）
+    :param max_size: 单个区间的最大字节数
+    :return: list [(start, end), ...]
+    """
+    return [(begin, min(end, begin + max_size - 1)) for begin in range(start, end + 1, max_size)]
+
+
+class PartState:
+    """
+    断点续传状态，视频先写入file_name.part，已完成的字节区间及其分块摘要记录在file_name.part.json中，
+    重新下载时只请求缺失的区间，全部完成并通过校验后原子重命名为file_name
+    """
+
+    save_interval = 1.0  # 进度文件最短保存间隔（秒）
+
+    def __init__(self, file_name, content_size):
+        """
+        :param file_name: 最终的文件路径
+        :param content_size: 文件总大小
+        :return None
+        """
+        self.file_name = file_name
+        self.part_name = file_name + PART_SUFFIX
+        self.state_name = file_name + STATE_SUFFIX
+        self.content_size = content_size
+        self.done = []  # 已完成的字节区间，[[start, end], ...]，end为闭区间，按start有序且互不重叠
+        self.pieces = []  # 已写入的分块摘要，[[start, end, digest], ...]
+        self.extra = {}  # 与进度一起保存的其他状态
+        self._lock = threading.Lock()
+        self._saved_at = 0
+        self.load()
+
+    def load(self):
+        """
+        读取进度文件，文件大小不一致或数据文件不存在时视为重新下载
+        :return None
+        """
+        try:
+            with open(self.state_name, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get('content_size') == self.content_size and os.path.exists(self.part_name):
+            self.done = [list(x) for x in state.get('done', [])]
+            self.pieces = state.get('pieces', [])
+            self.extra = state.get('extra', {})
+
+    def save(self, force=True):
+        """
+        写入进度文件，先写临时文件再替换，避免中断时进度文件损坏
+        :param force: False时距上次保存不足save_interval秒则跳过
+        :return None
+        """
+        with self._lock:
+            now = time.time()
+            if not force and now - self._saved_at < self.save_interval:
+                return
+            self._saved_at = now
+            temp_name = self.state_name + '.tmp'
+            with open(temp_name, 'w') as f:
+                json.dump({'content_size': self.content_size, 'done': self.done, 'pieces': self.pieces,
+                           'extra': self.extra}, f)
+            os.replace(temp_name, self.state_name)
+
+    def add(self, start, end, digest=None):
+        """
+        记录[start, end]区间已写入文件，并与相邻区间合并
+        :param start: 起始字节
+        :param end: 结束字节（包含）
+        :param digest: 该区间的摘要
+        :return None
+        """
+        with self._lock:
+            if digest is not None:
+                self.pieces.append([start, end, digest])
+            merged = []
+            for s, e in self.done:
+                if e + 1 < start or s > end + 1:
+                    merged.append([s, e])
+                else:
+                    start, end = min(s, start), max(e, end)
+            merged.append([start, end])
+            merged.sort()
+            self.done = merged
+
+    def remove(self, start, end):
+        """
+        把[start, end]区间标记为未下载，用于重新下载校验失败的分段
+        :param start: 起始字节
+        :param end: 结束字节（包含）
+        :return None
+        """
+        with self._lock:
+            done = []
+            for s, e in self.done:
+                if s < start:
+                    done.append([s, min(e, start - 1)])
+                if e > end:
+                    done.append([max(s, end + 1), e])
+            self.done = done
+            self.pieces = [x for x in self.pieces if x[1] < start or x[0] > end]
+
+    def discard(self):
+        """
+        丢弃已下载的数据和进度，从头重新下载
+        :return None
+        """
+        with self._lock:
+            self.done = []
+            self.pieces = []
+            self.extra = {}
+        if os.path.exists(self.part_name):
+            os.remove(self.part_name)
+        discard_state(self.file_name)
+
+    @property
+    def completed(self):
+        """
+        已完成的字节数
+        :return: int
+        """
+        with self._lock:
+            return sum(e - s + 1 for s, e in self.done)
+
+    def missing(self):
+        """
+        缺失的字节区间
+        :return: list [(start, end), ...]
+        """
+        gaps = []
+        position = 0
+        with self._lock:
+            for s, e in self.done:
+                if s > position:
+                    gaps.append((position, s - 1))
+                position = max(position, e + 1)
+        if position < self.content_size:
+            gaps.append((position, self.content_size - 1))
+        return gaps
+
+    def commit(self, **result):
+        """
+        下载完成，写入校验清单，将.part文件原子重命名为最终文件并删除进度文件
+        :param result: 写入清单的其他校验结果
+        :return None
+        """
+        write_manifest(self.file_name, self.content_size, self.pieces, **result)
+        os.replace(self.part_name, self.file_name)
+        discard_state(self.file_name)
+
+
+def discard_state(file_name):
+    """
+    删除指定文件对应的进度文件（如果存在）
+    :param file_name: 最终的文件路径
+    :return None
+    """
+    for name in (file_name + STATE_SUFFIX, file_name + STATE_SUFFIX + '.tmp'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def is_completed(file_name):
+    """
+    判断分段是否已在之前的运行中下载完成：最终文件存在即表示已完成，因为只有完成后才会从.part重命名
+    :param file_name: 最终的文件路径
+    :return: bool
+    """
+    if os.path.exists(file_name):
+        discard_state(file_name)
+        return True
+    return False
+
+
+async def _buffer_call(function, *args):
+    """
+    在线程池中执行RangeBuffer的写入或提交
+    协程被取消时先等线程池中的这次调用结束再抛出CancelledError，之后缓冲区不再被线程池使用，可以安全地归还
+    :param function: buffer.write或buffer.flush
+    :param args: 参数
+    :return: function的返回值
+    """
+    future = asyncio.get_event_loop().run_in_executor(None, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+async def write_async(buffer: RangeBuffer, chunks, flush=True, bucket=None, progress=None, watchdog=None):
+    """
+    在协程中把异步迭代得到的数据块写入RangeBuffer，只有需要取新缓冲区或提交时才切换到线程池，
+    避免每个数据块都经过一次线程池
+    :param buffer: RangeBuffer对象
+    :param chunks: 异步迭代器，例如response.content.iter_chunked()
+    :param flush: 结束时是否提交缓冲区中剩余的数据
+    :param bucket: 单个任务的令牌桶，与全局令牌桶共同限速
+    :param progress: 进度计数（progress.ProgressTask）
+    :param watchdog: 最低速度看门狗（retry.SpeedWatchdog），停滞或被取消时抛出异常
+    :return None
+    """
+    async for data in chunks:
+        delay = await throttle_async(len(data), get_bucket(), bucket)
+        if watchdog is not None:
+            watchdog.update(len(data), delay)
+        if progress is not None:
+            progress.update(len(data))
+        if buffer.needs_flush(len(data)):
+            await _buffer_call(buffer.write, data)
+        else:
+            buffer.write(data)
+    if flush:
+        await _buffer_call(buffer.flush)
+
+
+def _parse_range_support(headers):
+    """
+    根据响应头判断服务器是否支持Range请求并返回文件大小
+    :param headers: 响应头
+    :return: int or None 支持时返回文件大小，否则返回None
+    """
+    if headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    try:
+        return int(headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _check_partial_response(status, headers, content_size, start, end):
+    """
+    检查区间请求的响应，不同镜像的文件大小不一致时视为出错
+    :param status: 状态码
+    :param headers: 响应头
+    :param content_size: 期望的文件大小
+    :param start: 起始字节
+    :param end: 结束字节（包含）
+    :return None
+    """
+    if status != 206:
+        raise IOError('区间[{}-{}]请求失败，状态码{}'.format(start, end, status))
+    total = headers.get('Content-Range', '').rpartition('/')[2]
+    if total.isdigit() and int(total) != content_size:
+        raise IOError('区间[{}-{}]的文件大小{}与预期{}不一致'.format(start, end, total, content_size))
+
+
+def _mirror_order(mirrors, index):
+    """
+    第index个区间使用的镜像顺序：按得分排序后从第index个镜像开始轮转，使各区间分摊到不同镜像，
+    出错时依次切换到后面的镜像
+    :param mirrors: 已按得分排序的下载地址
+    :param index: 区间下标
+    :return: list
+    """
+    index %= len(mirrors)
+    return mirrors[index:] + mirrors[:index]
+
+
+class RangeTask:
+    """
+    一个字节区间的下载任务
+    尾部对冲时区间的剩余部分由原请求和对冲请求同时下载：对冲起点之后写入的分块先分别暂存，
+    先完成的一方的分块记入进度，另一方在收到下一块数据时停止并丢弃其分块（两方写入文件的字节相同）
+    """
+
+    def __init__(self, downloader, start, end, index=0):
+        """
+        :param downloader: 所属的区间下载器
+        :param start: 起始字节
+        :param end: 结束字节（包含）
+        :param index: 区间下标，用于选择镜像
+        :return None
+        """
+        self.downloader = downloader
+        self.start = start
+        self.end = end
+        self.index = index
+        self.buffer = None  # 原请求的RangeBuffer
+        self.hedge_start = None  # 对冲起点
+        self.winner = None  # 先完成的一方
+        self._running = {ORIGINAL}
+        self._pending = {ORIGINAL: [], HEDGE: []}  # 对冲起点之后暂存的分块
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        """
+        原请求尚未收到的字节数
+        :return: int
+        """
+        buffer = self.buffer
+        return self.end + 1 - (buffer.position if buffer is not None else self.start)
+
+    def record(self, side, offset, length, digest=None):
+        """
+        写线程写入一段数据后的回调
+        :param side: ORIGINAL或HEDGE
+        :return None
+        """
+        with self._lock:
+            if self.hedge_start is None or offset < self.hedge_start or self.winner == side:
+                self.downloader._on_written(offset, length, digest)
+            elif self.winner is None:
+                self._pending[side].append((offset, length, digest))
+
+    def start_hedge(self):
+        """
+        开始对冲，对冲起点为原请求下一个要提交的缓冲区的起点（之前的分块都已提交给写线程）
+        :return: int 对冲起点，已对冲或已完成时返回None
+        """
+        with self._lock:
+            if self.hedge_start is not None or self.winner is not None:
+                return None
+            self.hedge_start = self.buffer.offset if self.buffer is not None else self.start
+            self._running.add(HEDGE)
+            return self.hedge_start
+
+    def cancelled(self, side):
+        return self.winner is not None and self.winner != side
+
+    def finish(self, side, error=None):
+        """
+        一方结束下载
+        :param side: ORIGINAL或HEDGE
+        :param error: 出错时的异常
+        :return: bool 是否应把error作为整个区间的错误（另一方也已失败）
+        """
+        with self._lock:
+            self._running.discard(side)
+            if self.winner is not None:
+                return False
+            if error is not None and self._running:  # 另一方仍在下载
+                return False
+            # 先成功的一方胜出；两方都失败时保留原请求已收到的数据，下次从断点继续
+            self.winner = side if error is None else ORIGINAL
+            for item in self._pending[self.winner]:
+                self.downloader._on_written(*item)
+            self._pending = {ORIGINAL: [], HEDGE: []}
+        if error is None and side == HEDGE:
+            HEDGES.inc(result='won')
+        return error is not None
+
+
+class BaseRangeDownloader:
+    """
+    区间下载器的公共部分
+    下载的字节可以写到另一个文件的指定位置：源文件从第skip字节开始的内容写到输出文件的offset处，
+    多个分段因此可以直接拼接进同一个输出文件，见ConcatDownloader
+    """
+
+    chunk_size = 256 * 1024
+    max_range_size = MAX_RANGE_SIZE
+
+    def __init__(self, session, download_url, file_name, headers=None, connections=4, scoreboard=None, bucket=None,
+                 offset=0, skip=0, progress=None):
+        """
+        :param session: requests.Session或aiohttp.ClientSession对象
+        :param download_url: 视频下载地址，或同一分段的多个镜像地址列表
+        :param file_name: 保存的文件路径
+        :param headers: 请求头
+        :param connections: 并行连接数
+        :param scoreboard: 镜像测速记录，默认使用进程内共享的记录
+        :param bucket: 单个任务的令牌桶，与全局令牌桶共同限速
+        :param offset: 写入输出文件的起始位置
+        :param skip: 跳过源文件开头的字节数
+        :param progress: 进度计数（progress.ProgressTask），多个分段可共用一个
+        :return None
+        """
+        self.session = session
+        self.mirrors = [download_url] if isinstance(download_url, str) else list(download_url)
+        self.download_url = self.mirrors[0]
+        self.file_name = file_name
+        self.headers = dict(headers or {})
+        self.connections = connections
+        self.scoreboard = scoreboard or get_scoreboard()
+        self.bucket = bucket
+        self.offset = offset
+        self.skip = skip
+        self.progress = progress
+        self.content_size = None  # 源文件大小
+        self.size = 0
+        self.state = None
+        self.content_digest = None  # 整个文件由一条连接从头下载到尾时边下载边计算的摘要，写入校验清单
+        self._content = None  # 计算中的整个文件的摘要
+        self._content_end = 0  # 已计入摘要的原请求覆盖到的位置
+        self._size_lock = threading.Lock()
+        self._errors = []
+
+    @property
+    def output_size(self):
+        """
+        写入输出文件的字节数
+        :return: int
+        """
+        return self.content_size - self.skip
+
+    def _source_range(self, start, end):
+        """
+        输出文件中的区间对应的源文件区间
+        :return: tuple (start, end)
+        """
+        return start - self.offset + self.skip, end - self.offset + self.skip
+
+    def _missing_ranges(self):
+        """
+        本分段在输出文件中尚未完成的区间，按连接数切分
+        :return: list [(start, end), ...]
+        """
+        first, last = self.offset, self.offset + self.output_size - 1
+        gaps = [(max(start, first), min(end, last)) for start, end in self.state.missing()
+                if end >= first and start <= last]
+        return split_gaps(gaps, self.connections)
+
+    def _on_written(self, offset, length, digest=None):
+        """
+        写线程写入一段数据后记录进度
+        :param offset: 文件偏移
+        :param length: 写入的字节数
+        :param digest: 这段数据的摘要
+        :return None
+        """
+        self.state.add(offset, offset + length - 1, digest)
+        self.state.save(force=False)
+        with self._size_lock:
+            self.size += length
+
+    def _new_lanes(self):
+        """
+        按缺失的区间生成下载任务，每条连接一组相接的区间，依次请求，每个区间不超过max_range_size
+        从文件开头只用一条连接下载时，顺带计算整个文件的摘要（断点续传和拼接中的分段除外）
+        :return: list [[RangeTask, ...], ...]
+        """
+        lanes = [[RangeTask(self, begin, end_, i) for begin, end_ in split_range(start, end, self.max_range_size)]
+                 for i, (start, end) in enumerate(self._missing_ranges())]
+        whole = len(lanes) == 1 and self.offset == 0 and self.output_size == self.state.content_size and \
+            not self.state.completed
+        self._content = hashlib.new(HASH_ALGORITHM) if whole else None
+        self._content_end = 0
+        return lanes
+
+    def _start_hedges(self, tasks):
+        """
+        区间总体完成到HEDGE_THRESHOLD后，对仍在下载且剩余较多的区间开始对冲
+        :param tasks: RangeTask列表
+        :return: list [(task, 对冲起点), ...]
+        """
+        total = sum(task.end + 1 - task.start for task in tasks)
+        remaining = sum(max(0, task.remaining) for task in tasks if task.winner is None)
+        if not total or remaining > total * (1 - HEDGE_THRESHOLD):
+            return []
+        hedges = []
+        for task in tasks:
+            # 还没开始的区间由所在的连接稍后下载，不对冲
+            if task.buffer is not None and task.winner is None and task.remaining >= HEDGE_MIN_SIZE:
+                start = task.start_hedge()
+                if start is not None:
+                    HEDGES.inc(result='issued')
+                    hedges.append((task, start))
+        return hedges
+
+    def _range_buffer(self, writer, task, side, start):
+        content = None
+        if side == ORIGINAL and self._content is not None and start == self._content_end:
+            content = self._content  # 同一条连接上相接的区间接着计算整个文件的摘要
+            self._content_end = task.end + 1
+        verifier = StreamVerifier(start, content=content)
+        buffer = RangeBuffer(writer, start, functools.partial(task.record, side), verifier)
+        if side == ORIGINAL:
+            task.buffer = buffer
+        # 对冲请求从下一个镜像开始，避开原请求所在的慢镜像
+        return buffer, _mirror_order(self.mirrors, task.index + (1 if side == HEDGE else 0))
+
+    def _streamed_digest(self, tasks):
+        """
+        所有区间结束后取出边下载边计算的整个文件的摘要
+        :param tasks: RangeTask列表
+        :return: string，多连接、断点续传或对冲请求胜出时返回None
+        """
+        if self._content is None or self._content_end != self.state.content_size or \
+                any(task.winner != ORIGINAL for task in tasks):
+            return None
+        return self._content.hexdigest()
+
+    @staticmethod
+    def _retry_reason(error):
+        return 'stall' if isinstance(error, StallError) else 'retry'
+
+    def _headers_for(self, start, end):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={}-{}'.format(start, end)
+        headers['Accept-Encoding'] = 'identity'  # 压缩后的偏移与文件偏移不一致
+        return headers
+
+    def _reset_progress(self, total, done):
+        """
+        开始一轮下载时设置进度的总字节数和已完成的字节数（断点续传或校验失败后重新下载）
+        :return None
+        """
+        if self.progress is not None:
+            self.progress.total = total
+            self.progress.reset(done)
+
+    def verify(self, state):
+        """
+        所有区间下载完成后检查FLV分帧（区间乱序到达，只能在写盘后通过mmap检查标签头）
+        :param state: PartState对象
+        :return: dict 写入清单的校验结果
+        """
+        result = {}
+        if self.content_digest is not None:
+            result['content_digest'] = self.content_digest
+        if is_flv_url(self.download_url):
+            result['flv_tags'] = check_flv_file(state.part_name)[0]
+        return result
+
+
+class RangeDownloader(BaseRangeDownloader):
+    """
+    对单个视频分段发起HEAD请求，按字节区间切分后用多个连接并行下载
+    分段有多个镜像时，各区间轮流分配到按测速得分排序的镜像上，某个镜像出错或停滞时，
+    该区间剩余的字节切换到下一个镜像继续下载，不必重新下载整个分段
+    """
+
+    timeout = (10, 30)  # 连接超时和读取超时（秒），读取超过30秒没有数据视为停滞
+
+    def probe(self):
+        """
+        HEAD请求获取文件大小，按得分依次尝试各镜像，均不支持Range时返回None
+        :return: int or None
+        """
+        self.mirrors = self.scoreboard.rank(self.mirrors)
+        for url in self.mirrors:
+            try:
+                response = self.session.head(url, headers=self.headers, allow_redirects=True, verify=False,
+                                             timeout=self.timeout)
+            except Exception:
+                self.scoreboard.record_error(url)
+                continue
+            if response.status_code == 200:
+                self.content_size = _parse_range_support(response.headers)
+                if self.content_size is not None:
+                    self.download_url = url
+                    return self.content_size
+            else:
+                self.scoreboard.record_error(url)
+        return None
+
+    def _fetch(self, url, buffer, end, watchdog=None):
+        """
+        从指定镜像下载输出文件中的[buffer.position, end]区间
+        :param url: 镜像地址
+        :param buffer: RangeBuffer对象
+        :param end: 结束字节（包含）
+        :param watchdog: 最低速度看门狗
+        :return None
+        """
+        start, source_end = self._source_range(buffer.position, end)
+        position = buffer.position
+        limiter = get_controller().for_url(url)
+        status = None
+        with limiter.slot():  # 同一主机的并发数由AIMD控制器决定
+            try:
+                begin = time.time()
+                with closing(self.session.get(url, headers=self._headers_for(start, source_end), stream=True,
+                                              verify=False, timeout=self.timeout)) as response:
+                    latency = time.time() - begin
+                    FIRST_BYTE_SECONDS.observe(latency, host=host_of(url))
+                    status = response.status_code
+                    _check_partial_response(status, response.headers, self.content_size, start, source_end)
+                    for data in response.iter_content(chunk_size=self.chunk_size):
+                        delay = throttle(len(data), get_bucket(), self.bucket)
+                        if watchdog is not None:
+                            watchdog.update(len(data), delay)
+                        if self.progress is not None:
+                            self.progress.update(len(data))
+                        buffer.write(data)
+                if buffer.position != end + 1:
+                    raise IOError('区间[{}-{}]数据不完整'.format(start, source_end))
+            except HedgeCancelled:
+                raise
+            except Exception:
+                limiter.failure(status, buffer.position - position)
+                raise
+            finally:
+                DOWNLOAD_BYTES.inc(buffer.position - position, host=host_of(url))
+            limiter.success(source_end + 1 - start, latency)
+        self.scoreboard.record(url, source_end + 1 - start, time.time() - begin)
+
+    def _download_range(self, writer, task, side=ORIGINAL, start=None):
+        """
+        下载任务的[start, task.end]区间并交给写线程写入文件对应位置
+        出错或停滞时切换镜像续传，所有镜像都试过一轮后按指数退避等待，总共尝试RETRY_ATTEMPTS次
+        :param writer: FileWriter对象
+        :param task: RangeTask对象
+        :param side: ORIGINAL或HEDGE
+        :param start: 起始字节，默认为task.start
+        :return None
+        """
+        buffer, mirrors = self._range_buffer(writer, task, side, task.start if start is None else start)
+        watchdog = SpeedWatchdog(cancelled=lambda: task.cancelled(side))
+        error = None
+        for attempt in range(RETRY_ATTEMPTS):
+            if attempt and attempt % len(mirrors) == 0:
+                sleep_backoff(attempt // len(mirrors) - 1)
+            url = mirrors[attempt % len(mirrors)]
+            try:
+                self._fetch(url, buffer, task.end, watchdog)
+                error = None
+                break
+            except HedgeCancelled:
+                buffer.discard()  # 另一方已完成，剩余数据不再需要
+                task.finish(side, None)
+                return
+            except Exception as e:
+                error = e
+                self.scoreboard.record_error(url)
+                RETRIES.inc(reason=self._retry_reason(e))
+        buffer.flush()  # 出错时已收到的数据仍然有效，写入后记录到进度文件
+        if task.finish(side, error):
+            self._errors.append(error)
+
+    def _download_lane(self, writer, lane):
+        """
+        一条连接依次下载一组相接的区间，每个区间单独请求
+        :param writer: FileWriter对象
+        :param lane: RangeTask列表
+        :return None
+        """
+        for task in lane:
+            if self._errors:  # 本次下载已不会完整，剩下的区间留给下次断点续传
+                return
+            self._download_range(writer, task)
+
+    def download_into(self, writer, state):
+        """
+        把本分段缺失的区间下载到共享的输出文件中，不负责重命名
+        区间总体接近完成时，对剩余较多的区间向另一个镜像发出对冲请求，先完成的一方生效
+        :param writer: 输出文件的FileWriter对象
+        :param state: 输出文件的PartState对象
+        :return: bool 本分段是否完整下载
+        :raise DownloadError: 某个区间的重试次数用完仍然失败，已收到的数据仍记录在进度中
+        """
+        self.state = state
+        self.content_digest = None
+        begin = time.time()
+        lanes = self._new_lanes()
+        tasks = [task for lane in lanes for task in lane]
+        writer.pool.reserve(2 * len(lanes))  # 每条连接同时最多有原请求和一个对冲请求在填充缓冲区
+        threads = [threading.Thread(target=self._download_lane, args=(writer, lane)) for lane in lanes]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(HEDGE_INTERVAL)
+                if thread.is_alive():
+                    break
+            if self.connections > 1 or len(self.mirrors) > 1:  # 单连接单镜像时不额外增加连接
+                for task, start in self._start_hedges(tasks):
+                    thread = threading.Thread(target=self._download_range, args=(writer, task, HEDGE, start))
+                    thread.start()
+                    threads.append(thread)
+        if self._errors:
+            raise DownloadError('视频[{}]的区间多次下载失败：{}'.format(os.path.basename(self.file_name),
+                                                              self._errors[0])) from self._errors[0]
+        self.content_digest = self._streamed_digest(tasks)
+        SEGMENT_SECONDS.observe(time.time() - begin, mode='range')
+        return not self._missing_ranges()
+
+    def download(self):
+        """
+        并行下载所有缺失的区间，已下载的部分从进度文件中恢复
+        :return: bool 是否完整下载
+        :raise DownloadError: 某个区间的重试次数用完仍然失败
+        """
+        if self.content_size is None and self.probe() is None:
+            return False
+
+        for attempt in range(VERIFY_ATTEMPTS):
+            state = PartState(self.file_name, self.output_size)
+            self.size = state.completed
+            self._reset_progress(self.output_size, state.completed)
+            writer = FileWriter(state.part_name, self.output_size, producers=0)  # 缓冲区由download_into追加
+            try:
+                self.download_into(writer, state)
+            finally:
+                writer.close()
+                state.save()
+                self.scoreboard.save()
+
+            if state.completed != self.output_size:
+                return False
+            try:
+                result = self.verify(state)
+            except IntegrityError as e:
+                log('视频[{}]校验失败，重新下载：{}'.format(os.path.basename(self.file_name), e))
+                RETRIES.inc(reason='verify')
+                state.discard()
+                continue
+            state.commit(**result)
+            return True
+        return False
+
+
+class AsyncRangeDownloader(BaseRangeDownloader):
+    """RangeDownloader的协程版本，基于aiohttp"""
+
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=30)
+
+    async def probe(self):
+        """
+        HEAD请求获取文件大小，按得分依次尝试各镜像，均不支持Range时返回None
+        :return: int or None
+        """
+        self.mirrors = self.scoreboard.rank(self.mirrors)
+        for url in self.mirrors:
+            try:
+                async with self.session.head(url, headers=self.headers, allow_redirects=True, verify_ssl=False,
+                                             timeout=self.timeout) as response:
+                    if response.status != 200:
+                        self.scoreboard.record_error(url)
+                        continue
+                    self.content_size = _parse_range_support(response.headers)
+            except Exception:
+                self.scoreboard.record_error(url)
+                continue
+            if self.content_size is not None:
+                self.download_url = url
+                return self.content_size
+        return None
+
+    async def _fetch(self, url, buffer, end, watchdog=None):
+        start, source_end = self._source_range(buffer.position, end)
+        position = buffer.position
+        limiter = get_controller().for_url(url)
+        status = None
+        await limiter.acquire_async()
+        try:
+            begin = time.time()
+            async with self.session.get(url, headers=self._headers_for(start, source_end), verify_ssl=False,
+                                        timeout=self.timeout) as response:
+                latency = time.time() - begin
+                FIRST_BYTE_SECONDS.observe(latency, host=host_of(url))
+                status = response.status
+                _check_partial_response(status, response.headers, self.content_size, start, source_end)
+                await write_async(buffer, response.content.iter_chunked(self.chunk_size), False, self.bucket,
+                                  self.progress, watchdog)
+            if buffer.position != end + 1:
+                raise IOError('区间[{}-{}]数据不完整'.format(start, source_end))
+            limiter.success(source_end + 1 - start, latency)
+        except (HedgeCancelled, asyncio.CancelledError):
+            raise
+        except Exception:
+            limiter.failure(status, buffer.position - position)
+            raise
+        finally:
+            limiter.release()
+            DOWNLOAD_BYTES.inc(buffer.position - position, host=host_of(url))
+        self.scoreboard.record(url, source_end + 1 - start, time.time() - begin)
+
+    async def _download_range(self, writer, task, side=ORIGINAL, start=None):
+        buffer, mirrors = self._range_buffer(writer, task, side, task.start if start is None else start)
+        watchdog = SpeedWatchdog(cancelled=lambda: task.cancelled(side))
+        error = None
+        try:
+            for attempt in range(RETRY_ATTEMPTS):
+                if attempt and attempt % len(mirrors) == 0:
+                    await sleep_backoff_async(attempt // len(mirrors) - 1)
+                url = mirrors[attempt % len(mirrors)]
+                try:
+                    await self._fetch(url, buffer, task.end, watchdog)
+                    error = None
+                    break
+                except (HedgeCancelled, asyncio.CancelledError):  # Python3.7中CancelledError是Exception的子类
+                    raise
+                except Exception as e:
+                    error = e
+                    self.scoreboard.record_error(url)
+                    RETRIES.inc(reason=self._retry_reason(e))
+        except HedgeCancelled:
+            buffer.discard()  # 另一方已完成，剩余数据不再需要
+            task.finish(side, None)
+            return
+        except asyncio.CancelledError:
+            # 被download_into取消（对冲请求胜出），线程池中的写入已由_buffer_call等待结束，归还尚未提交的缓冲区
+            buffer.discard()
+            task.finish(side, None)
+            raise
+        await _buffer_call(buffer.flush)  # 出错时已收到的数据仍然有效
+        if task.finish(side, error):
+            self._errors.append(error)
+
+    async def _download_lane(self, writer, lane, running):
+        """
+        一条连接依次下载一组相接的区间，每个区间单独请求
+        :param writer: FileWriter对象
+        :param lane: RangeTask列表
+        :param running: {Future: RangeTask}，正在下载的原请求，对冲请求胜出时由download_into取消
+        :return None
+        """
+        for task in lane:
+            if self._errors:  # 本次下载已不会完整，剩下的区间留给下次断点续传
+                return
+            future = asyncio.ensure_future(self._download_range(writer, task))
+            running[future] = task
+            try:
+                await asyncio.wait([future])  # 原请求被取消后继续下一个区间
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            finally:
+                running.pop(future, None)
+            if not future.cancelled():
+                future.result()
+
+    async def download_into(self, writer, state):
+        """
+        把本分段缺失的区间下载到共享的输出文件中，不负责重命名
+        区间总体接近完成时，对剩余较多的区间向另一个镜像发出对冲请求，先完成的一方生效，另一方被取消
+        :param writer: 输出文件的FileWriter对象
+        :param state: 输出文件的PartState对象
+        :return: bool 本分段是否完整下载
+        :raise DownloadError: 某个区间的重试次数用完仍然失败，已收到的数据仍记录在进度中
+        """
+        self.state = state
+        self.content_digest = None
+        begin = time.time()
+        lanes = self._new_lanes()
+        tasks = [task for lane in lanes for task in lane]
+        writer.pool.reserve(2 * len(lanes))  # 每条连接同时最多有原请求和一个对冲请求在填充缓冲区
+        running = {}  # 各条连接正在下载的原请求
+        pending = {asyncio.ensure_future(self._download_lane(writer, lane, running)): None for lane in lanes}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), timeout=HEDGE_INTERVAL)
+                for future in done:
+                    pending.pop(future)
+                for future, task in list(pending.items()) + list(running.items()):
+                    if task is not None and task.winner is not None:  # 另一方已完成，不必等到它收到下一块数据
+                        future.cancel()
+                if self.connections > 1 or len(self.mirrors) > 1:  # 单连接单镜像时不额外增加连接
+                    for task, start in self._start_hedges(tasks):
+                        pending[asyncio.ensure_future(self._download_range(writer, task, HEDGE, start))] = task
+        except asyncio.CancelledError:  # 整个下载被取消时一并取消所有区间
+            for future in pending:
+                future.cancel()
+            raise
+        if self._errors:
+            raise DownloadError('视频[{}]的区间多次下载失败：{}'.format(os.path.basename(self.file_name),
+                                                              self._errors[0])) from self._errors[0]
+        self.content_digest = self._streamed_digest(tasks)
+        SEGMENT_SECONDS.observe(time.time() - begin, mode='range')
+        return not self._missing_ranges()
+
+    async def download(self):
+        """
+        并行下载所有缺失的区间，已下载的部分从进度文件中恢复
+        :return: bool 是否完整下载
+        :raise DownloadError: 某个区间的重试次数用完仍然失败
+        """
+        if self.content_size is None and await self.probe() is None:
+            return False
+
+        loop = asyncio.get_event_loop()
+        for attempt in range(VERIFY_ATTEMPTS):
+            state = PartState(self.file_name, self.output_size)
+            self.size = state.completed
+            self._reset_progress(self.output_size, state.completed)
+            writer = FileWriter(state.part_name, self.output_size, producers=0)  # 缓冲区由download_into追加
+            try:
+                await self.download_into(writer, state)
+            finally:
+                await loop.run_in_executor(None, writer.close)
+                state.save()
+                self.scoreboard.save()
+
+            if state.completed != self.output_size:
+                return False
+            try:
+                result = await loop.run_in_executor(None, self.verify, state)
+            except IntegrityError as e:
+                log('视频[{}]校验失败，重新下载：{}'.format(os.path.basename(self.file_name), e))
+                RETRIES.inc(reason='verify')
+                state.discard()
+                continue
+            state.commit(**result)
+            return True
+        return False
+
+
+class ConcatDownloader:
+    """
+    多段FLV视频直接拼接下载：各分段去掉FLV文件头后按顺序写入同一个输出文件的对应位置，
+    全部完成后在原文件上修正各分段的时间戳（只读写标签头），不产生临时分段文件，也不需要ffmpeg
+    """
+
+    downloader_class = RangeDownloader
+
+    def __init__(self, session, segments, file_name, headers=None, connections=4, bucket=None, progress=None):
+        """
+        :param session: requests.Session或aiohttp.ClientSession对象
+        :param segments: 每个分段的镜像地址列表，[[url, backup_url...], ...]
+        :param file_name: 保存的文件路径
+        :param headers: 请求头
+        :param connections: 每个分段的并行连接数
+        :param bucket: 单个任务的令牌桶
+        :param progress: 进度计数（progress.ProgressTask），各分段共用
+        :return None
+        """
+        self.file_name = file_name
+        self.progress = progress
+        self.downloaders = [self.downloader_class(session, mirrors, file_name, headers, connections, bucket=bucket,
+                                                  progress=progress)
+                            for mirrors in segments]
+        self.state = None
+
+    def _layout(self):
+        """
+        根据各分段大小计算其在输出文件中的位置，第一个分段保留FLV文件头
+        :return: int 输出文件大小
+        """
+        offset = 0
+        for i, downloader in enumerate(self.downloaders):
+            downloader.skip = 0 if i == 0 else FLV_HEADER_SIZE
+            downloader.offset = offset
+            offset += downloader.output_size
+        return offset
+
+    def _verify(self):
+        """
+        检查各分段的FLV分帧，出错的分段从进度中移除，下一轮只重新下载该分段
+        :return: dict 写入清单的校验结果
+        """
+        try:
+            counts = check_flv_file(self.state.part_name, [d.offset for d in self.downloaders])
+        except IntegrityError as e:
+            bad = self.downloaders[e.offset]
+            self.state.remove(bad.offset, bad.offset + bad.output_size - 1)
+            self.state.extra.pop('patched', None)
+            self.state.save()
+            raise
+        return {'flv_tags': sum(counts), 'segments': len(counts)}
+
+    def _finish(self):
+        """
+        所有分段完成后校验、修正时间戳并重命名
+        :return: bool 时间戳无法直接拼接时丢弃拼接的文件并返回None，由调用方改用逐段下载和ffmpeg合并
+        """
+        if self.state.completed != self.state.content_size:
+            return False
+        result = self._verify()
+        if not self.state.extra.get('patched'):
+            changed = []
+            try:
+                concat_timestamps(self.state.part_name, [d.offset for d in self.downloaders], changed)
+            except TimestampError as e:
+                log('视频[{}]的分段无法直接拼接，改用ffmpeg合并：{}'.format(os.path.basename(self.file_name), e))
+                self.state.discard()
+                return None
+            # 分块摘要是下载时计算的，改写过时间戳和onMetaData的分块需要重新计算，清单才与文件一致
+            self.state.pieces = rehash_pieces(self.state.part_name, self.state.pieces, changed)
+            self.state.extra['patched'] = True
+            self.state.save()
+        self.state.commit(**result)
+        return True
+
+    def _download(self, writer):
+        errors = []
+
+        def run(downloader):
+            try:
+                downloader.download_into(writer, self.state)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(d,)) for d in self.downloaders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def download(self):
+        """
+        并行下载所有分段，校验失败的分段自动重新下载
+        :return: bool 是否完整下载，任一分段不支持Range或时间戳无法直接拼接时返回None，由调用方改用逐段下载
+        :raise DownloadError: 某个区间的重试次数用完仍然失败
+        """
+        if any(d.probe() is None for d in self.downloaders):
+            return None
+        total = self._layout()
+        for attempt in range(VERIFY_ATTEMPTS):
+            self.state = PartState(self.file_name, total)
+            if self.progress is not None:
+                self.progress.total = total
+                self.progress.reset(self.state.completed)
+            writer = FileWriter(self.state.part_name, total, producers=0)  # 缓冲区由download_into追加
+            try:
+                self._download(writer)
+            finally:
+                writer.close()
+                self.state.save()
+                get_scoreboard().save()
+            try:
+                return self._finish()
+            except IntegrityError as e:
+                log('视频[{}]校验失败，重新下载：{}'.format(os.path.basename(self.file_name), e))
+                RETRIES.inc(reason='verify')
+        return False
+
+
+class AsyncConcatDownloader(ConcatDownloader):
+    """ConcatDownloader的协程版本"""
+
+    downloader_class = AsyncRangeDownloader
+
+    async def download(self):
+        sizes = await asyncio.gather(*[d.probe() for d in self.downloaders])
+        if any(size is None for size in sizes):
+            return None
+        total = self._layout()
+        loop = asyncio.get_event_loop()
+        for attempt in range(VERIFY_ATTEMPTS):
+            self.state = PartState(self.file_name, total)
+            if self.progress is not None:
+                self.progress.total = total
+                self.progress.reset(self.state.completed)
+            writer = FileWriter(self.state.part_name, total, producers=0)  # 缓冲区由download_into追加
+            try:
+                await asyncio.gather(*[d.download_into(writer, self.state) for d in self.downloaders])
+            finally:
+                await loop.run_in_executor(None, writer.close)
+                self.state.save()
+                get_scoreboard().save()
+            try:
+                return await loop.run_in_executor(None, self._finish)
+            except IntegrityError as e:
+                log('视频[{}]校验失败，重新下载：{}'.format(os.path.basename(self.file_name), e))
+                RETRIES.inc(reason='verify')
+        return False
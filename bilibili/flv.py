@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# FLV标签流处理：多段FLV拼接后修正时间戳，取代ffmpeg -f concat
+# 参考https://www.adobe.com/content/dam/acom/en/devnet/flv/video_file_format_spec_v10.pdf
+import mmap
+import struct
+from urllib.parse import urlparse
+
+FLV_HEADER_SIZE = 13  # 9字节文件头 + 4字节PreviousTagSize0
+TAG_HEADER_SIZE = 11  # 类型(1) 数据大小(3) 时间戳(3) 扩展时间戳(1) 流ID(3)
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+
+
+class TimestampError(ValueError):
+    """分段内的时间戳早于该分段的第一个标签，无法简单平移拼接，应改用ffmpeg合并"""
+
+
+def is_flv_url(url):
+    """
+    根据下载地址判断分段是否为FLV格式
+    :param url: 下载地址
+    :return: bool
+    """
+    return urlparse(url).path.lower().endswith('.flv')
+
+
+def parse_header(data):
+    """
+    解析FLV文件头
+    :param data: 文件开头至少9个字节
+    :return: int 第一个标签的位置，不是FLV文件时返回None
+    """
+    if len(data) < 9 or data[:3] != b'FLV':
+        return None
+    return struct.unpack('>I', data[5:9])[0] + 4
+
+
+def read_timestamp(data, position):
+    """
+    读取标签头中的时间戳（低24位+扩展的高8位）
+    :param data: 文件内容
+    :param position: 标签头位置
+    :return: int 毫秒
+    """
+    return int.from_bytes(data[position + 4:position + 7], 'big') | (data[position + 7] << 24)
+
+
+def write_timestamp(data, position, timestamp):
+    """
+    改写标签头中的时间戳
+    :param data: 可写的文件内容
+    :param position: 标签头位置
+    :param timestamp: 毫秒
+    :return None
+    """
+    timestamp &= 0xFFFFFFFF
+    data[position + 4:position + 7] = (timestamp & 0xFFFFFF).to_bytes(3, 'big')
+    data[position + 7] = timestamp >> 24
+
+
+def iter_tags(data, start, end):
+    """
+    遍历[start, end)范围内的标签
+    :param data: 文件内容
+    :param start: 第一个标签头的位置
+    :param end: 结束位置
+    :return: 生成器 (标签头位置, 标签类型, 数据大小)
+    """
+    position = start
+    while position + TAG_HEADER_SIZE <= end:
+        tag_type = data[position] & 0x1F
+        size = int.from_bytes(data[position + 1:position + 4], 'big')
+        if position + TAG_HEADER_SIZE + size + 4 > end:
+            raise ValueError('FLV标签在位置{}处被截断'.format(position))
+        yield position, tag_type, size
+        position += TAG_HEADER_SIZE + size + 4
+
+
+def _set_amf_number(data, start, end, name, value):
+    """
+    在onMetaData中查找数值类型的属性并原地改写，属性不存在时忽略
+    :return: tuple 改写的区间(start, end)，end为闭区间，没有改写时返回None
+    """
+    key = struct.pack('>H', len(name)) + name + b'\x00'  # AMF0字符串键 + Number类型标记
+    index = data.find(key, start, end)
+    if index != -1 and index + len(key) + 8 <= end:
+        data[index + len(key):index + len(key) + 8] = struct.pack('>d', value)
+        return index + len(key), index + len(key) + 7
+    return None
+
+
+def concat_timestamps(file_name, segment_offsets, changed=None):
+    """
+    修正多段FLV直接拼接后的时间戳：每个分段的时间戳从上一分段最后一帧之后继续，
+    第一个分段的onMetaData中的duration和filesize改为拼接后的值
+    只读写标签头，数据部分不经过Python，通过mmap原地修改
+    同一文件重复执行结果不变（每个分段都以其第一个标签的时间戳为基准重新计算）
+    :param file_name: 拼接后的文件路径
+    :param segment_offsets: 各分段在文件中的起始位置，第一个为0（文件头），其余为该分段第一个标签的位置
+    :param changed: 列表，改写过的区间(start, end)（闭区间）追加到其中，用于重新计算分块摘要
+    :return: int 总时长（毫秒）
+    :raise TimestampError: 某个分段的时间戳相对其第一个标签为负，此时文件不做任何修改
+    """
+    with open(file_name, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0) as data:
+            first_tag = parse_header(data)
+            if first_tag is None:
+                raise ValueError('{}不是FLV文件'.format(file_name))
+            starts = [first_tag] + list(segment_offsets[1:])
+            ends = list(segment_offsets[1:]) + [len(data)]
+
+            for index, (start, end) in enumerate(zip(starts, ends)):  # 先检查再修改，出错时不留下改了一半的文件
+                first_timestamp = None
+                for position, tag_type, size in iter_tags(data, start, end):
+                    timestamp = read_timestamp(data, position)
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    elif timestamp < first_timestamp:
+                        raise TimestampError('第{}段位置{}处的时间戳{}早于分段起始的{}'.format(
+                            index + 1, position, timestamp, first_timestamp))
+
+            base = 0  # 当前分段的时间戳偏移
+            last = 0  # 已处理的最大时间戳
+            metadata = None
+            for start, end in zip(starts, ends):
+                first_timestamp = None
+                frame_interval = 0
+                last_video = None
+                for position, tag_type, size in iter_tags(data, start, end):
+                    timestamp = read_timestamp(data, position)
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    if tag_type == TAG_SCRIPT and metadata is None:
+                        metadata = (position + TAG_HEADER_SIZE, position + TAG_HEADER_SIZE + size)
+                    new_timestamp = timestamp - first_timestamp + base
+                    if new_timestamp != timestamp:
+                        write_timestamp(data, position, new_timestamp)
+                        if changed is not None:
+                            changed.append((position + 4, position + 7))
+                    if tag_type == TAG_VIDEO:
+                        if last_video is not None and new_timestamp > last_video:
+                            frame_interval = new_timestamp - last_video
+                        last_video = new_timestamp
+                    last = max(last, new_timestamp)
+                base = last + frame_interval  # 下一分段从最后一帧之后开始
+
+            if metadata is not None:
+                for name, value in ((b'duration', base / 1000), (b'filesize', float(len(data)))):
+                    patched = _set_amf_number(data, metadata[0], metadata[1], name, value)
+                    if patched is not None and changed is not None:
+                        changed.append(patched)
+            data.flush()
+    return base
+
+
+class FramingChecker:
+    """
+    边接收边检查FLV的分帧：文件头、标签类型以及每个标签之后的PreviousTagSize，
+    数据部分只计数跳过，不复制也不解析
+    """
+
+    def __init__(self, header=True):
+        """
+        :param header: 数据是否从FLV文件头开始，为False时从某个标签头开始（拼接文件中的后续分段）
+        :return None
+        """
+        self.position = 0  # 已检查的字节数
+        self.tags = 0  # 完整的标签数
+        self._state = 'header' if header else 'tag'
+        self._need = 9 if header else TAG_HEADER_SIZE
+        self._expected = 0  # 下一个PreviousTagSize的期望值
+        self._skip = 0
+        self._pending = bytearray()
+
+    def feed(self, data):
+        """
+        检查下一段数据
+        :param data: bytes、bytearray或memoryview
+        :return None
+        """
+        view = memoryview(data)
+        while len(view):
+            if self._skip:
+                count = min(self._skip, len(view))
+                self._skip -= count
+                self.position += count
+                view = view[count:]
+                continue
+            count = min(self._need - len(self._pending), len(view))
+            self._pending += view[:count]
+            self.position += count
+            view = view[count:]
+            if len(self._pending) == self._need:
+                self._parse(bytes(self._pending))
+                self._pending.clear()
+
+    def _parse(self, data):
+        start = self.position - len(data)
+        if self._state == 'header':
+            first_tag = parse_header(data)
+            if first_tag is None or first_tag < FLV_HEADER_SIZE:
+                raise ValueError('FLV文件头无效')
+            self._skip = first_tag - FLV_HEADER_SIZE
+            self._state, self._need, self._expected = 'previous', 4, 0
+        elif self._state == 'previous':
+            previous = struct.unpack('>I', data)[0]
+            if previous != self._expected:
+                raise ValueError('位置{}处的PreviousTagSize为{}，应为{}'.format(start, previous, self._expected))
+            self._state, self._need = 'tag', TAG_HEADER_SIZE
+        else:
+            tag_type = data[0] & 0x1F
+            if tag_type not in (TAG_AUDIO, TAG_VIDEO, TAG_SCRIPT):
+                raise ValueError('位置{}处的标签类型{}无效'.format(start, tag_type))
+            size = int.from_bytes(data[1:4], 'big')
+            self._skip = size
+            self._expected = TAG_HEADER_SIZE + size
+            self._state, self._need = 'previous', 4
+            self.tags += 1
+
+    def finish(self):
+        """
+        数据结束，检查是否恰好停在标签边界上
+        :return: int 标签数
+        """
+        if self._state != 'tag' or self._pending or self._skip:
+            raise ValueError('FLV在位置{}处被截断'.format(self.position))
+        return self.tags
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 接口响应的磁盘缓存（SQLite）：按地址缓存，每类接口单独的有效期，过期后用ETag/Last-Modified向服务器确认，
+# 响应体压缩保存，总大小超过上限时删除最久未使用的记录
+import os
+import re
+import time
+import zlib
+import sqlite3
+import threading
+from metrics import endpoint_of
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.bilibili_http_cache.db')  # 缓存的默认保存位置
+MAX_SIZE = 64 * 1024 * 1024  # 压缩后的总大小上限（字节）
+COMPRESS_LEVEL = 6
+# 各类接口的有效期（秒），按metrics.endpoint_of得到的主机名加路径匹配，第一个匹配的生效
+# 没有匹配的接口不缓存，例如带签名和过期时间的playurl、含下载地址的视频页面
+ENDPOINT_TTLS = (
+    (r'/x/web-interface/view$', 12 * 3600),  # 视频信息，重新运行失败的批量任务时不必再请求
+    (r'/x/player/pagelist$', 12 * 3600),  # 选集
+    (r'/x/web-interface/archive/stat$', 600),  # 状态信息变化较快
+    (r'/x/web-interface/search/', 600),  # 搜索结果
+    (r'/x/(space|relation)/', 3600),  # 用户空间、粉丝和关注列表
+    (r'space\.bilibili\.com/ajax/', 3600),
+    (r'/dm/list\.so$|comment\.bilibili\.cn/', 3600),  # 弹幕
+)
+
+
+def ttl_for(url, rules=ENDPOINT_TTLS):
+    """
+    :param url: 地址
+    :param rules: [(正则, 有效期), ...]
+    :return: int 有效期（秒），0表示不缓存
+    """
+    endpoint = endpoint_of(url)
+    for pattern, ttl in rules:
+        if re.search(pattern, endpoint):
+            return ttl
+    return 0
+
+
+class CacheEntry:
+    """一条缓存记录"""
+
+    def __init__(self, body, etag=None, last_modified=None, fresh=True):
+        """
+        :param body: 解压后的响应体
+        :param etag: 响应头中的ETag
+        :param last_modified: 响应头中的Last-Modified
+        :param fresh: 是否仍在有效期内，过期时需带上validators重新确认
+        :return None
+        """
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh = fresh
+
+    @property
+    def validators(self):
+        """
+        条件请求的请求头，服务器返回304时继续使用缓存
+        :return: dict
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """
+    所有线程共用一个连接，通过锁串行访问；多个进程可以共用同一个文件
+    """
+
+    def __init__(self, file_name=CACHE_FILE, max_size=MAX_SIZE, rules=ENDPOINT_TTLS):
+        """
+        :param file_name: SQLite文件路径，为None时只缓存在内存中
+        :param max_size: 压缩后的总大小上限（字节）
+        :param rules: 各类接口的有效期，见ENDPOINT_TTLS
+        :return None
+        """
+        self.file_name = file_name
+        self.max_size = max_size
+        self.rules = rules
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_name or ':memory:', timeout=30, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')  # 缓存丢失最后几条记录无妨
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                  url TEXT PRIMARY KEY,
+                                  body BLOB NOT NULL,
+                                  etag TEXT,
+                                  last_modified TEXT,
+                                  expires REAL NOT NULL,
+                                  accessed REAL NOT NULL,
+                                  size INTEGER NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self._size = self._total_size()
+
+    def _total_size(self):
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def lookup(self, url):
+        """
+        查找缓存并更新最近使用时间
+        :param url: 地址
+        :return: CacheEntry 没有记录或该接口不缓存时返回None
+        """
+        if not self.enabled or not ttl_for(url, self.rules):
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT body, etag, last_modified, expires FROM entries WHERE url = ?',
+                                     (url,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE entries SET accessed = ? WHERE url = ?', (now, url))
+        try:
+            body = zlib.decompress(row[0])
+        except zlib.error:
+            self.invalidate(url)
+            return None
+        return CacheEntry(body, row[1], row[2], row[3] > now)
+
+    def store(self, url, body, headers=None):
+        """
+        保存响应，该接口不缓存或响应要求不缓存时忽略
+        :param url: 地址
+        :param body: 解压后的响应体
+        :param headers: 响应头，取ETag、Last-Modified和Cache-Control
+        :return None
+        """
+        ttl = ttl_for(url, self.rules)
+        headers = headers or {}
+        if not self.enabled or not ttl or 'no-store' in (headers.get('Cache-Control') or ''):
+            return
+        data = zlib.compress(body, COMPRESS_LEVEL)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM entries WHERE url = ?', (url,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO entries (url, body, etag, last_modified, expires, accessed, '
+                               'size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (url, data, headers.get('ETag'), headers.get('Last-Modified'), now + ttl, now,
+                                len(data)))
+            self._size += len(data) - (row[0] if row else 0)
+            if self._size > self.max_size:
+                self._evict()
+
+    def refresh(self, url, headers=None):
+        """
+        服务器返回304后延长有效期
+        :param url: 地址
+        :param headers: 304响应的响应头，可能带有新的ETag
+        :return None
+        """
+        ttl = ttl_for(url, self.rules)
+        headers = headers or {}
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE entries SET expires = ?, accessed = ?, etag = COALESCE(?, etag) WHERE url = ?',
+                               (now + ttl, now, headers.get('ETag'), url))
+
+    def invalidate(self, url):
+        """
+        删除一条记录，例如接口返回了错误码
+        :param url: 地址
+        :return None
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM entries WHERE url = ?', (url,))
+            self._size = self._total_size()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM entries')
+            self._size = 0
+
+    def _evict(self):
+        """按最近使用时间从旧到新删除记录，直到总大小降到上限的90%，调用时需持有锁"""
+        self._size = self._total_size()  # 其他进程可能也写入了记录
+        target = self.max_size * 0.9
+        if self._size <= self.max_size:
+            return
+        urls = []
+        for url, size in self._conn.execute('SELECT url, size FROM entries ORDER BY accessed'):
+            if self._size <= target:
+                break
+            urls.append((url,))
+            self._size -= size
+        self._conn.executemany('DELETE FROM entries WHERE url = ?', urls)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_http_cache():
+    """
+    获取进程内共享的接口缓存
+    :return: HttpCache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = HttpCache()
+            except sqlite3.Error:  # 家目录不可写等情况下退回内存缓存
+                _cache = HttpCache(file_name=None)
+        return _cache
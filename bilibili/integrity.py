@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载完整性校验：写入的同时统计大小、计算分块摘要并检查FLV分帧，结果记录在输出文件旁的清单中
+import os
+import json
+import mmap
+import time
+import bisect
+import hashlib
+from flv import FramingChecker
+
+HASH_ALGORITHM = 'sha1'  # 分块摘要算法
+MANIFEST_SUFFIX = '.manifest.json'  # 校验清单文件后缀
+VERIFY_ATTEMPTS = 3  # 校验失败后重新下载的总尝试次数
+
+
+class IntegrityError(IOError):
+    """下载的数据不完整或格式错误"""
+
+    def __init__(self, message, offset=None):
+        """
+        :param message: 错误信息
+        :param offset: 出错的文件偏移，未知时为None
+        :return None
+        """
+        super().__init__(message)
+        self.offset = offset
+
+
+class StreamVerifier:
+    """
+    跟随数据流的校验器，由RangeBuffer在追加数据时调用
+    每次提交缓冲区时切出一个分块摘要，摘要与写入进度一起记录，断点续传时不需要重新读取已下载的部分
+    """
+
+    def __init__(self, offset=0, expected_size=None, flv=False, content=False):
+        """
+        :param offset: 数据流起始的文件偏移
+        :param expected_size: 期望的字节数，为None时不检查
+        :param flv: 是否检查FLV分帧，数据流需从FLV文件头开始
+        :param content: 是否同时计算整个数据流的摘要（与file_digest相同），数据流需是完整的文件；
+                        也可以传入前面相接的数据流的摘要对象，接着计算
+        :return None
+        """
+        self.offset = offset
+        self.expected_size = expected_size
+        self.size = 0
+        self.pieces = []  # [[start, end, digest], ...]，end为闭区间
+        self._content = hashlib.new(HASH_ALGORITHM) if content is True else (content or None)
+        self._piece = hashlib.new(HASH_ALGORITHM)
+        self._piece_start = offset
+        self._framing = FramingChecker() if flv else None
+
+    def update(self, data):
+        """
+        追加数据
+        :param data: bytes
+        :return None
+        """
+        self.size += len(data)
+        self._piece.update(data)
+        if self._content is not None:
+            self._content.update(data)
+        if self._framing is not None:
+            try:
+                self._framing.feed(data)
+            except ValueError as e:
+                raise IntegrityError(str(e), self.offset + self._framing.position)
+
+    @property
+    def content_digest(self):
+        """
+        到目前为止整个数据流的摘要
+        :return: string，没有计算时返回None
+        """
+        return self._content.hexdigest() if self._content is not None else None
+
+    def cut(self):
+        """
+        结束当前分块
+        :return: string 分块摘要，当前分块为空时返回None
+        """
+        end = self.offset + self.size - 1
+        if end < self._piece_start:
+            return None
+        digest = self._piece.hexdigest()
+        self.pieces.append([self._piece_start, end, digest])
+        self._piece = hashlib.new(HASH_ALGORITHM)
+        self._piece_start = end + 1
+        return digest
+
+    def finish(self):
+        """
+        数据流结束，检查大小和FLV分帧
+        :return: dict 写入清单的校验结果
+        """
+        self.cut()
+        if self.expected_size is not None and self.size != self.expected_size:
+            raise IntegrityError('收到{}字节，应为{}字节'.format(self.size, self.expected_size), self.offset + self.size)
+        result = {}
+        if self._framing is not None:
+            try:
+                result['flv_tags'] = self._framing.finish()
+            except ValueError as e:
+                raise IntegrityError(str(e), self.offset + self._framing.position)
+        return result
+
+
+def check_flv_file(file_name, boundaries=(0,)):
+    """
+    检查已写入磁盘的FLV文件的分帧，用于多连接下载（数据乱序到达，无法边写边检查）
+    通过mmap只读取标签头，数据部分不会被读入
+    :param file_name: 文件路径
+    :param boundaries: 各分段的起始位置，第一个为0（文件头），其余为该分段第一个标签的位置
+    :return: list 各分段的标签数，某个分段出错时抛出IntegrityError，其offset为该分段的下标
+    """
+    counts = []
+    error = None
+    with open(file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise IntegrityError('{}为空文件'.format(file_name), 0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ends = list(boundaries[1:]) + [size]
+            for i, (start, end) in enumerate(zip(boundaries, ends)):
+                checker = FramingChecker(header=i == 0)
+                view = memoryview(data)[start:end]
+                try:
+                    checker.feed(view)
+                    counts.append(checker.finish())
+                except ValueError as e:
+                    # 异常的traceback引用着mmap的切片，不能带着它关闭mmap，只记下出错的分段
+                    error = ('第{}段：{}'.format(i + 1, e), i)
+                    break
+                finally:
+                    view.release()
+    if error is not None:
+        raise IntegrityError(*error)
+    return counts
+
+
+def root_digest(pieces):
+    """
+    整个文件的摘要：各分块摘要按位置顺序拼接后再计算摘要
+    :param pieces: [[start, end, digest], ...]
+    :return: string
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    for piece in sorted(pieces):
+        digest.update(piece[2].encode())
+    return digest.hexdigest()
+
+
+def rehash_pieces(file_name, pieces, changed, chunk_size=1024 * 1024):
+    """
+    文件被原地改写后重新计算受影响的分块摘要，只读取与改写区间重叠的分块
+    :param file_name: 文件路径
+    :param pieces: [[start, end, digest], ...]
+    :param changed: 改写过的区间[(start, end), ...]，end为闭区间，区间之间不重叠
+    :return: list 新的分块摘要
+    """
+    changed = sorted(changed)
+    ends = [end for start, end in changed]
+    result = []
+    with open(file_name, 'rb') as f:
+        for start, end, digest in pieces:
+            index = bisect.bisect_left(ends, start)  # 第一个结束于分块起点之后的改写区间
+            if index < len(changed) and changed[index][0] <= end:
+                piece = hashlib.new(HASH_ALGORITHM)
+                f.seek(start)
+                remaining = end + 1 - start
+                while remaining > 0:
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        raise IntegrityError('{}在位置{}处被截断'.format(file_name, f.tell()), f.tell())
+                    piece.update(data)
+                    remaining -= len(data)
+                digest = piece.hexdigest()
+            result.append([start, end, digest])
+    return result
+
+
+def file_digest(file_name, chunk_size=1024 * 1024):
+    """
+    整个文件内容的摘要，与分块无关，同样内容的文件摘要相同
+    :param file_name: 文件路径
+    :param chunk_size: 每次读取的字节数
+    :return: string
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(file_name, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def streamed_digest(file_name):
+    """
+    下载时边写边计算并记录在清单中的整个文件的摘要，与file_digest(file_name)相同，不需要重新读取文件
+    :param file_name: 文件路径
+    :return: string，没有清单、清单中没有该摘要，或文件在校验之后被改动过时返回None
+    """
+    manifest = read_manifest(file_name)
+    if manifest is None or not manifest.get('content_digest') or manifest.get('algorithm') != HASH_ALGORITHM:
+        return None
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    if stat.st_size != manifest.get('size') or stat.st_mtime > manifest.get('verified_at', 0) + 1:
+        return None
+    return manifest['content_digest']
+
+
+def write_manifest(file_name, size, pieces, **result):
+    """
+    在file_name旁写入校验清单
+    :param file_name: 已完成的文件路径
+    :param size: 文件大小
+    :param pieces: 分块摘要
+    :param result: 其他校验结果，例如flv_tags
+    :return None
+    """
+    pieces = sorted(pieces)
+    manifest = {
+        'file': os.path.basename(file_name),
+        'size': size,
+        'algorithm': HASH_ALGORITHM,
+        'digest': root_digest(pieces),
+        'pieces': pieces,
+        'verified_at': int(time.time()),
+    }
+    manifest.update(result)
+    temp_name = file_name + MANIFEST_SUFFIX + '.tmp'
+    with open(temp_name, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_name, file_name + MANIFEST_SUFFIX)
+
+
+def read_manifest(file_name):
+    """
+    读取file_name的校验清单
+    :param file_name: 文件路径
+    :return: dict，没有清单时返回None
+    """
+    try:
+        with open(file_name + MANIFEST_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def rename_verified(src, dst):
+    """
+    重命名已完成的文件，校验清单随之重命名
+    :param src: 原文件路径
+    :param dst: 新文件路径
+    :return None
+    """
+    os.rename(src, dst)
+    manifest = read_manifest(src)
+    if manifest is not None:
+        manifest['file'] = os.path.basename(dst)
+        with open(dst + MANIFEST_SUFFIX, 'w') as f:
+            json.dump(manifest, f)
+        os.remove(src + MANIFEST_SUFFIX)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 批量下载的持久化任务队列（SQLite），进程重启后从上次的进度继续
+import os
+import re
+import time
+import sqlite3
+import threading
+from pool import worker_loop
+from progress import log
+
+QUEUE_FILE = os.path.join(os.path.expanduser('~'), '.bilibili_jobs.db')  # 任务队列的默认保存位置
+JOB_TTL = 120  # running状态的任务超过该时间（秒）没有心跳时视为持有者已挂掉，可被其他进程领取
+
+PENDING = 'pending'  # 等待下载
+RUNNING = 'running'  # 正在下载
+DONE = 'done'  # 下载完成
+FAILED = 'failed'  # 重试次数用完仍然失败
+
+
+def parse_aids(lines):
+    """
+    从文本行中解析AV号，每行一个，忽略空行和#开头的注释，允许带av前缀
+    :param lines: 可迭代的文本行，例如打开的文件或sys.stdin
+    :return: list
+    """
+    aids = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        match = re.match(r'^(?:av)?(\d+)$', line, re.I)
+        if match:
+            aids.append(match.group(1))
+        elif line:
+            log('忽略无法识别的AV号: {}'.format(line))
+    return aids
+
+
+class JobQueue:
+    """
+    每个AV号一条任务记录，状态为pending/running/done/failed，并记录尝试次数和最后一次的错误
+    所有线程共用一个连接，通过锁串行访问；领取任务使用BEGIN IMMEDIATE，多个进程共用同一个文件时也不会重复领取
+    正在下载的任务由run_batch定期更新心跳，进程崩溃后其任务在JOB_TTL秒后重新可以被领取
+    """
+
+    def __init__(self, file_name=QUEUE_FILE):
+        """
+        :param file_name: SQLite文件路径
+        :return None
+        """
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')  # 读写互不阻塞，每次提交只追加日志
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                  id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                  aid TEXT NOT NULL UNIQUE,
+                                  directory TEXT NOT NULL,
+                                  status TEXT NOT NULL DEFAULT 'pending',
+                                  attempts INTEGER NOT NULL DEFAULT 0,
+                                  error TEXT,
+                                  created REAL NOT NULL,
+                                  updated REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def add(self, aids, directory=r'video'):
+        """
+        批量添加任务，已存在的AV号不会重复添加（也不会改变其状态）
+        :param aids: AV号列表
+        :param directory: 下载目录
+        :return: int 新添加的任务数
+        """
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('INSERT OR IGNORE INTO jobs (aid, directory, created, updated) '
+                                       'VALUES (?, ?, ?, ?)', [(str(aid), directory, now, now) for aid in aids])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return self._conn.total_changes - before
+
+    def claim(self, stale=JOB_TTL, max_attempts=3):
+        """
+        领取最早的一个等待中的任务（或心跳已超时的running任务），并把它标记为running、尝试次数加1
+        心跳超时的任务尝试次数已用完时（例如每次都让进程崩溃）标记为failed，不再领取
+        :param stale: 心跳超时时间（秒）
+        :param max_attempts: 单个任务的最大尝试次数
+        :return: dict {'aid': AV号, 'directory': 下载目录, 'attempts': 尝试次数}，没有任务时返回None
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT id, aid, directory, attempts FROM jobs '
+                                         'WHERE status = ? ORDER BY id LIMIT 1', (PENDING,)).fetchone()
+                if row is None:
+                    now = time.time()
+                    self._conn.execute('UPDATE jobs SET status = ?, error = ?, updated = ? '
+                                       'WHERE status = ? AND updated < ? AND attempts >= ?',
+                                       (FAILED, '下载进程心跳超时', now, RUNNING, now - stale, max_attempts))
+                    row = self._conn.execute('SELECT id, aid, directory, attempts FROM jobs '
+                                             'WHERE status = ? AND updated < ? ORDER BY updated LIMIT 1',
+                                             (RUNNING, now - stale)).fetchone()
+                if row is not None:
+                    self._conn.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? '
+                                       'WHERE id = ?', (RUNNING, time.time(), row[0]))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return {'aid': row[1], 'directory': row[2], 'attempts': row[3] + 1}
+
+    def _set_status(self, aid, status, error=None):
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE aid = ?',
+                               (status, error, time.time(), str(aid)))
+
+    def finish(self, aid):
+        """
+        标记任务完成
+        :param aid: AV号
+        :return None
+        """
+        self._set_status(aid, DONE)
+
+    def fail(self, aid, error, max_attempts=3):
+        """
+        标记任务失败，尝试次数未用完时放回等待队列
+        :param aid: AV号
+        :param error: 错误信息
+        :param max_attempts: 最大尝试次数
+        :return: bool 是否已放弃（不再重试）
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT attempts FROM jobs WHERE aid = ?', (str(aid),)).fetchone()
+        give_up = row is None or row[0] >= max_attempts
+        self._set_status(aid, FAILED if give_up else PENDING, str(error))
+        return give_up
+
+    def touch(self, aids):
+        """
+        更新正在下载的任务的心跳
+        :param aids: AV号列表
+        :return None
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('UPDATE jobs SET updated = ? WHERE aid = ? AND status = ?',
+                                   [(now, str(aid), RUNNING) for aid in aids])
+
+    def retry_failed(self):
+        """
+        把失败的任务放回等待队列并清零尝试次数
+        :return: int 放回的任务数
+        """
+        with self._lock:
+            cursor = self._conn.execute('UPDATE jobs SET status = ?, attempts = 0, updated = ? WHERE status = ?',
+                                        (PENDING, time.time(), FAILED))
+            return cursor.rowcount
+
+    def counts(self):
+        """
+        各状态的任务数
+        :return: dict
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BatchWorker(threading.Thread):
+    """
+    从任务队列中不断领取任务并下载，直到队列为空
+    所有工作线程共用进程内的连接池、并发控制器和令牌桶，每个线程有自己的长期事件循环，任务之间复用其中的aiohttp连接
+    """
+
+    def __init__(self, queue: JobQueue, download, max_attempts=3):
+        """
+        :param queue: 任务队列
+        :param download: 下载函数，参数为(aid, directory)，出错时抛出异常，有分P未完整下载时返回False
+        :param max_attempts: 单个任务的最大尝试次数
+        :return None
+        """
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.download = download
+        self.max_attempts = max_attempts
+        self.job = None  # 正在下载的任务
+
+    def run(self):
+        with worker_loop():
+            while True:
+                job = self.queue.claim(max_attempts=self.max_attempts)
+                if job is None:
+                    break
+                self.job = job
+                try:
+                    if self.download(job['aid'], job['directory']) is False:
+                        raise IOError('部分分P未完整下载')
+                except (Exception, SystemExit) as e:  # 接口出错时抛出util.ApiError，下载目录无效时会调用exit
+                    if self.queue.fail(job['aid'], e, self.max_attempts):
+                        log('av{}下载失败（已尝试{}次）：{}'.format(job['aid'], job['attempts'], e))
+                    else:
+                        log('av{}下载失败，稍后重试：{}'.format(job['aid'], e))
+                else:
+                    self.queue.finish(job['aid'])
+                finally:
+                    self.job = None
+
+
+def run_batch(queue: JobQueue, download, workers=4, max_attempts=3):
+    """
+    用多个工作线程清空任务队列，其他进程可以同时处理同一个队列
+    :param queue: 任务队列
+    :param download: 下载函数，参数为(aid, directory)
+    :param workers: 工作线程数
+    :param max_attempts: 单个任务的最大尝试次数
+    :return: dict 结束时各状态的任务数
+    """
+    threads = [BatchWorker(queue, download, max_attempts) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(JOB_TTL / 3 / len(threads))
+        queue.touch([thread.job['aid'] for thread in threads if thread.job is not None])  # 心跳
+    return queue.counts()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 合并阶段：ffmpeg以asyncio子进程运行在有限的进程池中，第N P合并的同时第N+1 P继续下载
+import os
+import time
+import asyncio
+import functools
+import threading
+import subprocess
+from integrity import MANIFEST_SUFFIX
+from progress import log
+from metrics import MERGE_SECONDS
+
+
+def _quote(file_name):
+    """
+    ffmpeg concat文件列表中的文件名转义
+    :param file_name: 文件名
+    :return: string
+    """
+    return "'" + file_name.replace("'", "'\\''") + "'"
+
+
+class MergePipeline:
+    """
+    ffmpeg合并任务的流水线
+    在协程中使用时传入当前事件循环；在线程中使用时不传，流水线在后台线程中运行自己的事件循环
+    合并结果先写到临时文件，成功后重命名，并在完成回调中删除分段文件和文件列表
+    """
+
+    def __init__(self, max_workers=2, loop=None):
+        """
+        :param max_workers: 同时运行的ffmpeg进程数
+        :param loop: 所在的事件循环，为None时启动后台线程
+        :return None
+        """
+        self.max_workers = max_workers
+        self._pending = set()
+        self._thread = None
+        if loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self._thread.start()
+        else:
+            self.loop = loop
+        self._semaphore = None
+
+    async def _run(self, args, cwd, temp_file, output_file, cleanup):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        async with self._semaphore:
+            begin = time.time()
+            try:
+                try:
+                    process = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdin=asyncio.subprocess.DEVNULL,
+                                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                                   stderr=asyncio.subprocess.PIPE)
+                    _, stderr = await process.communicate()
+                    return_code = process.returncode
+                except (NotImplementedError, RuntimeError):
+                    # Windows的SelectorEventLoop以及Python3.7非主线程的事件循环不支持asyncio子进程，改用线程池等待
+                    completed = await self.loop.run_in_executor(None, functools.partial(
+                        subprocess.run, args, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE))
+                    stderr, return_code = completed.stderr, completed.returncode
+            except FileNotFoundError:
+                log('请安装FFmpeg--http://ffmpeg.org/，并配置Path环境变量')
+                MERGE_SECONDS.observe(time.time() - begin, result='failed')  # 没有ffmpeg也是一次失败的合并
+                return False
+        merged = self._on_merged(return_code, stderr, cwd, temp_file, output_file, cleanup)
+        MERGE_SECONDS.observe(time.time() - begin, result='ok' if merged else 'failed')
+        return merged
+
+    @staticmethod
+    def _on_merged(return_code, stderr, cwd, temp_file, output_file, cleanup):
+        """
+        合并完成回调：成功时重命名并清理分段文件，失败时保留分段文件以便重试
+        :return: bool
+        """
+        temp_path = os.path.join(cwd, temp_file)
+        if return_code != 0:
+            log('视频[{}]合并失败：{}'.format(output_file, stderr.decode('utf-8', 'ignore').strip()[-200:]))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        os.replace(temp_path, os.path.join(cwd, output_file))
+        for name in cleanup:
+            path = os.path.join(cwd, name)
+            if os.path.exists(path):
+                os.remove(path)
+        log('视频[{}]合并完成！'.format(output_file))
+        return True
+
+    def submit(self, args, cwd, output_file, cleanup=()):
+        """
+        提交一个ffmpeg命令，args中的输出文件需为output_file + '.part'
+        :param args: 命令参数
+        :param cwd: 工作目录
+        :param output_file: 最终的文件名（相对cwd）
+        :param cleanup: 合并成功后删除的文件（相对cwd）
+        :return: Future
+        """
+        coroutine = self._run(args, cwd, output_file + '.part', output_file, list(cleanup))
+        if self._thread is None:
+            future = asyncio.ensure_future(coroutine, loop=self.loop)
+        else:
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def submit_concat(self, directory, movies, output_file):
+        """
+        提交多段视频的concat合并
+        :param directory: 分段所在目录
+        :param movies: 分段文件名列表，按顺序
+        :param output_file: 合并后的文件名
+        :return: Future
+        """
+        directory = os.path.abspath(directory)
+        list_file = output_file + '.txt'
+        with open(os.path.join(directory, list_file), 'w', encoding='utf-8') as f:
+            for movie in movies:
+                f.write('file ' + _quote(movie) + '\n')
+        """
+        ffmpeg
+        -f fmt（输入/输出）
+        强制输入或输出文件格式。输出到.part临时文件时无法从后缀名推断格式，需要指定
+        -c copy
+        不对流进行重新编码
+        """
+        args = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy',
+                '-f', os.path.splitext(output_file)[1].lstrip('.') or 'flv', output_file + '.part']
+        manifests = [movie + MANIFEST_SUFFIX for movie in movies]  # 分段的校验清单随分段一起删除
+        return self.submit(args, directory, output_file, movies + manifests + [list_file])
+
+    def submit_mux(self, directory, tracks, output_file):
+        """
+        提交DASH视频轨和音频轨的封装
+        :param directory: 轨道文件所在目录
+        :param tracks: 轨道文件名列表，视频轨在前
+        :param output_file: 封装后的文件名
+        :return: Future
+        """
+        directory = os.path.abspath(directory)
+        args = ['ffmpeg', '-y', '-loglevel', 'error']
+        for track in tracks:
+            args += ['-i', track]
+        for i in range(len(tracks)):
+            args += ['-map', '{}:0'.format(i)]
+        """
+        -movflags +faststart
+        把moov移到文件开头，边下边播时不必先读到文件末尾
+        """
+        args += ['-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', output_file + '.part']
+        manifests = [track + MANIFEST_SUFFIX for track in tracks]
+        return self.submit(args, directory, output_file, list(tracks) + manifests)
+
+    async def join_async(self):
+        """
+        在流水线所在的事件循环中等待所有合并任务完成
+        :return None
+        """
+        while self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    def join(self):
+        """
+        在其他线程中等待所有合并任务完成（仅用于后台线程模式）
+        :return None
+        """
+        for future in list(self._pending):
+            try:
+                future.result()
+            except Exception as e:
+                log(e)
+
+    def close(self):
+        """
+        等待所有合并任务完成并停止后台线程
+        :return None
+        """
+        if self._thread is not None:
+            self.join()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self._thread = None
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载和接口调用的指标，以Prometheus文本格式输出：可选在本地端口提供/metrics，也可在进程退出时写入文件
+import os
+import re
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)  # 首字节时间、接口耗时（秒）
+DURATION_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)  # 分段下载、合并耗时（秒）
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: 指标名
+        :param documentation: 说明
+        :param labelnames: 标签名
+        :return None
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {标签值: 计数}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        """
+        :param amount: 增加的数值
+        :param labels: 标签值
+        :return None
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in items]
+
+
+class Histogram(Counter):
+    """按上界分桶的直方图，同时记录总和与次数"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: 各桶的上界（升序），自动追加+Inf
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """
+        :param value: 观测值
+        :param labels: 标签值
+        :return None
+        """
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        记录with语句块的耗时
+        :param labels: 标签值
+        """
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - begin, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, ([list(state[0]), state[1], state[2]])) for key, state in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, key,
+                                                                                [('le', _format_value(bound))]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, key), _format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, key), count))
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Prometheus文本格式
+        :return: string
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+
+
+def get_registry():
+    """
+    获取进程级的指标注册表
+    :return: Registry
+    """
+    return _registry
+
+
+DOWNLOAD_BYTES = _registry.counter('bilibili_download_bytes_total', '各主机下载的字节数', ['host'])
+SEGMENT_SECONDS = _registry.histogram('bilibili_segment_duration_seconds', '单个视频分段的下载耗时', ['mode'],
+                                      DURATION_BUCKETS)
+FIRST_BYTE_SECONDS = _registry.histogram('bilibili_time_to_first_byte_seconds', '下载请求从发出到收到响应头的时间',
+                                         ['host'])
+RETRIES = _registry.counter('bilibili_retries_total',
+                            '重试次数，reason为retry（请求出错）、stall（速度过低）、verify（校验失败）或api（接口出错）',
+                            ['reason'])
+HEDGES = _registry.counter('bilibili_hedges_total', '尾部对冲请求，result为issued（发出）或won（先于原请求完成）',
+                           ['result'])
+STORE_BYTES = _registry.counter('bilibili_store_saved_bytes_total',
+                                '内容存储节省的字节数，result为hit（下载前命中，不再下载）或dedup（内容相同，只保留一份）',
+                                ['result'])
+API_SECONDS = _registry.histogram('bilibili_api_duration_seconds', '接口调用耗时', ['endpoint', 'status'])
+MERGE_SECONDS = _registry.histogram('bilibili_merge_duration_seconds', 'ffmpeg合并耗时', ['result'],
+                                    DURATION_BUCKETS)
+DANMAKU_SECONDS = _registry.histogram('bilibili_danmaku_convert_seconds', '弹幕转换为ASS的耗时', buckets=LATENCY_BUCKETS)
+
+
+def host_of(url):
+    """
+    :param url: 地址
+    :return: string 主机名
+    """
+    return urlparse(url).hostname or ''
+
+
+def endpoint_of(url):
+    """
+    接口地址对应的标签：主机名加路径，路径中的数字替换为{id}，查询参数去掉，避免标签值无限增长
+    例如https://api.bilibili.com/x/web-interface/view?aid=1 -> api.bilibili.com/x/web-interface/view
+    :param url: 地址
+    :return: string
+    """
+    parsed = urlparse(url)
+    return (parsed.hostname or '') + re.sub(r'\d+', '{id}', parsed.path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = _registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """
+    在后台线程中提供/metrics
+    :param port: 端口
+    :param host: 监听地址，默认只监听本机
+    :return: ThreadingHTTPServer
+    """
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def dump(file_name):
+    """
+    把当前指标写入文件（先写临时文件再替换，可供node_exporter的textfile收集器读取）
+    :param file_name: 文件路径
+    :return None
+    """
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w', encoding='utf-8') as f:
+        f.write(_registry.render())
+    os.replace(temp_name, file_name)
+
+
+def dump_at_exit(file_name):
+    """
+    进程退出时把指标写入文件
+    :param file_name: 文件路径
+    :return None
+    """
+    atexit.register(dump, file_name)
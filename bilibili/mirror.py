@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 视频分段的多镜像（durl中的url及backup_url）测速记录与排序
+import os
+import json
+import time
+import atexit
+import threading
+from urllib.parse import urlparse
+
+SCOREBOARD_FILE = os.path.join(os.path.expanduser('~'), '.bilibili_mirrors.json')  # 镜像测速记录的默认保存位置
+
+
+def get_host(url):
+    """
+    获取下载地址的主机名
+    :param url: 下载地址
+    :return: string
+    """
+    return urlparse(url).netloc
+
+
+class HostScoreboard:
+    """
+    按主机记录观测到的下载速度（指数加权平均）和出错次数，跨运行保存在JSON文件中
+    出错会降低得分，使下次分配区间时该镜像排在后面
+    """
+
+    alpha = 0.3  # 指数加权平均中新样本的权重
+    error_penalty = 0.5  # 每次出错后得分乘以该系数
+
+    def __init__(self, file_name=SCOREBOARD_FILE):
+        """
+        :param file_name: 保存记录的JSON文件路径，为None时不保存
+        :return None
+        """
+        self.file_name = file_name
+        self.hosts = {}  # {host: {'speed': 字节/秒, 'errors': 出错次数, 'updated': unix时间戳}}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.file_name:
+            return
+        try:
+            with open(self.file_name, 'r') as f:
+                self.hosts = json.load(f)
+        except (OSError, ValueError):
+            self.hosts = {}
+
+    def save(self):
+        """
+        写入JSON文件，先写临时文件再替换
+        :return None
+        """
+        if not self.file_name:
+            return
+        with self._lock:
+            temp_name = self.file_name + '.tmp'
+            try:
+                with open(temp_name, 'w') as f:
+                    json.dump(self.hosts, f)
+                os.replace(temp_name, self.file_name)
+            except OSError:
+                pass
+
+    def _entry(self, host):
+        return self.hosts.setdefault(host, {'speed': 0.0, 'errors': 0, 'updated': 0})
+
+    def record(self, url, size, seconds):
+        """
+        记录一次传输的速度
+        :param url: 下载地址
+        :param size: 传输的字节数
+        :param seconds: 耗时（秒）
+        :return None
+        """
+        if size <= 0 or seconds <= 0:
+            return
+        speed = size / seconds
+        with self._lock:
+            entry = self._entry(get_host(url))
+            entry['speed'] = speed if not entry['speed'] else (1 - self.alpha) * entry['speed'] + self.alpha * speed
+            entry['updated'] = time.time()
+
+    def record_error(self, url):
+        """
+        记录一次出错（连接失败、状态码异常或停滞超时）
+        :param url: 下载地址
+        :return None
+        """
+        with self._lock:
+            entry = self._entry(get_host(url))
+            entry['errors'] += 1
+            entry['speed'] *= self.error_penalty
+            entry['updated'] = time.time()
+
+    def score(self, url):
+        """
+        主机得分，没有记录的主机给一个中等分数，让新镜像也有机会被测速
+        :param url: 下载地址
+        :return: float
+        """
+        with self._lock:
+            entry = self.hosts.get(get_host(url))
+            if entry is None:
+                speeds = [x['speed'] for x in self.hosts.values() if x['speed'] > 0]
+                return sorted(speeds)[len(speeds) // 2] if speeds else 1.0
+            return entry['speed']
+
+    def rank(self, urls):
+        """
+        按得分从高到低排列下载地址，得分相同时保持原顺序（主地址优先）
+        :param urls: 下载地址列表
+        :return: list
+        """
+        return sorted(urls, key=lambda url: -self.score(url))
+
+
+_scoreboard = None
+_scoreboard_lock = threading.Lock()
+
+
+def get_scoreboard():
+    """
+    获取进程内共享的镜像记录，进程退出时自动保存
+    :return: HostScoreboard
+    """
+    global _scoreboard
+    with _scoreboard_lock:
+        if _scoreboard is None:
+            _scoreboard = HostScoreboard()
+            atexit.register(_scoreboard.save)
+        return _scoreboard
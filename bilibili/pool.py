@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 进程内共享的HTTP连接池，三种下载模式共用同一份连接、DNS缓存和TLS会话
+import atexit
+import asyncio
+import threading
+from contextlib import contextmanager
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ConnectionPool:
+    """
+    持有进程内唯一的requests.Session和aiohttp.ClientSession，负责创建和关闭
+    同一主机的连接保持keep-alive并复用，避免每个分段重新进行DNS解析、TCP握手和TLS握手
+    """
+
+    def __init__(self, limit=100, limit_per_host=16, dns_ttl=300, keepalive_timeout=60):
+        """
+        :param limit: 连接总数上限
+        :param limit_per_host: 每个主机的连接数上限
+        :param dns_ttl: DNS缓存时间（秒），仅aiohttp有效
+        :param keepalive_timeout: 空闲连接保持时间（秒），仅aiohttp有效
+        :return None
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._async_sessions = {}  # {事件循环: aiohttp.ClientSession}，批量下载时每个工作线程有自己的事件循环
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        线程间共享的requests.Session，urllib3按主机维护连接池并复用TLS连接
+        :return: requests.Session
+        """
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.limit, pool_maxsize=self.limit_per_host,
+                                      pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def async_session(self):
+        """
+        当前事件循环中共享的aiohttp.ClientSession，需在协程中调用
+        aiohttp的会话不能跨事件循环使用，每个事件循环各有一个，事件循环关闭前由async_close关闭
+        :return: aiohttp.ClientSession
+        """
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                                 ttl_dns_cache=self.dns_ttl, use_dns_cache=True,
+                                                 keepalive_timeout=self.keepalive_timeout, verify_ssl=False)
+                session = aiohttp.ClientSession(connector=connector)
+                self._async_sessions[loop] = session
+            return session
+
+    async def async_close(self):
+        """
+        关闭当前事件循环的aiohttp会话，必须在事件循环关闭前调用
+        :return None
+        """
+        with self._lock:
+            session = self._async_sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def close(self):
+        """
+        关闭requests会话
+        :return None
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    获取进程内共享的连接池，首次调用时创建，进程退出时自动关闭
+    :return: ConnectionPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+            atexit.register(_pool.close)
+        return _pool
+
+
+_worker = threading.local()
+
+
+@contextmanager
+def worker_loop():
+    """
+    工作线程在多个任务之间共用一个事件循环和其中的aiohttp会话，空闲连接保持keep-alive，下一个任务不必重新握手
+    with块内Video.async_download_video在该事件循环中运行且不关闭它，退出with块时才关闭会话和事件循环
+    :return: 事件循环
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _worker.loop = loop
+    try:
+        yield loop
+    finally:
+        _worker.loop = None
+        try:
+            loop.run_until_complete(get_pool().async_close())
+        finally:
+            loop.close()
+
+
+def get_worker_loop():
+    """
+    当前线程由worker_loop提供的长期事件循环
+    :return: 事件循环，不在worker_loop中时返回None
+    """
+    return getattr(_worker, 'loop', None)
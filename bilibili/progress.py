@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载进度汇总：各下载线程/协程只累加计数器，由一个后台线程按固定频率统一输出，
+# 终端中显示一个总进度条加每个任务一行，非终端（日志管道）中定期输出JSON行
+import sys
+import json
+import time
+import atexit
+import threading
+
+REFRESH_INTERVAL = 0.5  # 终端中的刷新间隔（秒）
+JSON_INTERVAL = 10  # 非终端中输出JSON行的间隔（秒）
+MAX_LINES = 10  # 终端中最多显示的任务行数，其余任务只计入总进度
+BAR_WIDTH = 30  # 总进度条宽度
+
+
+def _format_size(size):
+    """
+    :param size: 字节数
+    :return: string 例如'12.3MB'
+    """
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.2f}GB'.format(size)
+
+
+class ProgressTask:
+    """
+    单个任务（一个输出文件）的进度，update只做一次加法，不加锁，也不输出
+    """
+
+    def __init__(self, reporter, name, total=0):
+        """
+        :param reporter: 所属的ProgressReporter
+        :param name: 任务名，一般为文件名
+        :param total: 总字节数，未知时为0，可在得到文件大小后再设置
+        :return None
+        """
+        self.reporter = reporter
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.started = time.time()
+        self.finished = None
+        self._last_done = 0  # 上次输出时的进度，用于计算速度
+        self._last_time = self.started
+        self.speed = 0.0
+
+    def update(self, size):
+        """
+        :param size: 新收到的字节数
+        :return None
+        """
+        self.done += size  # 多个线程同时更新时偶尔少计一次，只影响显示
+
+    def reset(self, done=0):
+        """
+        重新开始计数，例如断点续传时从已完成的字节数开始，或校验失败后重新下载
+        :param done: 已完成的字节数
+        :return None
+        """
+        self.done = done
+        self._last_done = done
+
+    def close(self):
+        self.reporter.remove(self)
+
+    def _sample(self, now):
+        """计算两次输出之间的速度"""
+        elapsed = now - self._last_time
+        if elapsed > 0:
+            self.speed = max(0, self.done - self._last_done) / elapsed
+        self._last_done, self._last_time = self.done, now
+
+    def to_dict(self):
+        return {'name': self.name, 'done': self.done, 'total': self.total, 'speed': int(self.speed),
+                'status': 'done' if self.finished else 'running'}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ProgressReporter:
+    """
+    进度输出器，有任务时启动后台线程按固定频率输出，没有任务时线程空转等待
+    日志信息通过write输出，终端中会先擦除进度行再打印，避免与进度条交错
+    """
+
+    def __init__(self, stream=None, json_lines=None, interval=None):
+        """
+        :param stream: 输出流，默认为标准输出
+        :param json_lines: 是否输出JSON行，None时根据输出流是否为终端决定
+        :param interval: 输出间隔（秒），None时终端为REFRESH_INTERVAL，JSON行为JSON_INTERVAL
+        :return None
+        """
+        self.stream = stream or sys.stdout
+        if json_lines is None:
+            json_lines = not (hasattr(self.stream, 'isatty') and self.stream.isatty())
+        self.json_lines = json_lines
+        self.interval = interval or (JSON_INTERVAL if json_lines else REFRESH_INTERVAL)
+        self._tasks = []
+        self._finished = []  # 上次输出后结束的任务，JSON行中最后输出一次
+        self._done_bytes = 0  # 已结束任务的字节数，计入总进度
+        self._done_total = 0
+        self._lock = threading.RLock()
+        self._drawn = 0  # 终端中上次输出的行数
+        self._stop = threading.Event()
+        self._thread = None
+
+    def task(self, name, total=0):
+        """
+        新建任务
+        :param name: 任务名
+        :param total: 总字节数
+        :return: ProgressTask 可用作上下文管理器，退出时结束任务
+        """
+        task = ProgressTask(self, name, total)
+        with self._lock:
+            self._tasks.append(task)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return task
+
+    def remove(self, task):
+        """
+        结束任务
+        :param task: ProgressTask对象
+        :return None
+        """
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.remove(task)
+                task.finished = time.time()
+                self._finished.append(task)
+                self._done_bytes += task.done
+                self._done_total += task.total or task.done
+
+    def write(self, message):
+        """
+        输出一行日志，JSON行模式中同样输出为JSON
+        :param message: 日志内容
+        :return None
+        """
+        with self._lock:
+            if self.json_lines:
+                self.stream.write(json.dumps({'time': int(time.time()), 'message': str(message)},
+                                             ensure_ascii=False) + '\n')
+                self.stream.flush()
+                return
+            self._clear()
+            self.stream.write(str(message) + '\n')
+            self._draw()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    def render(self):
+        """输出一次当前进度"""
+        with self._lock:
+            now = time.time()
+            for task in self._tasks:
+                task._sample(now)
+            if self.json_lines:
+                self._emit_json(now)
+            else:
+                self._clear()
+                self._draw()
+            self._finished = []
+
+    def _overall(self):
+        done = self._done_bytes + sum(task.done for task in self._tasks)
+        total = self._done_total + sum(task.total or task.done for task in self._tasks)
+        return done, total, sum(task.speed for task in self._tasks)
+
+    def _emit_json(self, now):
+        if not self._tasks and not self._finished:
+            return
+        done, total, speed = self._overall()
+        line = {'time': int(now), 'done': done, 'total': total, 'speed': int(speed),
+                'jobs': [task.to_dict() for task in self._finished + self._tasks]}
+        self.stream.write(json.dumps(line, ensure_ascii=False) + '\n')
+        self.stream.flush()
+
+    def _clear(self):
+        """擦除终端中上次输出的进度行"""
+        if not self.json_lines and self._drawn:
+            self.stream.write('\x1b[{}F\x1b[J'.format(self._drawn))  # 光标上移并清除到屏幕末尾
+            self._drawn = 0
+
+    def _draw(self):
+        """在终端中输出总进度条和各任务的进度行"""
+        if self.json_lines or not self._tasks:
+            return
+        done, total, speed = self._overall()
+        ratio = min(1.0, done / total) if total else 0.0
+        filled = int(BAR_WIDTH * ratio)
+        lines = ['[{}{}] {:5.1f}% {}/{} {}/s 进行中{}个'.format('#' * filled, '-' * (BAR_WIDTH - filled), ratio * 100,
+                                                           _format_size(done), _format_size(total),
+                                                           _format_size(speed), len(self._tasks))]
+        for task in self._tasks[:MAX_LINES]:
+            percent = '{:5.1f}%'.format(task.done * 100 / task.total) if task.total else '  ?  '
+            lines.append('  {} {} {}/s'.format(percent, _format_size(task.done), _format_size(task.speed)) +
+                         '  ' + task.name)
+        if len(self._tasks) > MAX_LINES:
+            lines.append('  ...另有{}个任务'.format(len(self._tasks) - MAX_LINES))
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+        self._drawn = len(lines)
+
+    def close(self):
+        """
+        停止后台线程并输出最后一次进度
+        :return None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.render()
+
+
+_reporter = None
+_reporter_lock = threading.Lock()
+
+
+def get_progress():
+    """
+    获取进程级的进度输出器，所有下载共用，进程退出时输出最后一次进度
+    :return: ProgressReporter
+    """
+    global _reporter
+    with _reporter_lock:
+        if _reporter is None:
+            _reporter = ProgressReporter()
+            atexit.register(_reporter.close)
+        return _reporter
+
+
+def log(message):
+    """
+    代替print输出下载过程中的信息，与进度行不会交错
+    :param message: 日志内容
+    :return None
+    """
+    get_progress().write(message)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 各分P可用清晰度（playurl返回的accept_quality）的缓存，跨运行保存在JSON文件中，过期后重新获取
+import os
+import json
+import time
+import atexit
+import threading
+
+QUALITY_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.bilibili_quality.json')  # 清晰度缓存的默认保存位置
+QUALITY_TTL = 24 * 3600  # 缓存有效期（秒），视频重新转码后可用清晰度可能变化
+MAX_ENTRIES = 100000  # 最多保存的分P数，超过时删除最早的记录
+
+
+class QualityCache:
+    """
+    按cid记录可用清晰度（从高到低）
+    playurl总是先请求最高清晰度，接口拒绝且响应中没有accept_quality时才需要查缓存，有记录就不必再发qn=15的探测请求；
+    缓存不用来决定首次请求的清晰度，视频重新转码出更高清晰度后不会被过期的记录压低
+    """
+
+    def __init__(self, file_name=QUALITY_CACHE_FILE, ttl=QUALITY_TTL):
+        """
+        :param file_name: 保存记录的JSON文件路径，为None时不保存
+        :param ttl: 有效期（秒）
+        :return None
+        """
+        self.file_name = file_name
+        self.ttl = ttl
+        self.entries = {}  # {cid: {'accept': [qn, ...], 'updated': unix时间戳}}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not self.file_name:
+            return
+        try:
+            with open(self.file_name, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        """
+        删除过期的记录后写入JSON文件，先写临时文件再替换，没有变化时不写
+        :return None
+        """
+        if not self.file_name or not self._dirty:
+            return
+        with self._lock:
+            now = time.time()
+            entries = sorted(((cid, entry) for cid, entry in self.entries.items()
+                              if now - entry['updated'] < self.ttl), key=lambda item: item[1]['updated'])
+            self.entries = dict(entries[-MAX_ENTRIES:])
+            temp_name = self.file_name + '.tmp'
+            try:
+                with open(temp_name, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(temp_name, self.file_name)
+                self._dirty = False
+            except OSError:
+                pass
+
+    def get(self, cid):
+        """
+        :param cid: 分P的cid
+        :return: list 可用清晰度，从高到低，没有记录或已过期时返回None
+        """
+        with self._lock:
+            entry = self.entries.get(str(cid))
+            if entry is None or time.time() - entry['updated'] >= self.ttl:
+                return None
+            return entry['accept']
+
+    def set(self, cid, accept_quality):
+        """
+        :param cid: 分P的cid
+        :param accept_quality: playurl返回的accept_quality
+        :return None
+        """
+        if not accept_quality:
+            return
+        with self._lock:
+            self.entries[str(cid)] = {'accept': sorted(accept_quality, reverse=True), 'updated': time.time()}
+            self._dirty = True
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_quality_cache():
+    """
+    获取进程内共享的清晰度缓存，进程退出时自动保存
+    :return: QualityCache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QualityCache()
+            atexit.register(_cache.save)
+        return _cache
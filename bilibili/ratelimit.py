@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 令牌桶限速，所有下载路径（requests、aiohttp、区间下载）共用进程级的全局限速，并可叠加单个任务的限速
+import re
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """
+    令牌桶，rate为每秒补充的字节数，burst为桶的容量（允许的突发字节数）
+    consume采用预支方式：令牌不足时直接记账为负数并返回需要等待的时间，不在锁内睡眠，
+    每个数据块只有一次加锁和几次浮点运算，高速下载时的CPU开销可以忽略
+    """
+
+    def __init__(self, rate=0, burst=None):
+        """
+        :param rate: 每秒字节数，0表示不限速
+        :param burst: 突发字节数，默认为1秒的流量
+        :return None
+        """
+        self._lock = threading.Lock()
+        self.consumed = 0  # 累计通过的字节数，用于统计吞吐量
+        self.rate = 0
+        self.burst = 0
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """
+        运行时修改速率，立即对后续的数据块生效
+        :param rate: 每秒字节数，0表示不限速
+        :param burst: 突发字节数，默认为1秒的流量
+        :return None
+        """
+        with self._lock:
+            self.rate = max(0, rate or 0)
+            self.burst = burst if burst is not None else self.rate
+            self._tokens = min(self._tokens, self.burst)
+            self._updated = time.monotonic()
+
+    def consume(self, size):
+        """
+        取出size个令牌
+        :param size: 字节数
+        :return: float 需要等待的秒数，0表示无需等待
+        """
+        self.consumed += size  # 仅用于统计，不加锁，并发时偶尔少计一次不影响结果
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+def throttle(size, *buckets):
+    """
+    按所有给定的令牌桶限速，阻塞当前线程
+    :param size: 本次传输的字节数
+    :param buckets: 令牌桶，None会被忽略
+    :return: float 等待的秒数
+    """
+    delay = max([bucket.consume(size) for bucket in buckets if bucket is not None] or [0])
+    if delay > 0:
+        time.sleep(delay)
+    return delay
+
+
+async def throttle_async(size, *buckets):
+    """
+    throttle的协程版本
+    :param size: 本次传输的字节数
+    :param buckets: 令牌桶，None会被忽略
+    :return: float 等待的秒数
+    """
+    delay = max([bucket.consume(size) for bucket in buckets if bucket is not None] or [0])
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return delay
+
+
+def parse_rate(value):
+    """
+    解析带单位的速率，例如'500K'、'10M'、'1.5G'，单位为字节/秒
+    :param value: 字符串或数字
+    :return: int
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.match(r'^\s*([\d.]+)\s*([KMG]?)B?\s*$', value, re.I)
+    if not match:
+        raise ValueError('无法识别的速率: {}'.format(value))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMG'.index(unit.upper() or ' '))
+
+
+_bucket = TokenBucket()
+
+
+def get_bucket():
+    """
+    获取进程级的全局令牌桶，默认不限速
+    :return: TokenBucket
+    """
+    return _bucket
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 重试与停滞检测：指数退避加随机抖动，最低速度看门狗，尾部对冲请求的公共部分
+import time
+import random
+import asyncio
+
+RETRY_ATTEMPTS = 5  # 单个请求（或单个区间）的总尝试次数
+BACKOFF_BASE = 0.5  # 第一次重试前的最长等待（秒），之后每次翻倍
+BACKOFF_CAP = 30  # 单次等待的上限（秒）
+RETRY_STATUS = (429, 500, 502, 503, 504)  # 可以重试的状态码
+
+MIN_SPEED = 16 * 1024  # 最低速度（字节/秒），连续STALL_WINDOW秒低于该速度视为停滞
+STALL_WINDOW = 15  # 停滞检测窗口（秒）
+
+HEDGE_THRESHOLD = 0.95  # 分段完成到该比例后，仍在下载的区间向另一个镜像发出对冲请求
+HEDGE_MIN_SIZE = 512 * 1024  # 剩余不足该字节数的区间不对冲
+HEDGE_INTERVAL = 1.0  # 检查是否需要对冲的间隔（秒）
+
+
+class StallError(IOError):
+    """传输速度持续低于最低速度"""
+
+
+class DownloadError(IOError):
+    """区间的所有镜像和重试次数都已用完，本次下载失败，只影响所在的分P"""
+
+
+class HedgeCancelled(Exception):
+    """对冲的另一方已先完成，本方停止下载"""
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    第attempt次重试前的等待时间：在[0, min(cap, base * 2 ** attempt)]中均匀随机（full jitter），
+    避免大量连接在同一时刻重试
+    :param attempt: 已失败的次数，从0开始
+    :param base: 基础等待时间（秒）
+    :param cap: 等待上限（秒）
+    :return: float 秒
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def sleep_backoff(attempt):
+    """
+    阻塞等待backoff(attempt)秒
+    :param attempt: 已失败的次数
+    :return None
+    """
+    time.sleep(backoff(attempt))
+
+
+async def sleep_backoff_async(attempt):
+    """
+    sleep_backoff的协程版本
+    :param attempt: 已失败的次数
+    :return None
+    """
+    await asyncio.sleep(backoff(attempt))
+
+
+class SpeedWatchdog:
+    """
+    最低速度看门狗，下载循环每收到一块数据并限速后调用一次update
+    完全没有数据到达的情况由请求的读取超时处理，这里处理有数据但速度过低的连接；
+    令牌桶限速等待的时间不计入检测窗口，用户有意限速时连接变慢不算停滞
+    """
+
+    def __init__(self, min_speed=MIN_SPEED, window=STALL_WINDOW, cancelled=None, clock=time.monotonic):
+        """
+        :param min_speed: 最低速度（字节/秒），0表示不检测
+        :param window: 检测窗口（秒）
+        :param cancelled: 返回True时停止下载的函数，用于对冲请求的取消
+        :param clock: 返回当前时间（秒）的函数
+        :return None
+        """
+        self.min_speed = min_speed
+        self.window = window
+        self.cancelled = cancelled
+        self.clock = clock
+        self._window_start = clock()
+        self._window_bytes = 0
+
+    def update(self, size, paused=0):
+        """
+        :param size: 新收到的字节数
+        :param paused: 收到这块数据后限速等待的秒数（ratelimit.throttle的返回值）
+        :return None
+        """
+        if self.cancelled is not None and self.cancelled():
+            raise HedgeCancelled()
+        self._window_bytes += size
+        self._window_start += paused
+        now = self.clock()
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            if self.min_speed and self._window_bytes < self.min_speed * elapsed:
+                raise StallError('{:.0f}秒内只收到{}字节，低于最低速度{}字节/秒'.format(elapsed, self._window_bytes,
+                                                                           self.min_speed))
+            self._window_start = now
+            self._window_bytes = 0
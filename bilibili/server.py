@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 常驻进程：连接池、镜像记录、并发控制器等在进程内保持预热，通过本地HTTP接口（TCP或Unix套接字）接收下载任务
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import socketserver
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ratelimit import parse_rate
+from metrics import get_registry
+from pool import worker_loop
+from progress import log
+
+QUEUED = 'queued'  # 等待下载
+RUNNING = 'running'  # 正在下载
+DONE = 'done'  # 下载完成
+FAILED = 'failed'  # 下载出错
+
+
+class Job:
+    """一个下载任务及其状态"""
+
+    def __init__(self, job_id, aid, pages=None, danmu=False, directory=r'video', connections=1, rate=0):
+        """
+        :param job_id: 任务编号
+        :param aid: AV号
+        :param pages: 要下载的分P序号（从1开始），None表示全部
+        :param danmu: 是否下载弹幕
+        :param directory: 下载目录
+        :param connections: 单个视频分段的并行连接数
+        :param rate: 本任务的下载限速（字节/秒），0表示不限速
+        :return None
+        """
+        self.id = job_id
+        self.aid = aid
+        self.pages = pages
+        self.danmu = danmu
+        self.directory = directory
+        self.connections = connections
+        self.rate = rate
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.bucket = None  # 运行时为所属Video的令牌桶，从中读取已下载的字节数
+
+    @property
+    def key(self):
+        """
+        同一视频下载到同一目录的任务写同一批.part文件和进度文件，不能同时运行
+        :return: tuple (aid, 下载目录的绝对路径)
+        """
+        return self.aid, os.path.abspath(self.directory)
+
+    def covers(self, pages, danmu):
+        """
+        本任务是否已包含另一次提交要下载的内容
+        :param pages: 分P序号列表，None表示全部
+        :param danmu: 是否下载弹幕
+        :return: bool
+        """
+        return (self.pages is None or (pages is not None and set(pages) <= set(self.pages))) and \
+            (self.danmu or not danmu)
+
+    def merge(self, pages, danmu):
+        """
+        把另一次提交并入尚未开始的本任务，连接数和限速保持本任务的设置
+        :param pages: 分P序号列表，None表示全部
+        :param danmu: 是否下载弹幕
+        :return None
+        """
+        self.pages = None if self.pages is None or pages is None else sorted(set(self.pages) | set(pages))
+        self.danmu = self.danmu or danmu
+
+    def to_dict(self):
+        """
+        任务状态，bytes和speed（字节/秒）为本任务的下载量和平均速度
+        :return: dict
+        """
+        size = self.bucket.consumed if self.bucket is not None else 0
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0
+        return {
+            'id': self.id,
+            'aid': self.aid,
+            'pages': self.pages,
+            'danmu': self.danmu,
+            'directory': self.directory,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'bytes': size,
+            'speed': size / elapsed if elapsed > 0 else 0,
+        }
+
+
+class DownloadServer:
+    """
+    任务队列和工作线程，HTTP接口只负责提交和查询
+    """
+
+    max_jobs = 1000  # 保留的任务记录数，超过时删除最早结束的任务
+
+    def __init__(self, download, workers=4, directory=r'video', connections=1):
+        """
+        :param download: 下载函数，参数为Job，运行时需设置job.bucket，出错时抛出异常，有分P未完整下载时返回False
+        :param workers: 同时下载的任务数
+        :param directory: 任务未指定下载目录时使用的目录
+        :param connections: 任务未指定连接数时使用的连接数
+        :return None
+        """
+        self.download = download
+        self.directory = directory
+        self.connections = connections
+        self.jobs = OrderedDict()  # {任务编号: Job}
+        self._queue = queue.Queue()
+        self._running = {}  # {Job.key: 正在运行的Job}
+        self._deferred = {}  # {Job.key: [Job, ...]}，同一视频和目录的任务正在运行，结束后再排队
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, params):
+        """
+        提交任务
+        同一视频和下载目录已有任务时不新建：排队中的任务合并本次的分P和弹幕，
+        正在运行且已包含本次内容的任务直接返回，否则新建的任务等正在运行的任务结束后才开始
+        :param params: dict，aid必填，可选pages（序号列表）、danmu、directory、connections、rate
+        :return: tuple (Job, 是否新建)
+        """
+        aid = str(params.get('aid', '')).lower()
+        aid = aid[2:] if aid.startswith('av') else aid
+        if not aid.isdigit():
+            raise ValueError('aid无效')
+        pages = params.get('pages')
+        if pages is not None:
+            if not isinstance(pages, list) or not all(isinstance(x, int) and x > 0 for x in pages):
+                raise ValueError('pages应为从1开始的分P序号列表')
+            pages = sorted(set(pages))
+        rate = parse_rate(params.get('rate'))  # 格式错误时抛出ValueError
+        danmu = bool(params.get('danmu'))
+        with self._lock:
+            job = Job(self._next_id, aid, pages, danmu, params.get('directory') or self.directory,
+                      int(params.get('connections') or self.connections), rate)
+            existing = [x for x in self.jobs.values() if x.status in (QUEUED, RUNNING) and x.key == job.key]
+            for other in existing:
+                if other.covers(pages, danmu):
+                    return other, False
+            for other in existing:
+                if other.status == QUEUED:
+                    other.merge(pages, danmu)
+                    return other, False
+            self._next_id += 1
+            self.jobs[job.id] = job
+            self._prune()
+        self._queue.put(job)
+        return job, True
+
+    def _prune(self):
+        """删除最早结束的任务记录，调用时需持有锁"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _work(self):
+        with worker_loop():  # 工作线程的事件循环和aiohttp会话在任务之间保持，连接不必每个任务重新建立
+            while True:
+                job = self._queue.get()
+                with self._lock:  # 在锁内开始，之后提交的同一任务不会再并入它
+                    if job.key in self._running:
+                        self._deferred.setdefault(job.key, []).append(job)
+                        continue
+                    self._running[job.key] = job
+                    job.status = RUNNING
+                    job.started = time.time()
+                try:
+                    if self.download(job) is False:
+                        raise IOError('部分分P未完整下载')
+                except (Exception, SystemExit) as e:  # 接口出错时抛出util.ApiError，下载目录无效时会调用exit
+                    job.status = FAILED
+                    job.error = str(e)
+                else:
+                    job.status = DONE
+                finally:
+                    job.finished = time.time()
+                    with self._lock:
+                        del self._running[job.key]
+                        deferred = self._deferred.pop(job.key, [])
+                    for other in deferred:
+                        self._queue.put(other)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs           提交任务，请求体为JSON，例如{"aid": 170001, "pages": [1, 2], "danmu": true}，
+                         同一视频和目录已有任务时返回200和该任务，新建时返回201
+    GET  /jobs           所有任务的状态
+    GET  /jobs/<编号>    单个任务的状态
+    GET  /metrics        Prometheus格式的指标
+    """
+
+    server_version = 'BilibiliDownloader'
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        downloader = self.server.downloader
+        path = self.path.rstrip('/')
+        if path == '/metrics':
+            body = get_registry().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/jobs':
+            self._send_json(200, [job.to_dict() for job in downloader.list()])
+        elif path.startswith('/jobs/') and path[6:].isdigit():
+            job = downloader.get(int(path[6:]))
+            if job is None:
+                self._send_json(404, {'error': '任务不存在'})
+            else:
+                self._send_json(200, job.to_dict())
+        else:
+            self._send_json(404, {'error': '未知的地址'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': '未知的地址'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            params = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            if not isinstance(params, dict):
+                raise ValueError('请求体应为JSON对象')
+            job, created = self.server.downloader.submit(params)
+        except (TypeError, ValueError) as e:  # 包括JSON解析错误
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(201 if created else 200, job.to_dict())  # 并入已有任务时返回该任务
+
+    def address_string(self):
+        # Unix套接字的客户端地址为空字符串
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        pass  # 任务状态通过接口查询，不逐条打印请求日志
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """监听Unix套接字的HTTP服务器"""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):  # 上次运行遗留的套接字文件
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def serve(downloader: DownloadServer, host='127.0.0.1', port=8765, unix_socket=None):
+    """
+    启动HTTP接口并一直运行，Ctrl+C退出
+    :param downloader: DownloadServer对象
+    :param host: 监听地址，默认只监听本机
+    :param port: 监听端口
+    :param unix_socket: Unix套接字路径，给出时不监听TCP端口
+    :return None
+    """
+    if unix_socket:
+        httpd = UnixHTTPServer(unix_socket, JobRequestHandler)
+        log('>>>服务已启动：{}'.format(unix_socket))
+    else:
+        httpd = ThreadingHTTPServer((host, port), JobRequestHandler)
+        log('>>>服务已启动：http://{}:{}/jobs'.format(host, port))
+    httpd.downloader = downloader
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
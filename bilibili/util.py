@@ -5,10 +5,25 @@ import re
 import json
 import time
 import zlib
+import asyncio
 import hashlib
-import urllib.request
+import aiohttp
+import requests
+from contextlib import closing
 from urllib.parse import quote
-from urllib.error import HTTPError
+from urllib3.exceptions import HTTPError as TransportError
+from pool import get_pool
+from concurrency import get_controller
+from metrics import API_SECONDS, RETRIES, endpoint_of
+from retry import RETRY_ATTEMPTS, RETRY_STATUS, sleep_backoff, sleep_backoff_async
+from httpcache import get_http_cache
+
+try:
+    import brotli  # 可选依赖，用于解压br编码的响应
+    brotli_error = brotli.error
+except ImportError:
+    brotli = None
+    brotli_error = zlib.error
 
 
 class JsonInfo:
@@ -17,11 +32,12 @@ class JsonInfo:
     error = False  # 是否出错
     error_msg = ""  # 错误信息
 
-    def __init__(self, url, pre_deal=lambda x: x):
+    def __init__(self, url, pre_deal=lambda x: x, content=None):
         """
         将网址信息解析为json格式
         :param url: 网址
         :param pre_deal: 预处理函数
+        :param content: 已经取得的响应体，为None时同步请求url
         """
         """
         json.loads(s, *, encoding=None,...)
@@ -29,7 +45,9 @@ class JsonInfo:
         要使用自定义JSONDecoder子类，请使用cls kwarg指定它; 否则使用JSONDecoder。其他关键字参数将传递给类的构造函数。
         如果要反序列化的数据不是有效的JSON文档， 则会引发JSONDecodeError。输入编码应为UTF-8，UTF-16或UTF-32。
         """
-        self.json = json.loads(pre_deal(get_url_content(url)))
+        if content is None:
+            content = get_url_content(url)
+        self.json = json.loads(pre_deal(content))
 
         if 'code' in self.json.keys() and self.json['code'] != 0:
             if 'message' in self.json.keys():
@@ -37,6 +55,7 @@ class JsonInfo:
             elif 'error' in self.json.keys():
                 self.error_msg = self.get_value('error')
             self.error = True
+            get_http_cache().invalidate(url)  # 错误响应（例如被限流）不留在缓存中
 
     def get_value(self, *keys):
         """
@@ -59,71 +78,285 @@ class JsonInfo:
         return temp
 
 
+class ApiError(Exception):
+    """接口请求出错，库的调用者可以捕获后重试，而不是整个进程退出"""
+
+    def __init__(self, message, url=None):
+        super().__init__(message)
+        self.url = url
+
+
+class ApiHttpError(ApiError):
+    """接口返回了错误的状态码"""
+
+    def __init__(self, status, url=None):
+        super().__init__('HTTP {}'.format(status), url)
+        self.status = status
+
+
+class ApiConnectionError(ApiError):
+    """连接失败、超时或响应体无法解码"""
+
+
+class ApiResponseError(ApiError):
+    """接口返回的JSON中code不为0"""
+
+    def __init__(self, message, url=None, code=None):
+        super().__init__(message, url)
+        self.code = code
+
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'  # 没有brotli模块时不声明br
+READ_CHUNK_SIZE = 64 * 1024
+API_TIMEOUT = (10, 30)  # 连接超时和读取超时（秒）
+DEFAULT_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Accept-Language': 'zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.80 Safari/537.36'
+}
+
+
+class StreamDecoder:
+    """
+    按Content-Encoding逐块解压响应体，边收边解，不必先把压缩数据完整读入内存
+    """
+
+    def __init__(self, encoding):
+        """
+        :param encoding: Content-Encoding，支持gzip、deflate、br，其他值原样返回
+        :return None
+        """
+        self.encoding = (encoding or '').strip().lower()
+        self._first = True
+        if self.encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        elif self.encoding == 'br':
+            if brotli is None:
+                raise ApiConnectionError('响应使用了brotli压缩，请安装brotli模块')
+            self._decoder = brotli.Decompressor()
+        else:
+            self._decoder = None
+
+    def decode(self, data):
+        """
+        :param data: 一块压缩数据
+        :return: bytes 解压后的数据
+        """
+        if self._decoder is None:
+            return data
+        if self.encoding == 'br':
+            return self._decoder.process(data)
+        if self._first and self.encoding == 'deflate':
+            self._first = False
+            try:
+                return self._decoder.decompress(data)
+            except zlib.error:  # 部分服务器的deflate不带zlib头尾
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(data)
+
+    def flush(self):
+        if self._decoder is None or self.encoding == 'br':
+            return b''
+        return self._decoder.flush()
+
+
+def _read_body(response):
+    """
+    读取并逐块解压响应体
+    :param response: requests.Response，stream=True
+    :return: bytes
+    """
+    decoder = StreamDecoder(response.headers.get('Content-Encoding'))
+    chunks = []
+    received = 0
+    try:
+        for data in response.raw.stream(READ_CHUNK_SIZE, decode_content=False):
+            received += len(data)
+            chunks.append(decoder.decode(data))
+        chunks.append(decoder.flush())
+    except (zlib.error, brotli_error) as e:
+        raise ApiConnectionError('响应体解压失败：{}'.format(e), response.url)
+    except TransportError as e:  # 读到一半连接断开或读取超时，urllib3的异常不是requests.RequestException
+        raise ApiConnectionError('响应体读取失败：{}'.format(e), response.url)
+    # 旧版urllib3流式读取时不检查Content-Length，连接提前关闭会得到不完整的响应体
+    expected = response.headers.get('Content-Length')
+    if expected and expected.isdigit() and received < int(expected):
+        raise ApiConnectionError('响应体不完整：{}/{}字节'.format(received, expected), response.url)
+    return b''.join(chunks)
+
+
 def get_url_content(url, headers=None):
     """
     根据所给地址请求并返回网页信息
+    使用连接池中共享的keep-alive会话，同一主机不必每次重新进行TCP和TLS握手
     :param url: 网址
     :param headers: 自定义请求头
-    :return: string 网页信息
+    :return: bytes 网页信息，404时返回空字符串
+    :raise ApiHttpError: 状态码错误且重试次数用完
+    :raise ApiConnectionError: 网络错误且重试次数用完
     """
-    page = ""
-    content = ""
     if not headers:
-        headers = {
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Accept-Language': 'zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.80 Safari/537.36'
-        }
+        headers = DEFAULT_HEADERS
 
-    try:
-        request = urllib.request.Request(url=url, headers=headers)
-        page = urllib.request.urlopen(request)
-        content = page.read()
-    except HTTPError as e:
-        if e.code == 404:
-            return ""
-        else:
-            exit(e)
-    except Exception as e:
-        exit(e)
+    cache = get_http_cache()
+    cached = cache.lookup(url)
+    if cached is not None:
+        if cached.fresh:
+            return cached.body
+        headers = dict(headers, **cached.validators)  # 过期的记录先向服务器确认是否有变化
 
-    if page.info().get('Content-Encoding') == 'gzip':  # info()返回页面头信息字典
-        """
-        zlib.decompress(string[, wbits[, bufsize]])
-        解压缩字符串数据，返回包含未压缩数据的字符串。
-        wbits参数取决于字符串格式。
-        如果给出bufsize，则将其用作输出缓冲区的初始大小。
-        如果发生任何错误，则引发异常error。
-
-        该wbits参数控制历史缓冲区的大小（或“窗口大小”），头部和尾部的格式是预先定好的。
-        它类似于compressobj()参数，但接受更多范围的值：
-        +8到+15：基于2的对数的窗口大小。输入必须包含zlib头部和尾部。
-        0：从zlib头部自动确定窗口大小。仅自zlib 1.2.3.5起支持。
-        -8到-15：使用wbits的绝对值作为窗口大小的对数。输入必须是没有头部和尾部的原始数据流。
-        +24到+31 = 16 +（8到15）：使用该值的低4位作为窗口大小对数。输入必须包含gzip头部和尾部。
-        +40到+47 = 32 +（8到15）：使用该值的低4位作为窗口大小对数，并自动接受zlib或gzip格式。
-
-        解压缩流时，窗口大小不得小于最初用于压缩流的大小; 使用太小的值可能会导致error异常。
-        默认的wbits值为15，这对应于最大窗口大小（zlib.MAX_WBITS），并且需要包含zlib头部和尾部。
-
-        bufsize是用于保存解压缩数据的缓冲区的初始大小。
-        如果需要更多空间，缓冲区大小将根据需要增加，因此您不必完全正确地获取此值; 
-        调整它只会节省几个malloc()调用。默认大小为16384。
-        """
-        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
-        # content = str(content, encoding='utf-8')
+    session = get_pool().session
+    limiter = get_controller().for_url(url)  # 接口主机单独的并发预算
+    error = None
+    for attempt in range(RETRY_ATTEMPTS):
+        begin = time.time()
+        status = None
+        try:
+            with limiter.slot():
+                begin = time.time()
+                with closing(session.get(url, headers=headers, stream=True, timeout=API_TIMEOUT)) as response:
+                    latency = time.time() - begin
+                    status = response.status_code
+                    if status == 304 and cached is not None:  # 没有变化，继续使用缓存
+                        API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+                        cache.refresh(url, response.headers)
+                        return cached.body
+                    if status == 404:
+                        API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+                        return ""
+                    if status >= 400:
+                        raise ApiHttpError(status, url)
+                    content = _read_body(response)
+                    response_headers = response.headers
+            limiter.success(len(content), latency)
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+            break
+        except ApiHttpError as e:
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=e.status)
+            limiter.failure(e.status)
+            if e.status not in RETRY_STATUS:
+                raise
+            error = e
+        except (requests.RequestException, ApiConnectionError) as e:
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status='error')
+            limiter.failure(status)
+            error = e if isinstance(e, ApiConnectionError) else ApiConnectionError(str(e), url)
+        if attempt == RETRY_ATTEMPTS - 1:
+            raise error
+        RETRIES.inc(reason='api')
+        sleep_backoff(attempt)  # 限流或服务端临时错误，加随机抖动的指数退避后重试
+
+    cache.store(url, content, response_headers)
     return content
 
 
-def get_json_info(url):
-    json_info = JsonInfo(url)
+async def get_url_content_async(url, headers=None):
+    """
+    get_url_content的协程版本，在调用者的事件循环中运行，使用该事件循环共享的aiohttp会话
+    缓存、并发控制、重试和异常与同步版本相同；响应体由aiohttp按Content-Encoding解压
+    :param url: 网址
+    :param headers: 自定义请求头
+    :return: bytes 网页信息，404时返回空字符串
+    :raise ApiHttpError: 状态码错误且重试次数用完
+    :raise ApiConnectionError: 网络错误且重试次数用完
+    """
+    if not headers:
+        headers = DEFAULT_HEADERS
+
+    cache = get_http_cache()
+    cached = cache.lookup(url)
+    if cached is not None:
+        if cached.fresh:
+            return cached.body
+        headers = dict(headers, **cached.validators)
+
+    session = get_pool().async_session()
+    limiter = get_controller().for_url(url)
+    timeout = aiohttp.ClientTimeout(sock_connect=API_TIMEOUT[0], sock_read=API_TIMEOUT[1])
+    error = None
+    for attempt in range(RETRY_ATTEMPTS):
+        begin = time.time()
+        status = None
+        await limiter.acquire_async()
+        try:
+            begin = time.time()
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                latency = time.time() - begin
+                status = response.status
+                if status == 304 and cached is not None:
+                    API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+                    cache.refresh(url, response.headers)
+                    return cached.body
+                if status == 404:
+                    API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+                    return ""
+                if status >= 400:
+                    raise ApiHttpError(status, url)
+                chunks = []
+                async for data in response.content.iter_chunked(READ_CHUNK_SIZE):
+                    chunks.append(data)
+                content = b''.join(chunks)
+                response_headers = response.headers
+            limiter.success(len(content), latency)
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=status)
+            break
+        except ApiHttpError as e:
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status=e.status)
+            limiter.failure(e.status)
+            if e.status not in RETRY_STATUS:
+                raise
+            error = e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            API_SECONDS.observe(time.time() - begin, endpoint=endpoint_of(url), status='error')
+            limiter.failure(status)
+            error = ApiConnectionError(str(e) or type(e).__name__, url)
+        finally:
+            limiter.release()
+        if attempt == RETRY_ATTEMPTS - 1:
+            raise error
+        RETRIES.inc(reason='api')
+        await sleep_backoff_async(attempt)
+
+    cache.store(url, content, response_headers)
+    return content
+
+
+def _checked(json_info, url):
+    """
+    :param json_info: JsonInfo
+    :param url: 网址
+    :return: JsonInfo
+    :raise ApiResponseError: 接口返回的code不为0
+    """
     if json_info.error:
-        exit(json_info.error_msg)
+        raise ApiResponseError(json_info.error_msg, url, json_info.get_value('code'))
     else:
         return json_info
 
 
+def get_json_info(url):
+    """
+    请求接口并解析JSON
+    :param url: 网址
+    :return: JsonInfo
+    :raise ApiResponseError: 接口返回的code不为0
+    """
+    return _checked(JsonInfo(url), url)
+
+
+async def get_json_info_async(url):
+    """
+    get_json_info的协程版本
+    :param url: 网址
+    :return: JsonInfo
+    :raise ApiResponseError: 接口返回的code不为0
+    """
+    return _checked(JsonInfo(url, content=await get_url_content_async(url)), url)
+
+
 def get_re(regexp, content):
     return re.findall(regexp, content)
 
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载数据的写盘阶段：网络线程/协程只负责把数据拷贝进大缓冲区，由独立的写线程批量写入磁盘
+import os
+import queue
+import functools
+import threading
+
+_write_lock = threading.Lock()
+
+FSYNC_NONE = 'none'  # 从不fsync，交给操作系统回写
+FSYNC_CLOSE = 'close'  # 关闭文件前fsync一次
+FSYNC_INTERVAL = 'interval'  # 每写入fsync_interval字节fsync一次，关闭前再fsync一次
+
+
+def open_output(file_name):
+    """
+    以可随机写入的方式打开输出文件，不截断已有内容
+    :param file_name: 文件路径
+    :return: int 文件描述符
+    """
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    return os.open(file_name, flags, 0o644)
+
+
+def write_at(fd, data, offset):
+    """
+    在指定偏移处写入数据，等价于pwrite
+    Windows下没有os.pwrite，退化为加锁的lseek+write
+    :param fd: 文件描述符
+    :param data: 写入的数据
+    :param offset: 文件偏移
+    :return: int 写入的字节数
+    """
+    view = memoryview(data)
+    written = 0
+    if hasattr(os, 'pwrite'):
+        while written < len(view):
+            written += os.pwrite(fd, view[written:], offset + written)
+    else:
+        with _write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while written < len(view):
+                written += os.write(fd, view[written:])
+    return written
+
+
+def preallocate(fd, size):
+    """
+    按content-length预分配磁盘空间，减少文件碎片和写入时的元数据更新
+    不支持fallocate的平台或文件系统退化为ftruncate
+    :param fd: 文件描述符
+    :param size: 文件大小
+    :return None
+    """
+    if not size:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+class BufferPool:
+    """可复用的大缓冲区池，缓冲区全部被占用时阻塞，形成网络到磁盘的背压"""
+
+    def __init__(self, buffer_size, max_buffers):
+        """
+        :param buffer_size: 单个缓冲区大小
+        :param max_buffers: 缓冲区总数上限
+        :return None
+        """
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self._free = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取出一个空闲缓冲区，没有空闲且已达上限时等待写线程归还
+        :return: bytearray
+        """
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_buffers:
+                self._created += 1
+                return bytearray(self.buffer_size)
+        return self._free.get()
+
+    def release(self, buffer):
+        self._free.put(buffer)
+
+    def reserve(self, count):
+        """
+        提高缓冲区总数上限，用于生产者数量在创建后才确定的情况（例如对冲请求各自占用一个缓冲区）
+        :param count: 增加的缓冲区数
+        :return None
+        """
+        with self._lock:
+            self.max_buffers += count
+
+
+class FileWriter:
+    """
+    独立的写线程，从有界队列中取出(偏移, 缓冲区)并用pwrite写入文件
+    队列满时submit阻塞，下载速度超过磁盘速度时网络读取会自然放缓
+    """
+
+    buffer_size = 4 * 1024 * 1024  # 单个缓冲区大小
+    queue_size = 8  # 等待写盘的缓冲区数量上限
+    fsync = FSYNC_CLOSE  # fsync策略
+    fsync_interval = 64 * 1024 * 1024  # FSYNC_INTERVAL策略下的fsync间隔（字节）
+
+    def __init__(self, file_name, content_size=None, producers=1, **kwargs):
+        """
+        :param file_name: 文件路径，已存在时不截断（用于断点续传）
+        :param content_size: 文件大小，给出时预分配磁盘空间
+        :param producers: 同时写入的生产者（连接）数，每个生产者会占用一个正在填充的缓冲区，之后可用pool.reserve追加
+        :param kwargs: 覆盖buffer_size、queue_size、fsync、fsync_interval等类属性
+        :return None
+        """
+        for key, value in kwargs.items():
+            if not hasattr(FileWriter, key):
+                raise TypeError('未知的参数: {}'.format(key))
+            setattr(self, key, value)
+
+        self.file_name = file_name
+        self.fd = open_output(file_name)
+        preallocate(self.fd, content_size)
+        self.pool = BufferPool(self.buffer_size, self.queue_size + producers)
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._unsynced = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, offset, buffer, length, callback=None):
+        """
+        提交一个待写入的缓冲区，写入后缓冲区归还到缓冲池
+        :param offset: 文件偏移
+        :param buffer: 从self.pool取得的缓冲区
+        :param length: 缓冲区中有效数据的长度
+        :param callback: 写入完成后的回调，参数为(offset, length)
+        :return None
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((offset, buffer, length, callback))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            offset, buffer, length, callback = item
+            try:
+                if self._error is None:
+                    write_at(self.fd, memoryview(buffer)[:length], offset)
+                    self._unsynced += length
+                    if self.fsync == FSYNC_INTERVAL and self._unsynced >= self.fsync_interval:
+                        os.fsync(self.fd)
+                        self._unsynced = 0
+                    if callback is not None:
+                        callback(offset, length)
+            except Exception as e:
+                self._error = e
+            finally:
+                self.pool.release(buffer)
+
+    def close(self):
+        """
+        等待队列中的数据全部写入后关闭文件，写入出错时抛出异常
+        :return None
+        """
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is None and self.fsync != FSYNC_NONE:
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RangeBuffer:
+    """把一个连续字节区间内陆续到达的小块数据拼接进缓冲区，写满后一次性提交给FileWriter"""
+
+    def __init__(self, writer: FileWriter, offset, callback=None, verifier=None):
+        """
+        :param writer: 写线程
+        :param offset: 区间起始的文件偏移
+        :param callback: 写入完成后的回调，参数为(offset, length)，有verifier时还会传入digest关键字参数
+        :param verifier: 跟随数据流的校验器（integrity.StreamVerifier），每次提交时切出一个分块摘要
+        :return None
+        """
+        self.writer = writer
+        self.offset = offset
+        self.callback = callback
+        self.verifier = verifier
+        self._buffer = None
+        self._length = 0
+
+    @property
+    def position(self):
+        """
+        下一个字节对应的文件偏移（包含尚未提交的数据）
+        :return: int
+        """
+        return self.offset + self._length
+
+    def needs_flush(self, size):
+        """
+        追加size字节是否需要取新缓冲区或会写满缓冲区（两者都可能阻塞，协程中应放到线程池执行）
+        :param size: 即将追加的字节数
+        :return: bool
+        """
+        return self._buffer is None or self._length + size >= self.writer.buffer_size
+
+    def write(self, data):
+        """
+        追加数据，缓冲区写满时提交
+        :param data: bytes
+        :return None
+        """
+        if self.verifier is not None:
+            self.verifier.update(data)
+        view = memoryview(data)
+        while len(view):
+            if self._buffer is None:
+                self._buffer = self.writer.pool.acquire()
+            count = min(len(view), len(self._buffer) - self._length)
+            self._buffer[self._length:self._length + count] = view[:count]
+            self._length += count
+            view = view[count:]
+            if self._length == len(self._buffer):
+                self.flush()
+
+    def flush(self):
+        """
+        提交缓冲区中剩余的数据
+        :return None
+        """
+        if self._buffer is None:
+            return
+        if self._length:
+            callback = self.callback
+            if self.verifier is not None:
+                digest = self.verifier.cut()
+                if callback is not None:
+                    callback = functools.partial(callback, digest=digest)
+            self.writer.submit(self.offset, self._buffer, self._length, callback)
+            self.offset += self._length
+        else:
+            self.writer.pool.release(self._buffer)
+        self._buffer = None
+        self._length = 0
+
+    def discard(self):
+        """
+        丢弃缓冲区中尚未提交的数据并归还缓冲区，用于被取消的区间和对冲请求中落后的一方
+        :return None
+        """
+        if self._buffer is not None:
+            self.writer.pool.release(self._buffer)
+        self._buffer = None
+        self._length = 0
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 各模块之间按脚本目录平级导入（from base import *），测试时把bilibili目录加入sys.path
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bilibili'))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    按路径返回server.files中的内容，支持单个bytes=start-end区间
+    server.fail_gets为True时GET请求都返回503，server.break_after给出时每个响应只发送这么多字节就断开连接
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        self.server.requests.append((self.command, self.path, self.headers.get('Range')))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if body and self.server.fail_gets:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status, start, end = 200, 0, len(data) - 1
+        value = self.headers.get('Range')
+        if self.server.ranges and value and value.startswith('bytes='):
+            first, last = value[6:].split('-')
+            status, start, end = 206, int(first), min(int(last or len(data) - 1), len(data) - 1)
+        self.send_response(status)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if body:
+            if self.server.break_after is not None:  # 发送一部分后断开连接
+                self.wfile.write(data[start:min(end + 1, start + self.server.break_after)])
+                self.close_connection = True
+                return
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def range_server():
+    """
+    本地HTTP服务器，range_server(files, ranges=True)返回服务器对象，url为地址前缀，requests记录收到的请求
+    files为{路径: 内容}，ranges=False时不声明Accept-Ranges，用于测试单连接回退
+    """
+    servers = []
+
+    def start(files, ranges=True):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        server.daemon_threads = True
+        server.files = files
+        server.ranges = ranges
+        server.requests = []
+        server.fail_gets = False
+        server.break_after = None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
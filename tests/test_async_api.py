@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 协程接口：元数据和下载都在调用者的事件循环中运行，不新建也不关闭事件循环
+import os
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+import base  # noqa: E402
+import quality  # noqa: E402
+from base import Video, VideoPage  # noqa: E402
+from test_pages import json_info  # noqa: E402
+from test_video import VIEW, STAT, PAGES  # noqa: E402
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """假的协程接口，按地址返回数据并记录请求；同步接口不应被调用"""
+    responses = {}
+    requested = []
+
+    async def get_json_info_async(url):
+        requested.append(url)
+        for prefix, data in responses.items():
+            if url.startswith(prefix):
+                return json_info(dict(data, code=0))
+        raise AssertionError('未预期的请求：' + url)
+
+    def get_json_info(url):
+        raise AssertionError('协程中不应发出同步请求：' + url)
+
+    monkeypatch.setattr(base, 'get_json_info_async', get_json_info_async)
+    monkeypatch.setattr(base, 'get_json_info', get_json_info)
+    return responses, requested
+
+
+def test_load_and_load_details_use_only_async_requests(loop, api):
+    responses, requested = api
+    responses[base.webApiPrefix + 'view'] = {'data': VIEW}
+    responses[base.webApiPrefix + 'archive/stat'] = {'data': STAT}
+    responses[base.playerApiPrefix + 'pagelist'] = {'data': PAGES}
+    video = loop.run_until_complete(Video.load(170001))
+    assert len(requested) == 1
+    loop.run_until_complete(video.load_details())
+    assert len(requested) == 3
+    assert video.view == 7 and video.page_list[0].part == 'p1'
+    loop.run_until_complete(video.load_details())
+    assert len(requested) == 3  # 已加载的部分不再请求
+
+
+def test_async_quality_uses_accept_quality_of_the_rejected_response(loop, api, monkeypatch):
+    responses, requested = api
+    monkeypatch.setattr(quality, '_cache', quality.QualityCache(file_name=None))
+    monkeypatch.setattr(Video, '_play_info_url', staticmethod(lambda cid, qn: 'playurl?qn={}'.format(qn)))
+    responses['playurl?qn=127'] = {'accept_quality': [80, 64]}
+    responses['playurl?qn=80'] = {'quality': 80, 'durl': [{'url': 'http://cdn.example/1.flv'}]}
+    video = Video(170001, load=False)
+    video._page_list = [VideoPage(1001, part='p1')]
+    loop.run_until_complete(video._get_video_download_url_async())
+    assert requested == ['playurl?qn=127', 'playurl?qn=80']
+    assert video.mirror_url_dict['1001'] == [['http://cdn.example/1.flv']]
+
+
+def test_download_runs_on_the_callers_loop_and_leaves_it_open(loop, tmp_path, monkeypatch):
+    async def resolve(self):
+        self.mirror_url_dict = {'1001': [['http://cdn.example/1.flv']]}
+
+    async def download_page(self, steps, i, directory, connections=1, leased=False):
+        assert asyncio.get_event_loop() is loop
+        with open(self._page_output(directory, i), 'wb') as f:
+            f.write(b'FLV')
+
+    monkeypatch.setattr(Video, '_get_video_download_url_async', resolve)
+    monkeypatch.setattr(Video, '_download_page', download_page)
+    video = Video(170001, load=False)
+    video.title = 'a'
+    video._stat, video._page_list = {}, [VideoPage(1001, part='p1')]
+
+    async def other():
+        await asyncio.sleep(0)
+        return 'other'
+
+    async def main():
+        return await asyncio.gather(video.download(str(tmp_path)), other())
+
+    done, result = loop.run_until_complete(main())
+    assert done and result == 'other'
+    assert os.path.exists(str(tmp_path / 'a.flv'))
+    assert not loop.is_closed()
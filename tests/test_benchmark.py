@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 性能基准：模拟服务器和子进程中的单次下载
+import pytest
+
+pytest.importorskip('aiohttp')
+from benchmark import FakeBilibili, build_flv, run_case, start_server  # noqa: E402
+from flv import FramingChecker  # noqa: E402
+
+
+def test_build_flv_gives_a_valid_file_of_the_requested_size():
+    data = build_flv(300 * 1024)
+    assert len(data) == 300 * 1024
+    checker = FramingChecker()
+    checker.feed(data)
+    assert checker.finish() == 5  # 每个标签64KB
+
+
+def test_run_case_downloads_every_page():
+    fake = FakeBilibili(pages=2, segments=2, size=256 * 1024)
+    result = run_case('async_download_video', start_server(fake), 1, connections=2, timeout=120)
+    assert result['error'] is None
+    assert result['bytes'] == 2 * (2 * len(fake.payload) - 13)  # 第2段拼接时去掉FLV文件头
+
+
+def test_hung_run_is_reported_as_an_error():
+    fake = FakeBilibili(latency=60)
+    result = run_case('download_video', start_server(fake), 1, connections=1, timeout=2)
+    assert result['error'] == 'timed out after 2s' and result['bytes'] == 0
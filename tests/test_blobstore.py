@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 内容寻址存储
+import os
+import pytest
+import blobstore
+from blobstore import HARDLINK, REFLINK, SYMLINK, BlobStore, page_key
+from integrity import file_digest
+
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def downloads(tmp_path):
+    path = tmp_path / 'video'
+    path.mkdir()
+    return path
+
+
+def ingest(store, path, data, key):
+    file_name = write(path, data)
+    digest = file_digest(file_name)
+    store.ingest(file_name, digest, [key])
+    return file_name, digest
+
+
+def test_invalid_mode(tmp_path):
+    with pytest.raises(ValueError):
+        BlobStore(str(tmp_path / 'store'), mode='copy')
+
+
+def test_hardlink_ingest_and_link(tmp_path, downloads):
+    store = BlobStore(str(tmp_path / 'store'), HARDLINK)
+    file_name, digest = ingest(store, downloads / 'a.flv', b'video', page_key(10, 80))
+    assert os.path.samefile(file_name, store.object_path(digest))
+
+    target = str(downloads / 'b.flv')
+    assert store.link(page_key(10, 80), target) == digest
+    assert os.path.samefile(target, store.object_path(digest))
+    assert store.link(page_key(10, 64), str(downloads / 'c.flv')) is None
+
+
+def test_duplicate_content_is_replaced_by_link(tmp_path, downloads):
+    store = BlobStore(str(tmp_path / 'store'), HARDLINK)
+    first, digest = ingest(store, downloads / 'a.flv', b'same', page_key(10, 80))
+    second, _ = ingest(store, downloads / 'b.flv', b'same', page_key(11, 80))  # 转载：不同cid，相同内容
+    assert os.path.samefile(first, second)
+    assert store.find(page_key(11, 80)) == (digest, store.object_path(digest))
+
+
+def test_symlink_mode(tmp_path, downloads):
+    store = BlobStore(str(tmp_path / 'store'), SYMLINK)
+    file_name, digest = ingest(store, downloads / 'a.flv', b'video', page_key(10, 80))
+    assert os.path.samefile(file_name, store.object_path(digest))
+    assert not os.path.islink(store.object_path(digest))  # 对象本身是真实文件
+
+    target = str(downloads / 'b.flv')
+    assert store.link(page_key(10, 80), target) == digest
+    assert os.path.islink(target)
+    assert os.path.realpath(target) == os.path.realpath(store.object_path(digest))
+    with open(target, 'rb') as f:
+        assert f.read() == b'video'
+
+
+def test_reflink_mode_falls_back_to_copy(tmp_path, downloads, monkeypatch):
+    def unsupported(src, dst):
+        raise OSError(95, 'Operation not supported')
+
+    monkeypatch.setattr(blobstore, '_reflink', unsupported)
+    store = BlobStore(str(tmp_path / 'store'), REFLINK)
+    file_name, digest = ingest(store, downloads / 'a.flv', b'video', page_key(10, 80))
+    target = str(downloads / 'b.flv')
+    assert store.link(page_key(10, 80), target) == digest
+    assert not os.path.samefile(target, store.object_path(digest))
+    with open(target, 'rb') as f:
+        assert f.read() == b'video'
+
+
+def test_missing_object_drops_key(tmp_path, downloads):
+    store = BlobStore(str(tmp_path / 'store'), HARDLINK)
+    _, digest = ingest(store, downloads / 'a.flv', b'video', page_key(10, 80))
+    os.remove(store.object_path(digest))
+    assert store.find(page_key(10, 80)) is None
+    assert store.link(page_key(10, 80), str(downloads / 'b.flv')) is None
+
+
+def test_keys_persist(tmp_path, downloads):
+    root = str(tmp_path / 'store')
+    store = BlobStore(root, HARDLINK)
+    _, digest = ingest(store, downloads / 'a.flv', b'video', page_key(10, 80))
+    store.close()
+    assert BlobStore(root, HARDLINK).find(page_key(10, 80))[0] == digest
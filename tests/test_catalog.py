@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 已完成下载的索引和分层布局
+import os
+from catalog import FLAT, SHARDED, DownloadIndex, shard_of
+from integrity import StreamVerifier, file_digest, write_manifest
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_shard_depends_only_on_cid():
+    assert shard_of(10) == shard_of('10')
+    assert len(shard_of(10)) == 2
+    assert shard_of(10, width=2, levels=2).count(os.sep) == 1
+
+
+def test_record_and_lookup(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    file_name = write(str(tmp_path / 'a.flv'), b'video')
+    record = index.record(1, 10, file_name, quality=80)
+    assert record['hash'] == file_digest(file_name)
+    assert index.lookup(1, 10) == dict(record, path=os.path.join(str(tmp_path), 'a.flv'))
+    assert index.lookup(1, 11) is None
+
+
+def test_record_uses_digest_streamed_during_download(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    file_name = write(str(tmp_path / 'a.flv'), b'video')
+    verifier = StreamVerifier(0, 5, content=True)
+    verifier.update(b'video')
+    assert verifier.content_digest == file_digest(file_name)
+    write_manifest(file_name, 5, verifier.pieces, content_digest='f' * 40)  # 清单中的摘要不必再读文件验证
+    assert index.record(1, 10, file_name)['hash'] == 'f' * 40
+    write(file_name, b'edited')  # 校验之后被改动过的文件重新计算
+    assert index.record(1, 10, file_name)['hash'] == file_digest(file_name)
+
+
+def test_lookup_drops_stale_records(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    file_name = write(str(tmp_path / 'a.flv'), b'video')
+    index.record(1, 10, file_name)
+    write(file_name, b'truncated')  # 大小不符
+    assert index.lookup(1, 10) is None
+    index.record(1, 10, file_name)
+    os.remove(file_name)
+    assert index.lookup(1, 10) is None
+
+
+def test_lookup_adopts_existing_file_without_hashing(tmp_path):
+    index = DownloadIndex(str(tmp_path))
+    file_name = write(str(tmp_path / 'a.flv'), b'video')
+    record = index.lookup(1, 10, file_name)
+    assert record['size'] == 5 and record['hash'] is None
+
+
+def test_layout_is_fixed_when_created(tmp_path):
+    index = DownloadIndex(str(tmp_path), sharded=True)
+    assert index.layout == SHARDED
+    directory = index.page_directory(10)
+    assert directory == os.path.join(str(tmp_path), shard_of(10)) and os.path.isdir(directory)
+    index.close()
+    assert DownloadIndex(str(tmp_path), sharded=False).layout == SHARDED
+
+
+def test_flat_directory_stays_flat(tmp_path):
+    assert DownloadIndex(str(tmp_path)).layout == FLAT
+    index = DownloadIndex(str(tmp_path), sharded=True)
+    assert index.layout == FLAT
+    assert index.page_directory(10) == str(tmp_path)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 命令行入口的冒烟测试：Bilibili.py用到的每个名字都要自己导入，from base import *只能提供base本身定义的名字
+import os
+import ast
+import sys
+import builtins
+import warnings
+import subprocess
+import pytest
+
+pytest.importorskip('aiohttp')
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bilibili')
+SCRIPT = os.path.join(SOURCE_DIR, 'Bilibili.py')
+
+
+def parse(file_name):
+    with open(file_name, encoding='utf-8') as f, warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)  # 旧代码正则中的无效转义
+        return ast.parse(f.read())
+
+
+def bound_names(tree):
+    """文件中任何位置绑定过的名字（赋值、参数、函数和类定义、导入、except as等）"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.alias):
+            names.add((node.asname or node.name).split('.')[0])
+    return names
+
+
+def top_level_definitions(tree):
+    """模块顶层定义的名字，不包括导入的名字"""
+    names = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names.update(n.id for target in targets for n in ast.walk(target) if isinstance(n, ast.Name))
+    return names
+
+
+def test_cli_module_imports_what_it_uses():
+    import Bilibili
+    assert callable(Bilibili.batch_download)
+    tree = parse(SCRIPT)
+    defined = bound_names(tree) | top_level_definitions(parse(os.path.join(SOURCE_DIR, 'base.py'))) | \
+        set(dir(builtins))
+    used = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+    assert used - defined == set()
+
+
+@pytest.mark.parametrize('argv', [['--help'], ['serve', '--help']])
+def test_cli_help(argv):
+    result = subprocess.run([sys.executable, SCRIPT] + argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=SOURCE_DIR, timeout=60)
+    assert result.returncode == 0, result.stderr.decode('utf-8', 'replace')
+    assert b'usage' in result.stdout
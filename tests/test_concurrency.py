@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 按主机的AIMD并发控制
+import asyncio
+import threading
+from concurrency import AIMDLimiter, ConcurrencyController
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_failure_halves_limit_once_per_window():
+    limiter = AIMDLimiter(initial=8, minimum=1, maximum=32, window=60)
+    limiter.failure()
+    assert limiter.limit == 4
+    limiter.failure()  # 同一窗口内并发的失败只减一次
+    assert limiter.limit == 4
+
+
+def test_limit_never_drops_below_minimum():
+    limiter = AIMDLimiter(initial=2, minimum=2, window=0)
+    for _ in range(3):
+        limiter.failure()
+    assert limiter.limit == 2
+
+
+def test_success_increases_limit_when_saturated():
+    limiter = AIMDLimiter(initial=1, maximum=3, window=0.01)
+    limiter.acquire()
+    limiter._window_start -= 1  # 统计窗口已结束
+    limiter.success(1024 * 1024)
+    assert limiter.limit == 2
+    limiter.release()
+
+
+def test_latency_spike_decreases_limit():
+    limiter = AIMDLimiter(initial=8, window=60)
+    limiter.success(latency=0.01)
+    limiter._window_start -= 120
+    limiter.success(latency=1.0)
+    limiter.success(latency=1.0)
+    assert limiter.limit == 4
+
+
+def test_acquire_blocks_until_release():
+    limiter = AIMDLimiter(initial=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        with limiter.slot():
+            acquired.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(5)
+    thread.join()
+    assert limiter.in_flight == 0
+
+
+def test_async_waiter_is_woken_by_release():
+    limiter = AIMDLimiter(initial=1)
+
+    async def main():
+        await limiter.acquire_async()
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        limiter.release()
+        await asyncio.wait_for(waiter, 5)
+        assert limiter.in_flight == 1
+
+    run(main())
+
+
+def test_cancelled_waiter_leaves_queue():
+    limiter = AIMDLimiter(initial=1)
+
+    async def main():
+        await limiter.acquire_async()
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert limiter._async_waiters == []
+
+    run(main())
+
+
+def test_cancelled_after_wakeup_passes_slot_on():
+    limiter = AIMDLimiter(initial=1)
+
+    async def main():
+        await limiter.acquire_async()
+        first = asyncio.ensure_future(limiter.acquire_async())
+        second = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.01)
+        limiter.release()  # 唤醒first，但在它运行之前取消
+        first.cancel()
+        await asyncio.wait_for(second, 5)
+        assert limiter.in_flight == 1
+
+    run(main())
+
+
+def test_controller_uses_separate_budgets_per_host():
+    controller = ConcurrencyController(api_budget=(2, 1, 8), cdn_budget=(4, 1, 32))
+    api = controller.for_url('https://api.bilibili.com/x/web-interface/view?aid=1')
+    cdn = controller.for_url('https://upos-sz-mirrorkodo.bilivideo.com/a.flv')
+    assert api.limit == 2 and api.maximum == 8
+    assert cdn.limit == 4 and cdn.maximum == 32
+    assert controller.for_url('https://api.bilibili.com/x/player/pagelist') is api
+    assert controller.page_limit == 32
+
+
+def test_failure_closes_the_window_without_increasing():
+    limiter = AIMDLimiter(initial=1, maximum=3, window=60)
+    limiter.acquire()
+    limiter._last_decrease = limiter._window_start = limiter._window_start - 120  # 统计窗口已结束
+    limiter.failure(size=1024 * 1024)
+    assert limiter.limit == 1 and limiter._window_bytes == 0 and limiter._window_failures == 0
+    limiter._window_start -= 120
+    limiter.success(4 * 1024 * 1024)  # 下一个没有出错的窗口吞吐量上升，照常加性增
+    assert limiter.limit == 2
+    limiter.release()
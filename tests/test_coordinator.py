@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 多进程/多主机共用下载目录时的分P租约
+import threading
+import pytest
+from coordinator import ACQUIRED, DONE, LEASED, LeaseCoordinator
+
+
+@pytest.fixture
+def lease_file(tmp_path):
+    return str(tmp_path / 'leases.db')
+
+
+@pytest.fixture
+def make(lease_file):
+    coordinators = []
+
+    def make(owner, ttl=60):
+        coordinator = LeaseCoordinator(lease_file, owner=owner, ttl=ttl)
+        coordinators.append(coordinator)
+        return coordinator
+
+    yield make
+    for coordinator in coordinators:
+        coordinator.close()
+
+
+def test_lease_is_exclusive_until_released(make):
+    a, b = make('a'), make('b')
+    assert a.acquire(1, 10) == ACQUIRED
+    assert a.acquire(1, 10) == LEASED  # 本进程已持有时同样互斥
+    assert b.acquire(1, 10) == LEASED
+    a.release(1, 10, done=False)
+    assert b.acquire(1, 10) == ACQUIRED
+
+
+def test_done_page_is_not_handed_out_again(make):
+    a, b = make('a'), make('b')
+    a.acquire(1, 10)
+    a.release(1, 10)
+    assert b.acquire(1, 10) == DONE
+    assert b.acquire(1, 10, reopen=True) == DONE  # 刚完成的可能只是目录缓存没有刷新
+
+
+def test_done_page_reopened_after_ttl(make):
+    a, b = make('a', ttl=0), make('b', ttl=0)
+    a.acquire(1, 10)
+    a.release(1, 10)
+    assert b.acquire(1, 10) == DONE
+    assert b.acquire(1, 10, reopen=True) == ACQUIRED
+
+
+def test_schedule_reopens_only_pages_whose_output_is_missing(make):
+    a, b = make('a', ttl=0), make('b', ttl=0)
+    for cid in (10, 11):
+        a.acquire(1, cid)
+        a.release(1, cid)
+    missing = {'p11'}  # 只有11的输出文件被删除了
+    assert list(b.schedule([(1, 10, 'p10'), (1, 11, 'p11')], reopen=lambda page: page in missing)) == ['p11']
+
+
+def test_expired_lease_is_stolen(make):
+    a, b = make('a', ttl=60), make('b', ttl=60)
+    a.acquire(1, 10)
+    a._conn.execute('UPDATE leases SET expires = 0')  # 持有者崩溃，没有续约
+    assert b.acquire(1, 10) == ACQUIRED
+    a.release(1, 10)  # 原持有者不能再把别人的租约标记为完成
+    assert a.acquire(1, 10) == LEASED
+
+
+def test_close_releases_unfinished_leases(make):
+    a, b = make('a'), make('b')
+    a.acquire(1, 10)
+    a.acquire(1, 11)
+    a.release(1, 11)
+    a.close()
+    assert b.acquire(1, 10) == ACQUIRED
+    assert b.acquire(1, 11) == DONE
+
+
+def test_schedule_defers_leased_pages(make):
+    a, b = make('a'), make('b')
+    b.acquire(1, 11)
+    order = []
+    for payload in a.schedule([(1, 10, 'p1'), (1, 11, 'p2'), (1, 12, 'p3')], poll=0.01):
+        order.append(payload)
+        a.release(1, {'p1': 10, 'p2': 11, 'p3': 12}[payload])
+        if payload == 'p3':
+            b.release(1, 11, done=False)
+    assert order == ['p1', 'p3', 'p2']
+
+
+def test_threads_in_one_process_do_not_share_a_lease(make):
+    coordinator = make('a')
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(coordinator.acquire(1, 10))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [ACQUIRED] + [LEASED] * 7
+    coordinator.release(1, 10, done=False)
+    assert coordinator.acquire(1, 10) == ACQUIRED
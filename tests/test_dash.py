@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# DASH轨道的选择
+from dash import AUDIO, VIDEO, select_streams, track_files
+
+
+def stream(qn, codec, bandwidth, url):
+    return {'id': qn, 'codecid': codec, 'bandwidth': bandwidth, 'baseUrl': url, 'backupUrl': [url + '?b']}
+
+
+DASH = {
+    'video': [stream(80, 12, 900, 'hevc80'), stream(80, 7, 800, 'avc80'), stream(64, 7, 500, 'avc64')],
+    'audio': [{'id': 30216, 'bandwidth': 64, 'base_url': 'a64'}, {'id': 30280, 'bandwidth': 192, 'base_url': 'a192'}],
+}
+
+
+def test_highest_quality_prefers_avc_and_the_best_audio():
+    assert select_streams(DASH) == {VIDEO: ['avc80', 'avc80?b'], AUDIO: ['a192']}
+
+
+def test_quality_caps_the_video_track():
+    assert select_streams(DASH, 64)[VIDEO] == ['avc64', 'avc64?b']
+    assert select_streams(DASH, 16)[VIDEO] == ['avc80', 'avc80?b']  # 没有更低的清晰度时取最高
+
+
+def test_missing_video_gives_none_and_missing_audio_gives_one_track():
+    assert select_streams({'audio': DASH['audio']}) is None
+    streams = select_streams({'video': DASH['video']})
+    assert track_files('a', streams) == [('a.video.m4s', ['avc80', 'avc80?b'])]
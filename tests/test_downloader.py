@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 基于Range请求的分段下载、断点续传进度（PartState）和区间切分
+import os
+import asyncio
+import requests
+import pytest
+from downloader import STATE_SUFFIX, PartState, RangeDownloader, discard_state, is_completed, split_gaps, \
+    split_range, split_ranges
+from flv import TAG_VIDEO
+from test_flv import segment, tag
+
+DATA = segment([]) + b''.join(tag(TAG_VIDEO, i * 40, bytes(range(256)) * 1024) for i in range(12))  # 约3MB的FLV
+
+
+def new_state(tmp_path, size=100):
+    return PartState(str(tmp_path / 'video.flv'), size)
+
+
+def test_add_merges_adjacent_and_overlapping_ranges(tmp_path):
+    state = new_state(tmp_path)
+    state.add(0, 9)
+    state.add(20, 29)
+    state.add(10, 14)
+    assert state.done == [[0, 14], [20, 29]]
+    state.add(12, 25)
+    assert state.done == [[0, 29]]
+    assert state.completed == 30
+
+
+def test_missing_lists_gaps_up_to_content_size(tmp_path):
+    state = new_state(tmp_path)
+    assert state.missing() == [(0, 99)]
+    state.add(10, 19)
+    state.add(50, 99)
+    assert state.missing() == [(0, 9), (20, 49)]
+
+
+def test_remove_splits_ranges_and_drops_pieces(tmp_path):
+    state = new_state(tmp_path)
+    state.add(0, 49, digest='a')
+    state.add(50, 99, digest='b')
+    state.remove(40, 59)
+    assert state.done == [[0, 39], [60, 99]]
+    assert state.pieces == []
+    state.add(0, 9, digest='c')
+    state.remove(50, 99)
+    assert state.pieces == [[0, 9, 'c']]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    state = new_state(tmp_path)
+    open(state.part_name, 'wb').close()
+    state.add(0, 49, digest='a')
+    state.extra['patched'] = True
+    state.save()
+
+    resumed = new_state(tmp_path)
+    assert resumed.done == [[0, 49]]
+    assert resumed.pieces == [[0, 49, 'a']]
+    assert resumed.extra == {'patched': True}
+
+
+def test_load_ignores_state_without_part_file_or_with_other_size(tmp_path):
+    state = new_state(tmp_path)
+    state.add(0, 49)
+    state.save()
+    assert new_state(tmp_path).done == []  # .part文件不存在
+
+    open(state.part_name, 'wb').close()
+    assert new_state(tmp_path, size=200).done == []
+    assert new_state(tmp_path).done == [[0, 49]]
+
+
+def test_discard_removes_part_and_state_files(tmp_path):
+    state = new_state(tmp_path)
+    open(state.part_name, 'wb').close()
+    state.add(0, 49)
+    state.save()
+    state.discard()
+    assert state.done == [] and state.completed == 0
+    assert not os.path.exists(state.part_name)
+    assert not os.path.exists(str(tmp_path / 'video.flv') + STATE_SUFFIX)
+    discard_state(str(tmp_path / 'video.flv'))  # 文件不存在时不报错
+
+
+def test_commit_renames_part_file_and_removes_state(tmp_path):
+    state = new_state(tmp_path)
+    with open(state.part_name, 'wb') as f:
+        f.write(b'x' * 100)
+    state.add(0, 99)
+    state.save()
+    state.commit()
+    assert is_completed(state.file_name)
+    assert not os.path.exists(state.part_name)
+    assert not os.path.exists(str(tmp_path / 'video.flv') + STATE_SUFFIX)
+    discard_state(str(tmp_path / 'video.flv'))  # 文件不存在时不报错
+
+
+def test_split_gaps_covers_every_byte_exactly_once():
+    gaps = [(0, 99), (200, 1099)]
+    ranges = split_gaps(gaps, 4, min_range_size=10)
+    covered = [b for start, end in ranges for b in range(start, end + 1)]
+    assert covered == list(range(0, 100)) + list(range(200, 1100))
+    assert len(ranges) >= 4
+
+
+def test_split_gaps_respects_min_range_size():
+    assert split_gaps([(0, 99)], 8, min_range_size=60) == [(0, 99)]
+    assert split_gaps([(0, 99)], 2, min_range_size=10) == [(0, 49), (50, 99)]
+
+
+def test_split_gaps_empty():
+    assert split_gaps([], 4) == []
+
+
+def test_split_range_keeps_each_request_small():
+    assert split_range(0, 24, 10) == [(0, 9), (10, 19), (20, 24)]
+    assert split_range(5, 9, 10) == [(5, 9)]
+
+
+def test_split_ranges_cover_the_file():
+    ranges = split_ranges(10 * 1024 * 1024 + 3, 4)
+    assert ranges[0][0] == 0 and ranges[-1][1] == 10 * 1024 * 1024 + 2
+    assert all(ranges[i][1] + 1 == ranges[i + 1][0] for i in range(len(ranges) - 1))
+    assert split_ranges(100, 4) == [(0, 99)]  # 小文件不切分
+    assert split_ranges(0, 4) == []
+
+
+def test_ranges_are_written_at_their_offsets(tmp_path, range_server):
+    server = range_server({'/1.flv': DATA})
+    file_name = str(tmp_path / '1.flv')
+    with requests.Session() as session:
+        assert RangeDownloader(session, server.url + '/1.flv', file_name, connections=3).download()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_each_connection_requests_consecutive_capped_ranges(tmp_path, range_server):
+    server = range_server({'/1.flv': DATA})
+    file_name = str(tmp_path / '1.flv')
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, server.url + '/1.flv', file_name, connections=1)
+        downloader.max_range_size = 1024 * 1024
+        assert downloader.download()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert [x[2] for x in server.requests if x[0] == 'GET'] == \
+        ['bytes={}-{}'.format(start, end) for start, end in split_range(0, len(DATA) - 1, 1024 * 1024)]
+
+
+def test_resume_requests_only_missing_ranges(tmp_path, range_server):
+    server = range_server({'/1.flv': DATA})
+    file_name = str(tmp_path / '1.flv')
+    state = PartState(file_name, len(DATA))
+    with open(state.part_name, 'wb') as f:
+        f.write(DATA[:1024 * 1024])
+    state.add(0, 1024 * 1024 - 1)
+    state.save()
+    with requests.Session() as session:
+        assert RangeDownloader(session, server.url + '/1.flv', file_name, connections=1).download()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(file_name + STATE_SUFFIX)
+    assert [x[2] for x in server.requests if x[0] == 'GET'] == ['bytes={}-{}'.format(1024 * 1024, len(DATA) - 1)]
+
+
+def test_server_without_range_support_is_not_split(tmp_path, range_server):
+    server = range_server({'/1.flv': DATA}, ranges=False)
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, server.url + '/1.flv', str(tmp_path / '1.flv'), connections=3)
+        assert downloader.probe() is None
+        assert not downloader.download()
+    assert not os.path.exists(str(tmp_path / '1.flv'))
+
+
+def test_async_ranges_are_written_at_their_offsets(tmp_path, range_server):
+    aiohttp = pytest.importorskip('aiohttp')
+    from downloader import AsyncRangeDownloader
+    server = range_server({'/1.flv': DATA})
+    file_name = str(tmp_path / '1.flv')
+
+    async def main():
+        async with aiohttp.ClientSession() as session:
+            return await AsyncRangeDownloader(session, server.url + '/1.flv', file_name, connections=3).download()
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main())
+    finally:
+        loop.close()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 多段FLV拼接后的时间戳修正
+import struct
+import requests
+import pytest
+from downloader import ConcatDownloader
+from flv import FLV_HEADER_SIZE, TAG_AUDIO, TAG_SCRIPT, TAG_VIDEO, TimestampError, concat_timestamps, iter_tags, \
+    read_timestamp
+from mirror import HostScoreboard
+
+
+def tag(tag_type, timestamp, data=b'\x00' * 5):
+    header = bytes([tag_type]) + len(data).to_bytes(3, 'big') + (timestamp & 0xFFFFFF).to_bytes(3, 'big') + \
+        bytes([timestamp >> 24 & 0xFF]) + b'\x00' * 3
+    return header + data + struct.pack('>I', len(header) + len(data))
+
+
+def on_metadata(duration, filesize):
+    data = b'\x02' + struct.pack('>H', 10) + b'onMetaData' + b'\x08' + struct.pack('>I', 2)
+    for name, value in ((b'duration', duration), (b'filesize', filesize)):
+        data += struct.pack('>H', len(name)) + name + b'\x00' + struct.pack('>d', value)
+    return tag(TAG_SCRIPT, 0, data + b'\x00\x00\x09')
+
+
+def segment(tags, header=True):
+    """一个分段，header=False时和拼接下载一样去掉FLV文件头"""
+    data = b''.join(tag(tag_type, timestamp) for tag_type, timestamp in tags)
+    return (b'FLV\x01\x05\x00\x00\x00\x09' + b'\x00' * 4 if header else b'') + data
+
+
+def concatenated(tmp_path, *segments):
+    """第一个分段带文件头和onMetaData，其余分段去掉文件头后接在后面"""
+    parts = [segment(segments[0])[:FLV_HEADER_SIZE] + on_metadata(1.0, 123.0) +
+             segment(segments[0])[FLV_HEADER_SIZE:]]
+    parts += [segment(tags, header=False) for tags in segments[1:]]
+    offsets = [0]
+    for part in parts[:-1]:
+        offsets.append(offsets[-1] + len(part))
+    file_name = str(tmp_path / 'video.flv')
+    with open(file_name, 'wb') as f:
+        f.write(b''.join(parts))
+    return file_name, offsets
+
+
+def timestamps(file_name):
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    return [(tag_type, read_timestamp(data, position))
+            for position, tag_type, size in iter_tags(data, FLV_HEADER_SIZE, len(data)) if tag_type != TAG_SCRIPT]
+
+
+def metadata(file_name):
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    values = {}
+    for name in (b'duration', b'filesize'):
+        index = data.index(struct.pack('>H', len(name)) + name + b'\x00') + len(name) + 3
+        values[name.decode()] = struct.unpack('>d', data[index:index + 8])[0]
+    return values, len(data)
+
+
+FIRST = [(TAG_VIDEO, 0), (TAG_AUDIO, 0), (TAG_AUDIO, 23), (TAG_VIDEO, 40), (TAG_AUDIO, 46), (TAG_VIDEO, 80)]
+SECOND = [(TAG_VIDEO, 1000), (TAG_AUDIO, 1005), (TAG_VIDEO, 1040)]  # 分段各自从任意时间戳开始
+
+
+def test_later_segments_continue_after_the_last_frame(tmp_path):
+    file_name, offsets = concatenated(tmp_path, FIRST, SECOND, SECOND)
+    assert concat_timestamps(file_name, offsets) == 280
+    assert timestamps(file_name) == FIRST + [(TAG_VIDEO, 120), (TAG_AUDIO, 125), (TAG_VIDEO, 160),
+                                             (TAG_VIDEO, 200), (TAG_AUDIO, 205), (TAG_VIDEO, 240)]
+
+
+def test_metadata_duration_and_filesize_are_patched(tmp_path):
+    file_name, offsets = concatenated(tmp_path, FIRST, SECOND)
+    concat_timestamps(file_name, offsets)
+    values, size = metadata(file_name)
+    assert values == {'duration': 0.2, 'filesize': float(size)}
+
+
+def test_second_run_gives_the_same_file(tmp_path):
+    file_name, offsets = concatenated(tmp_path, FIRST, SECOND)
+    concat_timestamps(file_name, offsets)
+    with open(file_name, 'rb') as f:
+        once = f.read()
+    changed = []
+    concat_timestamps(file_name, offsets, changed)
+    with open(file_name, 'rb') as f:
+        assert f.read() == once
+    assert len(changed) == 2  # 时间戳已是正确的值，只重写了duration和filesize
+
+
+def test_changed_ranges_cover_every_rewritten_byte(tmp_path):
+    file_name, offsets = concatenated(tmp_path, FIRST, SECOND)
+    with open(file_name, 'rb') as f:
+        before = f.read()
+    changed = []
+    concat_timestamps(file_name, offsets, changed)
+    with open(file_name, 'rb') as f:
+        after = f.read()
+    covered = set(i for start, end in changed for i in range(start, end + 1))
+    assert {i for i in range(len(before)) if before[i] != after[i]} <= covered
+
+
+def test_extended_timestamp_byte_is_used(tmp_path):
+    start = 0x1000000 + 500  # 超过24位，需要扩展字节
+    file_name, offsets = concatenated(tmp_path, [(TAG_VIDEO, start), (TAG_VIDEO, start + 40)], SECOND)
+    concat_timestamps(file_name, offsets)
+    assert timestamps(file_name)[2:] == [(TAG_VIDEO, start + 80), (TAG_AUDIO, start + 85), (TAG_VIDEO, start + 120)]
+
+
+def test_timestamp_error_leaves_the_file_unchanged(tmp_path):
+    backwards = [(TAG_VIDEO, 1000), (TAG_VIDEO, 960)]  # 分段内的时间戳早于分段起点
+    file_name, offsets = concatenated(tmp_path, FIRST, SECOND, backwards)
+    with open(file_name, 'rb') as f:
+        before = f.read()
+    with pytest.raises(TimestampError):
+        concat_timestamps(file_name, offsets)
+    with open(file_name, 'rb') as f:
+        assert f.read() == before
+
+
+def test_not_an_flv_file(tmp_path):
+    file_name = str(tmp_path / 'video.flv')
+    with open(file_name, 'wb') as f:
+        f.write(b'not an flv file')
+    with pytest.raises(ValueError):
+        concat_timestamps(file_name, [0])
+
+
+def test_segments_are_downloaded_into_one_file(tmp_path, range_server):
+    first = segment(FIRST)
+    first = first[:FLV_HEADER_SIZE] + on_metadata(1.0, 123.0) + first[FLV_HEADER_SIZE:]
+    server = range_server({'/1-1.flv': first, '/1-2.flv': segment(SECOND)})
+    file_name = str(tmp_path / 'video.flv')
+    with requests.Session() as session:
+        downloader = ConcatDownloader(session, [[server.url + '/1-1.flv'], [server.url + '/1-2.flv']], file_name,
+                                      connections=2)
+        for segment_downloader in downloader.downloaders:
+            segment_downloader.scoreboard = HostScoreboard(file_name=None)
+        assert downloader.download()
+    assert timestamps(file_name) == FIRST + [(TAG_VIDEO, 120), (TAG_AUDIO, 125), (TAG_VIDEO, 160)]
+    assert metadata(file_name)[0]['duration'] == 0.2
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 接口响应的磁盘缓存
+import zlib
+import pytest
+from httpcache import HttpCache, ttl_for
+
+VIEW = 'https://api.bilibili.com/x/web-interface/view?aid={}'
+PLAYURL = 'https://api.bilibili.com/x/player/playurl?cid=1&qn=80'
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HttpCache(str(tmp_path / 'cache.db'))
+
+
+def test_ttl_by_endpoint():
+    assert ttl_for(VIEW.format(1)) == 12 * 3600
+    assert ttl_for('https://api.bilibili.com/x/web-interface/archive/stat?aid=1') == 600
+    assert ttl_for(PLAYURL) == 0  # 带签名的下载地址不缓存
+
+
+def test_store_and_lookup(cache):
+    cache.store(VIEW.format(1), b'{"code": 0}', {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+    entry = cache.lookup(VIEW.format(1))
+    assert entry.body == b'{"code": 0}'
+    assert entry.fresh
+    assert entry.validators == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    assert cache.lookup(VIEW.format(2)) is None
+
+
+def test_uncacheable_responses_are_ignored(cache):
+    cache.store(PLAYURL, b'{}')
+    assert cache.lookup(PLAYURL) is None
+    cache.store(VIEW.format(1), b'{}', {'Cache-Control': 'no-store'})
+    assert cache.lookup(VIEW.format(1)) is None
+    cache.enabled = False
+    cache.store(VIEW.format(2), b'{}')
+    cache.enabled = True
+    assert cache.lookup(VIEW.format(2)) is None
+
+
+def test_expired_entry_is_revalidated_and_refreshed(tmp_path):
+    cache = HttpCache(str(tmp_path / 'cache.db'), rules=((r'/view$', -1),))
+    cache.store(VIEW.format(1), b'old', {'ETag': '"v1"'})
+    entry = cache.lookup(VIEW.format(1))
+    assert not entry.fresh
+    assert entry.validators == {'If-None-Match': '"v1"'}
+
+    cache.rules = ((r'/view$', 60),)
+    cache.refresh(VIEW.format(1), {'ETag': '"v2"'})  # 服务器返回304
+    entry = cache.lookup(VIEW.format(1))
+    assert entry.fresh and entry.body == b'old' and entry.etag == '"v2"'
+    cache.refresh(VIEW.format(1))  # 304没有带ETag时保留原来的
+    assert cache.lookup(VIEW.format(1)).etag == '"v2"'
+
+
+def test_persists_across_instances(tmp_path):
+    HttpCache(str(tmp_path / 'cache.db')).store(VIEW.format(1), b'body')
+    assert HttpCache(str(tmp_path / 'cache.db')).lookup(VIEW.format(1)).body == b'body'
+
+
+def test_invalidate_and_clear(cache):
+    cache.store(VIEW.format(1), b'a')
+    cache.store(VIEW.format(2), b'b')
+    cache.invalidate(VIEW.format(1))
+    assert cache.lookup(VIEW.format(1)) is None
+    cache.clear()
+    assert cache.lookup(VIEW.format(2)) is None
+    assert cache._size == 0
+
+
+def test_evicts_least_recently_used():
+    body = bytes(range(256)) * 16  # 压缩后仍有一定大小
+    cache = HttpCache(None)
+    cache.max_size = len(zlib.compress(body + b'\x00', 6)) * 3 + 10  # 刚好放下3条
+    for aid in range(3):
+        cache.store(VIEW.format(aid), body + bytes([aid]))
+        cache._conn.execute('UPDATE entries SET accessed = ? WHERE url = ?', (aid, VIEW.format(aid)))
+    cache.lookup(VIEW.format(0))  # 最近使用过，保留
+    cache.store(VIEW.format(3), body + b'\x03')
+    assert cache.lookup(VIEW.format(1)) is None
+    assert cache.lookup(VIEW.format(0)) is not None
+    assert cache.lookup(VIEW.format(3)) is not None
+    assert cache._size <= cache.max_size
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 分块摘要和校验清单
+import hashlib
+import requests
+from downloader import ConcatDownloader, RangeDownloader
+from flv import FLV_HEADER_SIZE
+from integrity import HASH_ALGORITHM, file_digest, read_manifest, rehash_pieces, root_digest
+from mirror import HostScoreboard
+from test_flv import FIRST, SECOND, on_metadata, segment
+
+
+def digest_of(data):
+    return hashlib.new(HASH_ALGORITHM, data).hexdigest()
+
+
+def check_manifest(file_name):
+    """按清单逐块重新计算摘要，返回清单"""
+    manifest = read_manifest(file_name)
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    assert manifest['size'] == len(data)
+    for start, end, digest in manifest['pieces']:
+        assert digest_of(data[start:end + 1]) == digest, '分块[{}-{}]与清单不一致'.format(start, end)
+    assert manifest['digest'] == root_digest(manifest['pieces'])
+    return manifest
+
+
+def test_rehash_only_touched_pieces(tmp_path):
+    file_name = str(tmp_path / 'data')
+    data = bytearray(range(256)) * 4
+    pieces = [[i, i + 255, digest_of(data[i:i + 256])] for i in range(0, len(data), 256)]
+    data[300] = data[800] = 0xFF
+    with open(file_name, 'wb') as f:
+        f.write(data)
+    pieces[2][2] = 'stale'  # 没有被改写的分块不重新读取
+    result = rehash_pieces(file_name, pieces, [(800, 800), (300, 300)])
+    assert result[0] == pieces[0] and result[2][2] == 'stale'
+    assert result[1][2] == digest_of(data[256:512]) and result[3][2] == digest_of(data[768:1024])
+
+
+def test_concatenated_flv_matches_its_manifest(tmp_path, range_server):
+    first = segment(FIRST)
+    first = first[:FLV_HEADER_SIZE] + on_metadata(1.0, 123.0) + first[FLV_HEADER_SIZE:]
+    server = range_server({'/1-1.flv': first, '/1-2.flv': segment(SECOND)})
+    file_name = str(tmp_path / 'video.flv')
+    with requests.Session() as session:
+        downloader = ConcatDownloader(session, [[server.url + '/1-1.flv'], [server.url + '/1-2.flv']], file_name,
+                                      connections=2)
+        for segment_downloader in downloader.downloaders:
+            segment_downloader.scoreboard = HostScoreboard(file_name=None)
+        assert downloader.download()
+    manifest = check_manifest(file_name)  # 时间戳修正改写过的分块已重新计算摘要
+    assert manifest['segments'] == 2
+
+
+def test_single_connection_records_the_whole_file_digest(tmp_path, range_server):
+    server = range_server({'/1.mp4': bytes(range(256)) * 64})
+    file_name = str(tmp_path / 'video.mp4')
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, server.url + '/1.mp4', file_name, connections=1,
+                                     scoreboard=HostScoreboard(file_name=None))
+        downloader.max_range_size = 4096  # 一条连接上相接的多个区间接着计算摘要
+        assert downloader.download()
+    assert check_manifest(file_name)['content_digest'] == file_digest(file_name)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 批量下载的持久化任务队列
+import io
+import threading
+import pytest
+
+pytest.importorskip('aiohttp')
+from jobqueue import DONE, FAILED, PENDING, RUNNING, JobQueue, parse_aids, run_batch  # noqa: E402
+from pool import get_worker_loop  # noqa: E402
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    yield queue
+    queue.close()
+
+
+def test_parse_aids_skips_comments_and_prefixes():
+    lines = io.StringIO('170001\nav170002  # 注释\n\n# 整行注释\nAV170003\nBV1xx\n')
+    assert parse_aids(lines) == ['170001', '170002', '170003']
+
+
+def test_add_ignores_duplicates(queue):
+    assert queue.add(['1', '2']) == 2
+    assert queue.add(['2', '3']) == 1
+    assert queue.counts() == {PENDING: 3, RUNNING: 0, DONE: 0, FAILED: 0}
+
+
+def test_claim_in_order_and_marks_running(queue):
+    queue.add(['1', '2'], directory='out')
+    assert queue.claim() == {'aid': '1', 'directory': 'out', 'attempts': 1}
+    assert queue.claim()['aid'] == '2'
+    assert queue.claim() is None  # running任务的心跳未超时
+    assert queue.counts()[RUNNING] == 2
+
+
+def test_fail_requeues_until_attempts_used_up(queue):
+    queue.add(['1'])
+    for attempt in range(1, 3):
+        assert queue.claim()['attempts'] == attempt
+        assert queue.fail('1', 'boom', max_attempts=3) is False
+    queue.claim()
+    assert queue.fail('1', 'boom', max_attempts=3) is True
+    assert queue.counts()[FAILED] == 1
+    assert queue.retry_failed() == 1
+    assert queue.claim()['attempts'] == 1
+
+
+def test_stale_running_job_is_reclaimed(queue):
+    queue.add(['1'])
+    queue.claim()
+    assert queue.claim(stale=60) is None
+    assert queue.claim(stale=-1) == {'aid': '1', 'directory': 'video', 'attempts': 2}
+
+
+def test_touch_keeps_job_leased(queue):
+    queue.add(['1'])
+    queue.claim()
+    queue._conn.execute('UPDATE jobs SET updated = updated - 100')
+    queue.touch(['1'])
+    assert queue.claim(stale=50) is None
+
+
+def test_stale_job_out_of_attempts_is_failed(queue):
+    queue.add(['1'])
+    for _ in range(3):
+        assert queue.claim(stale=-1, max_attempts=3) is not None  # 每次都在下载中崩溃
+    assert queue.claim(stale=-1, max_attempts=3) is None
+    assert queue.counts() == {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 1}
+
+
+def test_claim_is_exclusive_across_connections(tmp_path):
+    file_name = str(tmp_path / 'jobs.db')
+    JobQueue(file_name).add([str(i) for i in range(50)])
+    queues = [JobQueue(file_name) for _ in range(4)]
+    claimed = []
+
+    def worker(queue):
+        while True:
+            job = queue.claim()
+            if job is None:
+                break
+            claimed.append(job['aid'])
+
+    threads = [threading.Thread(target=worker, args=(q,)) for q in queues]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed, key=int) == [str(i) for i in range(50)]
+
+
+def test_run_batch_finishes_and_fails_jobs(queue):
+    queue.add(['1', '2', '3'])
+
+    def download(aid, directory):
+        if aid == '2':
+            raise RuntimeError('接口出错')
+
+    counts = run_batch(queue, download, workers=2, max_attempts=2)
+    assert counts == {PENDING: 0, RUNNING: 0, DONE: 2, FAILED: 1}
+
+
+def test_run_batch_retries_incomplete_downloads(queue):
+    queue.add(['1', '2'])
+    attempts = []
+
+    def download(aid, directory):
+        attempts.append(aid)
+        return aid != '2' or attempts.count('2') > 1  # av2第一次有分P未完整下载
+
+    counts = run_batch(queue, download, workers=1, max_attempts=2)
+    assert counts == {PENDING: 0, RUNNING: 0, DONE: 2, FAILED: 0}
+    assert attempts.count('2') == 2
+
+
+def test_worker_keeps_one_event_loop_between_jobs(queue):
+    queue.add(['1', '2'])
+    loops = []
+    run_batch(queue, lambda aid, directory: loops.append(get_worker_loop()), workers=1)
+    assert len(loops) == 2 and loops[0] is not None and loops[0] is loops[1]
+    assert loops[0].is_closed() and get_worker_loop() is None
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 后台合并流水线，用Python子进程代替ffmpeg
+import os
+import sys
+from merge import MergePipeline
+
+
+def write_part(output_file, exit_code=0):
+    """写出output_file.part后以exit_code退出的命令"""
+    return [sys.executable, '-c', 'import sys; open({!r}, "w").write("merged"); sys.exit({})'.format(
+        output_file + '.part', exit_code)]
+
+
+def test_success_renames_output_and_removes_inputs(tmp_path):
+    (tmp_path / 'a_1.flv').write_bytes(b'1')
+    pipeline = MergePipeline()
+    try:
+        assert pipeline.submit(write_part('a.flv'), str(tmp_path), 'a.flv', ['a_1.flv']).result(30)
+    finally:
+        pipeline.close()
+    assert (tmp_path / 'a.flv').read_text() == 'merged'
+    assert sorted(os.listdir(str(tmp_path))) == ['a.flv']
+
+
+def test_failure_keeps_inputs_and_drops_partial_output(tmp_path):
+    (tmp_path / 'a_1.flv').write_bytes(b'1')
+    pipeline = MergePipeline()
+    try:
+        assert not pipeline.submit(write_part('a.flv', 1), str(tmp_path), 'a.flv', ['a_1.flv']).result(30)
+    finally:
+        pipeline.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['a_1.flv']
+
+
+def test_missing_program_is_reported_as_failure(tmp_path):
+    pipeline = MergePipeline()
+    try:
+        assert not pipeline.submit(['no-such-ffmpeg-binary'], str(tmp_path), 'a.flv').result(30)
+    finally:
+        pipeline.close()
+
+
+def test_concat_list_quotes_file_names(tmp_path):
+    pipeline = MergePipeline()
+    try:
+        pipeline.submit = lambda args, cwd, output_file, cleanup=(): (args, cleanup)
+        args, cleanup = pipeline.submit_concat(str(tmp_path), ["it's_1.flv", "it's_2.flv"], "it's.flv")
+    finally:
+        pipeline.close()
+    assert (tmp_path / "it's.flv.txt").read_text(encoding='utf-8') == \
+        "file 'it'\\''s_1.flv'\nfile 'it'\\''s_2.flv'\n"
+    assert args[-1] == "it's.flv.part"
+    assert cleanup == ["it's_1.flv", "it's_2.flv", "it's_1.flv.manifest.json", "it's_2.flv.manifest.json",
+                       "it's.flv.txt"]
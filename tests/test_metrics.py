@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# Prometheus文本格式的指标
+import requests
+import pytest
+
+pytest.importorskip('aiohttp')
+from downloader import RangeDownloader  # noqa: E402
+from flv import TAG_VIDEO  # noqa: E402
+from merge import MergePipeline  # noqa: E402
+from metrics import DOWNLOAD_BYTES, MERGE_SECONDS, Registry, endpoint_of, host_of  # noqa: E402
+from mirror import HostScoreboard  # noqa: E402
+from test_flv import segment, tag  # noqa: E402
+
+DATA = segment([]) + b''.join(tag(TAG_VIDEO, i * 40, bytes(range(256)) * 1024) for i in range(4))  # 约1MB的FLV
+
+
+def test_counter_and_histogram_render_prometheus_text():
+    registry = Registry()
+    counter = registry.counter('bytes_total', '字节数', ['host'])
+    histogram = registry.histogram('seconds', '耗时', ['mode'], buckets=(1, 5))
+    counter.inc(10, host='a"b')
+    counter.inc(5, host='a"b')
+    histogram.observe(0.5, mode='range')
+    histogram.observe(3, mode='range')
+    assert registry.render().splitlines() == [
+        '# HELP bytes_total 字节数',
+        '# TYPE bytes_total counter',
+        'bytes_total{host="a\\"b"} 15',
+        '# HELP seconds 耗时',
+        '# TYPE seconds histogram',
+        'seconds_bucket{mode="range",le="1"} 1',
+        'seconds_bucket{mode="range",le="5"} 2',
+        'seconds_bucket{mode="range",le="+Inf"} 2',
+        'seconds_sum{mode="range"} 3.5',
+        'seconds_count{mode="range"} 2',
+    ]
+
+
+def test_endpoint_labels_drop_ids_and_query():
+    assert endpoint_of('https://api.bilibili.com/x/v2/dm/170001?oid=1') == 'api.bilibili.com/x/v{id}/dm/{id}'
+    assert host_of('http://127.0.0.1:8000/1.flv') == '127.0.0.1'
+
+
+def test_downloaded_bytes_are_counted_per_host(tmp_path, range_server):
+    server = range_server({'/1.flv': DATA})
+    before = DOWNLOAD_BYTES.get(host='127.0.0.1')
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, server.url + '/1.flv', str(tmp_path / '1.flv'), connections=2,
+                                     scoreboard=HostScoreboard(file_name=None))
+        assert downloader.download()
+    assert DOWNLOAD_BYTES.get(host='127.0.0.1') - before == len(DATA)
+
+
+def test_merge_without_ffmpeg_is_counted_as_failed(tmp_path):
+    before = MERGE_SECONDS.get(result='failed')
+    before = before[2] if before else 0
+    pipeline = MergePipeline()
+    try:
+        assert not pipeline.submit(['no-such-ffmpeg-binary'], str(tmp_path), 'a.flv').result(30)
+    finally:
+        pipeline.close()
+    assert MERGE_SECONDS.get(result='failed')[2] == before + 1
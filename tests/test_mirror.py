@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 多镜像测速排序和出错时的切换
+import requests
+from downloader import RangeDownloader
+from flv import TAG_VIDEO
+from mirror import HostScoreboard
+from test_flv import segment, tag
+
+DATA = segment([]) + b''.join(tag(TAG_VIDEO, i * 40, bytes(range(256)) * 1024) for i in range(8))  # 约2MB的FLV
+
+
+def test_faster_hosts_rank_first_and_errors_demote():
+    scoreboard = HostScoreboard(file_name=None)
+    scoreboard.record('http://a.example/1.flv', 1000, 1)
+    scoreboard.record('http://b.example/1.flv', 4000, 1)
+    urls = ['http://a.example/1.flv', 'http://b.example/1.flv', 'http://c.example/1.flv']
+    assert scoreboard.rank(urls) == ['http://b.example/1.flv', 'http://c.example/1.flv', 'http://a.example/1.flv']
+    for _ in range(3):
+        scoreboard.record_error('http://b.example/1.flv')
+    assert scoreboard.rank(urls)[-1] == 'http://b.example/1.flv'
+
+
+def test_scores_persist_between_runs(tmp_path):
+    file_name = str(tmp_path / 'mirrors.json')
+    scoreboard = HostScoreboard(file_name)
+    scoreboard.record('http://a.example/1.flv', 1000, 1)
+    scoreboard.save()
+    assert HostScoreboard(file_name).score('http://a.example/1.flv') == 1000
+    assert HostScoreboard(str(tmp_path / 'missing.json')).hosts == {}
+
+
+def test_failing_mirror_hands_its_ranges_to_the_next(tmp_path, range_server):
+    broken, good = range_server({'/1.flv': DATA}), range_server({'/1.flv': DATA})
+    broken.fail_gets = True
+    scoreboard = HostScoreboard(file_name=None)
+    file_name = str(tmp_path / '1.flv')
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, [broken.url + '/1.flv', good.url + '/1.flv'], file_name,
+                                     connections=2, scoreboard=scoreboard)
+        assert downloader.download()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert scoreboard.hosts[broken.url[7:]]['errors'] >= 1
+
+
+def test_interrupted_range_continues_from_the_received_byte(tmp_path, range_server):
+    broken, good = range_server({'/1.flv': DATA}), range_server({'/1.flv': DATA})
+    broken.break_after = 1000
+    file_name = str(tmp_path / '1.flv')
+    with requests.Session() as session:
+        downloader = RangeDownloader(session, [broken.url + '/1.flv', good.url + '/1.flv'], file_name,
+                                     connections=1, scoreboard=HostScoreboard(file_name=None))
+        downloader.chunk_size = 500  # 断开前收到的数据已交给缓冲区
+        assert downloader.download()
+    with open(file_name, 'rb') as f:
+        assert f.read() == DATA
+    assert [x[2] for x in good.requests if x[0] == 'GET'] == ['bytes=1000-{}'.format(len(DATA) - 1)]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 三种下载方式共用的分P流程（Video._download_page），下载步骤用假的实现代替
+import os
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+from base import Video, VideoPage, run_sync  # noqa: E402
+from catalog import get_download_index, shard_of  # noqa: E402
+from blobstore import BlobStore  # noqa: E402
+from retry import DownloadError  # noqa: E402
+import quality  # noqa: E402
+from util import JsonInfo  # noqa: E402
+
+
+class FakeSteps:
+    """只记录调用，逐段下载时直接写出分段文件"""
+
+    def __init__(self, tracks=None, leased=True, error=None):
+        self.calls = []
+        self.tracks = tracks
+        self.leased = leased
+        self.error = error
+
+    async def wait_page(self, cid, file_name):
+        self.calls.append('wait_page')
+        return self.leased
+
+    async def link(self, directory, cid, file_name):
+        self.calls.append('link')
+        return False
+
+    async def dash(self, directory, streams, title, connections):
+        self.calls.append('dash')
+        return self.tracks
+
+    async def concat(self, directory, segments, file_name, connections):
+        self.calls.append('concat')
+        return None
+
+    async def segment(self, directory, mirrors, file_name, connections):
+        self.calls.append('segment')
+        if self.error is not None:
+            raise self.error
+        with open(os.path.join(directory, file_name), 'wb') as f:
+            f.write(b'FLV')
+
+    async def mux(self, directory, tracks, output):
+        self.calls.append('mux')
+
+    async def merge(self, directory, movies, output):
+        self.calls.append('merge')
+
+    async def danmu(self, directory, title, cid):
+        self.calls.append('danmu')
+
+    async def release(self, directory, cid, file_name, merging):
+        self.calls.append(('release', os.path.basename(file_name)))
+
+
+@pytest.fixture
+def new_video():
+    def create(mirrors=None, dash=None):
+        video = Video(170001, load=False)  # 不请求接口
+        video.title = 'a b'
+        video._page_list = [VideoPage(1001, part='p1')]
+        video.mirror_url_dict = {'1001': mirrors or []}
+        if dash is not None:
+            video.dash_url_dict = {'1001': dash}
+        return video
+
+    return create
+
+
+def test_single_segment_page_is_renamed_and_released(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.flv']])
+    steps = FakeSteps()
+    run_sync(video._download_page(steps, 0, str(tmp_path), leased=True))
+    assert steps.calls == ['link', 'segment', 'danmu', ('release', 'a_b.flv')]
+    assert os.path.exists(str(tmp_path / 'a_b.flv')) and not os.path.exists(str(tmp_path / 'a_b_1.flv'))
+
+
+def test_multi_segment_page_is_merged(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.mp4'], ['http://cdn.example/2.mp4']])
+    steps = FakeSteps()
+    run_sync(video._download_page(steps, 0, str(tmp_path), leased=True))
+    assert steps.calls == ['link', 'segment', 'segment', 'merge', 'danmu', ('release', 'a_b.flv')]
+
+
+def test_incomplete_dash_page_skips_mux_and_danmu(tmp_path, new_video):
+    video = new_video(dash={'video': ['http://cdn.example/v.m4s'], 'audio': ['http://cdn.example/a.m4s']})
+    steps = FakeSteps(tracks=None)
+    run_sync(video._download_page(steps, 0, str(tmp_path)))
+    assert steps.calls == ['wait_page', 'link', 'dash', ('release', 'a_b.mp4')]
+
+
+def test_page_completed_by_another_process_is_not_released(tmp_path, new_video):
+    steps = FakeSteps(leased=False)
+    run_sync(new_video([['http://cdn.example/1.flv']])._download_page(steps, 0, str(tmp_path)))
+    assert steps.calls == ['wait_page']
+
+
+def test_download_error_fails_only_the_page(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.flv']])
+    steps = FakeSteps(error=DownloadError('区间多次下载失败'))
+    run_sync(video._download_page(steps, 0, str(tmp_path), leased=True))
+    assert steps.calls == ['link', 'segment', ('release', 'a_b.flv')]
+
+
+def test_page_in_the_download_index_is_skipped(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.flv']])
+    output = str(tmp_path / 'a_b.flv')
+    with open(output, 'wb') as f:
+        f.write(b'FLV')
+    get_download_index(str(tmp_path)).record(video.aid, '1001', output)
+    steps = FakeSteps()
+    run_sync(video._download_page(steps, 0, str(tmp_path), leased=True))
+    assert steps.calls == [('release', 'a_b.flv')]
+
+
+def test_sharded_page_is_written_under_its_cid_directory(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.flv']])
+    video.sharded = True
+    run_sync(video._download_page(FakeSteps(), 0, str(tmp_path), leased=True))
+    assert os.path.exists(str(tmp_path / shard_of('1001') / 'a_b.flv'))
+    assert video._check_pages(str(tmp_path), [0])
+
+
+def test_finished_page_is_stored_and_linked_into_another_directory(tmp_path, new_video):
+    store = BlobStore(str(tmp_path / 'store'))
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.mkdir()
+    second.mkdir()
+    video = new_video([['http://cdn.example/1.flv']])
+    video.blob_store, video.quality_dict = store, {'1001': 80}
+    run_sync(video._download_page(FakeSteps(), 0, str(first), leased=True))
+    video._release_page(str(first), '1001', str(first / 'a_b.flv'))  # FakeSteps不写索引，这里补上
+    assert video._link_from_store(str(second), '1001', str(second / 'a_b.flv'))
+    assert (second / 'a_b.flv').read_bytes() == b'FLV'
+    assert get_download_index(str(second)).lookup(video.aid, '1001')['quality'] == 80
+    store.close()
+
+
+def test_check_pages_reports_missing_outputs(tmp_path, new_video):
+    video = new_video([['http://cdn.example/1.flv']])
+    assert not video._check_pages(str(tmp_path), [0])
+    (tmp_path / 'a_b.flv').write_bytes(b'FLV')
+    assert video._check_pages(str(tmp_path), [0])
+
+
+def json_info(data):
+    """不请求接口的JsonInfo"""
+    info = JsonInfo.__new__(JsonInfo)
+    info.json = data
+    return info
+
+
+def test_cached_quality_skips_probe_when_max_quality_is_rejected(monkeypatch, new_video):
+    requested = []
+
+    def play_info(cid, qn):
+        requested.append(qn)
+        if qn > 80:
+            return json_info({})
+        return json_info({'quality': qn, 'durl': [{'url': 'http://cdn.example/1.flv'}]})
+
+    def probe(cid):
+        raise AssertionError('缓存中有记录时不应探测')
+
+    monkeypatch.setattr(quality, '_cache', quality.QualityCache(file_name=None))
+    quality._cache.set(1001, [32, 80, 64])
+    monkeypatch.setattr(Video, '_get_play_info', staticmethod(play_info))
+    monkeypatch.setattr(Video, '_get_video_quality_info', staticmethod(probe))
+    video = new_video()
+    video.download_url_dict, video.mirror_url_dict = {}, {}
+    video._get_video_download_url_v2()
+    assert requested == [127, 80] and video.mirror_url_dict['1001'] == [['http://cdn.example/1.flv']]
+    assert video.quality_dict['1001'] == 80
+
+
+def test_run_sync_rejects_coroutines_that_suspend():
+    with pytest.raises(RuntimeError):
+        run_sync(asyncio.sleep(0))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 进程内共享的HTTP连接池
+import asyncio
+import pytest
+
+pytest.importorskip('aiohttp')
+from pool import ConnectionPool, get_pool  # noqa: E402
+
+
+def test_requests_session_is_shared_and_bounded_per_host():
+    with ConnectionPool(limit=10, limit_per_host=3) as pool:
+        session = pool.session
+        assert pool.session is session
+        adapter = session.get_adapter('https://upos-hz-mirrorakam.akamaized.net/')
+        assert adapter._pool_maxsize == 3 and adapter._pool_block
+    assert pool._session is None
+
+
+def test_get_pool_returns_one_pool_per_process():
+    assert get_pool() is get_pool()
+
+
+def test_async_session_is_shared_within_a_loop():
+    pool = ConnectionPool()
+
+    async def sessions():
+        first, second = pool.async_session(), pool.async_session()
+        await pool.async_close()
+        return first, second
+
+    loop = asyncio.new_event_loop()
+    try:
+        first, second = loop.run_until_complete(sessions())
+    finally:
+        loop.close()
+    assert first is second and first.closed
+
+
+def test_async_session_is_recreated_for_a_new_loop():
+    pool = ConnectionPool()
+
+    async def session():
+        return pool.async_session()
+
+    sessions = []
+    for _ in range(2):
+        loop = asyncio.new_event_loop()
+        try:
+            sessions.append(loop.run_until_complete(session()))
+            loop.run_until_complete(pool.async_close())
+        finally:
+            loop.close()
+    assert sessions[0] is not sessions[1]
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 下载进度汇总输出
+import io
+import json
+import pytest
+from progress import ProgressReporter
+
+
+@pytest.fixture
+def make():
+    reporters = []
+
+    def make(json_lines):
+        reporter = ProgressReporter(io.StringIO(), json_lines=json_lines, interval=3600)  # 只在测试中手动输出
+        reporters.append(reporter)
+        return reporter
+
+    yield make
+    for reporter in reporters:
+        reporter.close()
+
+
+def json_lines(reporter):
+    return [json.loads(line) for line in reporter.stream.getvalue().splitlines()]
+
+
+def test_json_lines_report_totals_and_finished_jobs_once(make):
+    reporter = make(json_lines=True)
+    with reporter.task('a.flv', 100) as first:
+        second = reporter.task('b.flv')
+        first.update(60)
+        second.update(10)
+        reporter.render()
+    reporter.render()
+    second.close()
+    reporter.render()
+    reporter.render()  # 没有任务时不输出
+
+    lines = json_lines(reporter)
+    assert len(lines) == 3
+    assert (lines[0]['done'], lines[0]['total']) == (70, 110)  # 总大小未知的任务按已下载量计入
+    assert [job['status'] for job in lines[0]['jobs']] == ['running', 'running']
+    assert [(job['name'], job['status']) for job in lines[1]['jobs']] == [('a.flv', 'done'), ('b.flv', 'running')]
+    assert [(job['name'], job['status']) for job in lines[2]['jobs']] == [('b.flv', 'done')]
+    assert (lines[2]['done'], lines[2]['total']) == (70, 110)
+
+
+def test_json_lines_log_messages(make):
+    reporter = make(json_lines=True)
+    reporter.write('视频[a.flv]合并完成！')
+    assert json_lines(reporter)[0]['message'] == '视频[a.flv]合并完成！'
+
+
+def test_terminal_messages_are_printed_above_the_progress_lines(make):
+    reporter = make(json_lines=False)
+    task = reporter.task('a.flv', 100)
+    task.update(50)
+    reporter.render()
+    reporter.write('hello')
+    output = reporter.stream.getvalue()
+    assert output.count('  50.0% 50.0B/100.0B') == 2  # 总进度条
+    assert '\x1b[2F\x1b[J' + 'hello\n' in output  # 先擦除两行进度再输出日志，之后重新画出进度
+    assert output.endswith('a.flv\n')
+    task.close()
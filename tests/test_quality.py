@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 按cid缓存的可用清晰度
+from quality import QualityCache
+
+
+def test_entries_are_sorted_saved_and_expire(tmp_path):
+    file_name = str(tmp_path / 'quality.json')
+    cache = QualityCache(file_name=file_name)
+    cache.set(1001, [32, 80, 64])
+    cache.set(1002, None)  # 响应中没有accept_quality时不记录
+    cache.save()
+    assert QualityCache(file_name=file_name).get(1001) == [80, 64, 32]
+    assert cache.get(1002) is None
+    assert QualityCache(file_name=file_name, ttl=0).get(1001) is None
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 令牌桶限速
+import pytest
+from ratelimit import TokenBucket, parse_rate, throttle
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, 0),
+    (1000, 1000),
+    ('500', 500),
+    ('500K', 500 * 1024),
+    ('10m', 10 * 1024 * 1024),
+    ('1.5G', int(1.5 * 1024 ** 3)),
+    (' 2MB ', 2 * 1024 * 1024),
+])
+def test_parse_rate(value, expected):
+    assert parse_rate(value) == expected
+
+
+@pytest.mark.parametrize('value', ['fast', '10T', '-1M', ''])
+def test_parse_rate_rejects_garbage(value):
+    with pytest.raises(ValueError):
+        parse_rate(value)
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+    assert bucket.consume(10 ** 9) == 0
+    assert bucket.consumed == 10 ** 9
+
+
+def test_consume_borrows_and_reports_wait():
+    bucket = TokenBucket(rate=1000, burst=1000)
+    bucket._tokens = 1000
+    assert bucket.consume(1000) == 0
+    wait = bucket.consume(500)  # 预支500字节，按1000字节/秒需要等待约0.5秒
+    assert 0.45 < wait <= 0.5
+    wait = bucket.consume(500)  # 欠账累计
+    assert 0.95 < wait <= 1.0
+
+
+def test_set_rate_caps_tokens_to_new_burst():
+    bucket = TokenBucket(rate=1000, burst=1000)
+    bucket._tokens = 1000
+    bucket.set_rate(100)
+    assert bucket.burst == 100
+    assert bucket.consume(100) == 0
+    assert bucket.consume(50) > 0
+    bucket.set_rate(0)
+    assert bucket.consume(10 ** 6) == 0
+
+
+def test_throttle_uses_slowest_bucket(monkeypatch):
+    slept = []
+    monkeypatch.setattr('ratelimit.time.sleep', slept.append)
+    fast, slow = TokenBucket(rate=10 ** 6), TokenBucket(rate=100)
+    throttle(100, fast, None, slow)
+    assert len(slept) == 1 and 0.9 < slept[0] <= 1.0
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 最低速度看门狗和尾部对冲请求
+import os
+import functools
+import requests
+import pytest
+
+pytest.importorskip('aiohttp')
+import downloader  # noqa: E402
+from benchmark import FakeBilibili, start_server  # noqa: E402
+from downloader import ORIGINAL, HEDGE, RangeDownloader, RangeTask  # noqa: E402
+from mirror import HostScoreboard  # noqa: E402
+from ratelimit import TokenBucket  # noqa: E402
+from retry import HEDGE_MIN_SIZE, DownloadError, HedgeCancelled, SpeedWatchdog, StallError  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_watchdog_raises_after_a_slow_window():
+    clock = FakeClock()
+    watchdog = SpeedWatchdog(min_speed=100, window=10, clock=clock)
+    clock.now = 9
+    watchdog.update(10)  # 窗口还没结束
+    clock.now = 10
+    with pytest.raises(StallError):
+        watchdog.update(10)
+
+
+def test_watchdog_starts_a_new_window_when_fast_enough():
+    clock = FakeClock()
+    watchdog = SpeedWatchdog(min_speed=100, window=10, clock=clock)
+    clock.now = 10
+    watchdog.update(1000)
+    clock.now = 19
+    watchdog.update(0)  # 新窗口还没结束，之前的字节不再计入
+    clock.now = 20
+    with pytest.raises(StallError):
+        watchdog.update(500)
+
+
+def test_watchdog_ignores_throttle_delay():
+    clock = FakeClock()
+    watchdog = SpeedWatchdog(min_speed=100, window=10, clock=clock)
+    for _ in range(10):
+        clock.now += 5  # 每块数据到达后限速等待4.5秒，网络上只用了0.5秒
+        watchdog.update(100, paused=4.5)
+    assert clock.now == 50
+
+
+def test_watchdog_stops_the_cancelled_side():
+    watchdog = SpeedWatchdog(cancelled=lambda: True)
+    with pytest.raises(HedgeCancelled):
+        watchdog.update(1)
+
+
+class FakeBuffer:
+    def __init__(self, offset, position):
+        self.offset = offset
+        self.position = position
+
+
+def new_tasks(size, remaining):
+    """每个区间size字节，原请求各剩remaining中对应的字节数"""
+    tasks = []
+    for i, left in enumerate(remaining):
+        task = RangeTask(None, i * size, (i + 1) * size - 1, i)
+        task.buffer = FakeBuffer(task.start, task.end + 1 - left)
+        tasks.append(task)
+    return tasks
+
+
+def test_hedge_waits_for_the_threshold():
+    size = 4 * HEDGE_MIN_SIZE
+    assert RangeDownloader._start_hedges(None, new_tasks(size, [0] * 8 + [size, size])) == []
+
+
+def test_hedge_starts_for_large_remaining_ranges_only():
+    size = 100 * HEDGE_MIN_SIZE
+    tasks = new_tasks(size, [0] * 97 + [HEDGE_MIN_SIZE, HEDGE_MIN_SIZE - 1, 0])
+    hedges = RangeDownloader._start_hedges(None, tasks)
+    assert hedges == [(tasks[97], tasks[97].buffer.offset)]
+    assert RangeDownloader._start_hedges(None, tasks) == []  # 同一区间只对冲一次
+
+
+def test_hedge_skips_ranges_that_have_not_started():
+    size = 100 * HEDGE_MIN_SIZE
+    tasks = new_tasks(size, [0] * 99 + [size])
+    tasks[-1].buffer = None
+    assert RangeDownloader._start_hedges(None, tasks) == []
+
+
+class FakeDownloader:
+    def __init__(self):
+        self.written = []
+
+    def _on_written(self, offset, length, digest=None):
+        self.written.append((offset, length))
+
+
+def test_hedge_winner_keeps_its_chunks():
+    owner = FakeDownloader()
+    task = RangeTask(owner, 0, 99)
+    task.buffer = FakeBuffer(40, 40)
+    assert task.start_hedge() == 40
+    task.record(ORIGINAL, 0, 40)  # 对冲起点之前的分块直接记入进度
+    task.record(ORIGINAL, 40, 30)
+    task.record(HEDGE, 40, 60)
+    assert owner.written == [(0, 40)]
+    assert not task.finish(HEDGE)
+    assert owner.written == [(0, 40), (40, 60)]
+    assert task.cancelled(ORIGINAL) and not task.cancelled(HEDGE)
+    assert not task.finish(ORIGINAL, IOError('已取消'))
+
+
+def test_throttled_range_download_is_not_a_stall(tmp_path, monkeypatch):
+    base_url = start_server(FakeBilibili(size=128 * 1024))
+    # 每秒64KB的限速远低于最低速度，限速等待计入检测窗口时会被当作停滞
+    monkeypatch.setattr(downloader, 'SpeedWatchdog', functools.partial(SpeedWatchdog, min_speed=1024 * 1024,
+                                                                       window=0.2))
+    file_name = str(tmp_path / 'video.flv')
+    with requests.Session() as session:
+        range_downloader = RangeDownloader(session, base_url + '/media/1-1.flv', file_name, connections=1,
+                                           scoreboard=HostScoreboard(file_name=None), bucket=TokenBucket(64 * 1024))
+        range_downloader.chunk_size = 16 * 1024
+        assert range_downloader.download()
+    with open(file_name, 'rb') as f:
+        assert len(f.read()) == 128 * 1024
+
+
+def test_exhausted_range_raises_download_error_and_keeps_progress(tmp_path, monkeypatch, range_server):
+    server = range_server({'/1.flv': b'x' * 100})
+    monkeypatch.setattr(downloader, 'RETRY_ATTEMPTS', 1)
+    file_name = str(tmp_path / 'video.flv')
+    with requests.Session() as session:
+        range_downloader = RangeDownloader(session, server.url + '/1.flv', file_name, connections=1,
+                                           scoreboard=HostScoreboard(file_name=None))
+        assert range_downloader.probe() == 100
+        server.fail_gets = True  # 之后的区间请求都失败
+        with pytest.raises(DownloadError):
+            range_downloader.download()
+    assert os.path.exists(file_name + '.part.json')  # 进度仍然保存，下次从断点继续
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 常驻服务的任务队列和HTTP接口
+import json
+import threading
+import http.client
+from http.server import ThreadingHTTPServer
+import pytest
+
+pytest.importorskip('aiohttp')
+from server import DONE, QUEUED, RUNNING, DownloadServer, JobRequestHandler  # noqa: E402
+
+
+class FakeDownload:
+    """记录同时运行的任务，release之前一直阻塞"""
+
+    def __init__(self):
+        self.started = []
+        self.running = set()
+        self.overlap = False
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+        self._started = threading.Condition(self._lock)
+
+    def __call__(self, job):
+        with self._lock:
+            self.overlap = self.overlap or job.key in self.running
+            self.running.add(job.key)
+            self.started.append(job.id)
+            self._started.notify_all()
+        self.release.wait(5)
+        with self._lock:
+            self.running.discard(job.key)
+        return True
+
+    def wait_started(self, count):
+        with self._lock:
+            assert self._started.wait_for(lambda: len(self.started) >= count, 5)
+
+
+def wait_status(job, status):
+    for _ in range(500):
+        if job.status == status:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError('任务{}的状态为{}'.format(job.id, job.status))
+
+
+def test_queued_job_absorbs_a_duplicate_submit(tmp_path):
+    download = FakeDownload()
+    server = DownloadServer(download, workers=1, directory=str(tmp_path))
+    blocker, _ = server.submit({'aid': 1})
+    download.wait_started(1)
+    job, created = server.submit({'aid': 2, 'pages': [1]})
+    same, merged = server.submit({'aid': 'av2', 'pages': [3], 'danmu': True})
+    assert created and not merged and same is job
+    assert job.status == QUEUED and job.pages == [1, 3] and job.danmu
+    download.release.set()
+    wait_status(job, DONE)
+    assert download.started == [blocker.id, job.id]
+
+
+def test_running_job_is_returned_or_followed_not_overlapped(tmp_path):
+    download = FakeDownload()
+    server = DownloadServer(download, workers=2, directory=str(tmp_path))
+    job, _ = server.submit({'aid': 1, 'pages': [1, 2]})
+    download.wait_started(1)
+    assert job.status == RUNNING
+    assert server.submit({'aid': 1, 'pages': [2]}) == (job, False)  # 正在运行的任务已包含这个分P
+    later, created = server.submit({'aid': 1, 'pages': [3]})
+    assert created and later is not job
+    threading.Event().wait(0.1)
+    assert download.started == [job.id]  # 另一个工作线程空闲，但同一视频和目录的任务不同时运行
+    download.release.set()
+    wait_status(later, DONE)
+    assert download.started == [job.id, later.id] and not download.overlap
+
+
+def test_other_directory_runs_in_parallel(tmp_path):
+    download = FakeDownload()
+    server = DownloadServer(download, workers=2)
+    server.submit({'aid': 1, 'directory': str(tmp_path / 'a')})
+    _, created = server.submit({'aid': 1, 'directory': str(tmp_path / 'b')})
+    assert created
+    download.wait_started(2)
+    download.release.set()
+
+
+def test_http_submit_returns_existing_job(tmp_path):
+    download = FakeDownload()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), JobRequestHandler)
+    httpd.downloader = DownloadServer(download, workers=1, directory=str(tmp_path))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    def post(body):
+        connection = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+        connection.request('POST', '/jobs', json.dumps(body))
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read().decode('utf-8'))
+        connection.close()
+        return result
+
+    try:
+        status, first = post({'aid': 170001, 'pages': [1, 2]})
+        assert status == 201
+        status, second = post({'aid': 170001, 'pages': [1]})
+        assert status == 200 and second['id'] == first['id']
+        assert post({'aid': 'abc'})[0] == 400
+    finally:
+        download.release.set()
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 接口响应体的逐块解压
+import gzip
+import zlib
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from urllib3.exceptions import ProtocolError
+
+pytest.importorskip('aiohttp')
+import util  # noqa: E402
+import httpcache  # noqa: E402
+from util import ApiConnectionError, StreamDecoder  # noqa: E402
+
+BODY = b'{"code": 0, "data": {"title": "\xe6\xb5\x8b\xe8\xaf\x95"}}' * 200
+
+
+def chunks(data, size=37):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decode(encoding, data):
+    decoder = StreamDecoder(encoding)
+    return b''.join(decoder.decode(chunk) for chunk in chunks(data)) + decoder.flush()
+
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize('encoding, data', [
+    (None, BODY),
+    ('identity', BODY),
+    ('gzip', gzip.compress(BODY)),
+    (' GZIP ', gzip.compress(BODY)),
+    ('deflate', zlib.compress(BODY)),
+    ('deflate', raw_deflate(BODY)),  # 不带zlib头尾的deflate
+])
+def test_decode_in_chunks(encoding, data):
+    assert decode(encoding, data) == BODY
+
+
+def test_brotli():
+    brotli = pytest.importorskip('brotli')
+    assert decode('br', brotli.compress(BODY)) == BODY
+
+
+def test_brotli_missing(monkeypatch):
+    monkeypatch.setattr(util, 'brotli', None)
+    with pytest.raises(ApiConnectionError):
+        StreamDecoder('br')
+
+
+class FakeRaw:
+    def __init__(self, data, error=None):
+        self.data = data
+        self.error = error
+
+    def stream(self, size, decode_content=True):
+        assert not decode_content  # 解压由StreamDecoder完成
+        yield from chunks(self.data, size)
+        if self.error is not None:
+            raise self.error
+
+
+class FakeResponse:
+    url = 'https://api.bilibili.com/x/web-interface/view?aid=1'
+
+    def __init__(self, data, encoding, error=None):
+        self.raw = FakeRaw(data, error)
+        self.headers = {'Content-Encoding': encoding}
+
+
+def test_read_body():
+    assert util._read_body(FakeResponse(gzip.compress(BODY), 'gzip')) == BODY
+
+
+def test_read_body_corrupt():
+    with pytest.raises(ApiConnectionError) as info:
+        util._read_body(FakeResponse(b'not gzip at all', 'gzip'))
+    assert info.value.url == FakeResponse.url
+
+
+def test_read_body_connection_broken():
+    data = gzip.compress(BODY)
+    error = ProtocolError('Connection broken', ConnectionResetError())
+    with pytest.raises(ApiConnectionError) as info:
+        util._read_body(FakeResponse(data[:len(data) // 2], 'gzip', error))
+    assert info.value.url == FakeResponse.url
+
+
+class TruncatingHandler(BaseHTTPRequestHandler):
+    """声明完整长度，只发送一半响应体就关闭连接"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY[:len(BODY) // 2])
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def test_get_url_content_truncated_body(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), TruncatingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(httpcache, '_cache', httpcache.HttpCache(file_name=None))
+    monkeypatch.setattr(util, 'sleep_backoff', lambda attempt: None)
+    try:
+        url = 'http://127.0.0.1:{}/x/web-interface/view?aid=1'.format(server.server_port)
+        with pytest.raises(ApiConnectionError) as info:
+            util.get_url_content(url)
+        assert info.value.url == url
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# Video的元数据：view接口返回的状态信息和选集直接使用，缺少时首次访问才请求
+import threading
+import pytest
+
+pytest.importorskip('aiohttp')
+import base  # noqa: E402
+from base import Video  # noqa: E402
+from test_pages import json_info  # noqa: E402
+
+VIEW = {'videos': 1, 'cid': 1001, 'tid': 17, 'tname': '单机游戏', 'copyright': 1, 'pic': '', 'title': 'a',
+        'pubdate': 0, 'desc': '', 'duration': 60, 'owner': {'mid': 1}}
+STAT = {'coin': 1, 'danmaku': 2, 'favorite': 3, 'like': 4, 'reply': 5, 'share': 6, 'view': 7, 'copyright': 1}
+PAGES = [{'cid': 1001, 'page': 1, 'from': 'vupload', 'part': 'p1', 'duration': 60,
+          'dimension': {'width': 1920, 'height': 1080, 'rotate': 0}}]
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """假的接口，按地址返回数据并记录请求"""
+    responses = {}
+    requested = []
+    lock = threading.Lock()
+
+    def get_json_info(url):
+        with lock:
+            requested.append(url)
+        for prefix, data in responses.items():
+            if url.startswith(prefix):
+                return json_info({'code': 0, 'data': data})
+        raise AssertionError('未预期的请求：' + url)
+
+    monkeypatch.setattr(base, 'get_json_info', get_json_info)
+    return responses, requested
+
+
+def test_view_with_stat_and_pages_needs_one_request(api):
+    responses, requested = api
+    responses[base.webApiPrefix + 'view'] = dict(VIEW, stat=STAT, pages=PAGES)
+    video = Video(170001)
+    assert (video.view, video.dan_mu_count, video.page_list[0].cid) == (7, 2, 1001)
+    assert len(requested) == 1
+
+
+def test_missing_stat_and_pages_are_loaded_on_first_access(api):
+    responses, requested = api
+    responses[base.webApiPrefix + 'view'] = VIEW
+    responses[base.webApiPrefix + 'archive/stat'] = STAT
+    responses[base.playerApiPrefix + 'pagelist'] = PAGES
+    video = Video(170001)
+    assert len(requested) == 1
+    assert video.like == 4 and video.coin == 1
+    assert len(requested) == 2
+    assert [page.part for page in video.page_list] == ['p1']
+    assert len(requested) == 3
+    video.page_list
+    assert len(requested) == 3  # 只请求一次
+
+
+def test_str_loads_both_missing_parts_and_hides_private_fields(api):
+    responses, requested = api
+    responses[base.webApiPrefix + 'view'] = VIEW
+    responses[base.webApiPrefix + 'archive/stat'] = STAT
+    responses[base.playerApiPrefix + 'pagelist'] = PAGES
+    video = Video(170001)
+    fields = dict(zip(video.keys(), video.values()))
+    assert len(requested) == 3
+    assert fields['share'] == 6 and len(fields['page_list']) == 1
+    assert not any(name.startswith('_') for name in fields)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# 网络到磁盘之间的写盘阶段：缓冲池、写线程和区间缓冲
+import asyncio
+import threading
+import pytest
+
+pytest.importorskip('aiohttp')
+from downloader import AsyncRangeDownloader, PartState, RangeTask, write_async  # noqa: E402
+from mirror import HostScoreboard  # noqa: E402
+from writer import BufferPool, FileWriter, RangeBuffer  # noqa: E402
+
+
+def test_buffer_pool_blocks_until_release():
+    pool = BufferPool(16, 1)
+    buffer = pool.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        pool.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    assert not acquired.wait(0.1)
+    pool.release(buffer)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_range_buffers_write_at_their_offsets(tmp_path):
+    file_name = str(tmp_path / 'out')
+    written = []
+    with FileWriter(file_name, 20, producers=2, buffer_size=4) as writer:
+        first = RangeBuffer(writer, 0, lambda offset, length: written.append((offset, length)))
+        second = RangeBuffer(writer, 10, lambda offset, length: written.append((offset, length)))
+        second.write(b'KLMNOPQRST')
+        first.write(b'ABCDEFGHIJ')
+        first.flush()
+        second.flush()
+    with open(file_name, 'rb') as f:
+        assert f.read() == b'ABCDEFGHIJKLMNOPQRST'
+    assert sorted(written) == [(0, 4), (4, 4), (8, 2), (10, 4), (14, 4), (18, 2)]
+
+
+def test_discard_returns_the_buffer(tmp_path):
+    with FileWriter(str(tmp_path / 'out'), 8, producers=1, queue_size=1, buffer_size=4) as writer:
+        buffer = RangeBuffer(writer, 0)
+        buffer.write(b'AB')
+        buffer.discard()
+        assert writer.pool._free.qsize() == 1
+        assert buffer.position == 0
+
+
+def test_cancelled_ranges_return_their_buffers(tmp_path):
+    file_name = str(tmp_path / 'video.flv')
+    size = 1024 * 1024
+    downloader = AsyncRangeDownloader(None, 'http://cdn.example/1.flv', file_name, connections=1,
+                                      scoreboard=HostScoreboard(file_name=None))
+    downloader.content_size = size
+    downloader.state = PartState(file_name, size)
+    started = asyncio.Event()
+
+    async def chunks():
+        yield b'x' * 1000
+        yield b'y' * 1000
+
+    async def fetch(url, buffer, end, watchdog=None):
+        await write_async(buffer, chunks(), False)
+        started.set()
+        await asyncio.sleep(3600)  # 慢镜像，直到被取消
+
+    downloader._fetch = fetch
+    writer = FileWriter(downloader.state.part_name, size, producers=1, queue_size=1, buffer_size=64 * 1024)
+
+    async def main():
+        for i in range(2 * writer.pool.max_buffers + 2):  # 泄漏时缓冲池早已耗尽
+            started.clear()
+            future = asyncio.ensure_future(downloader._download_range(writer, RangeTask(downloader, 0, size - 1)))
+            if i % 2:
+                await asyncio.wait_for(started.wait(), 5)
+            else:
+                await asyncio.sleep(0)  # 取消时线程池中可能仍在写入
+            future.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await future
+            assert writer.pool._free.qsize() == writer.pool._created  # 缓冲区都已归还
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(main(), 30))
+    finally:
+        loop.close()
+        writer.close()